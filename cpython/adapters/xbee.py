@@ -1,8 +1,314 @@
-"""
-xbee.py re-implements the 'xbee' module from Digi XBee MicroPython in CPython using xbee-python library
-and an XBee attached locally to a PC. Rationale: This allows MicroPython code written for an XBee to be
-developed on a PC for convenience. Once the code is working, it can be deployed to the XBee for testing
-with the actual Digi MicroPython interpreter.
-"""
-
-# TODO
+"""
+xbee.py re-implements the 'xbee' module from Digi XBee MicroPython in CPython using xbee-python library
+and an XBee attached locally to a PC. Rationale: This allows MicroPython code written for an XBee to be
+developed on a PC for convenience. Once the code is working, it can be deployed to the XBee for testing
+with the actual Digi MicroPython interpreter.
+
+Usage:
+    with OpenXBeeDevice(XBeeDevice(port, baud)) as device:
+        xbee.attach(device)
+        ...run device code that calls xbee.transmit(), xbee.receive(), xbee.atcmd(), xbee.relay...
+        xbee.detach()
+
+Performance notes:
+- receive() and relay.receive() never touch the serial port: xbee-python's reader thread parses incoming frames
+  in the background and our callbacks append them to bounded deques (oldest dropped first, and counted).
+- transmit() only queues the frame and returns, like the radio's own transmit buffer. A sender thread assigns
+  frame IDs, keeps up to max_in_flight frames outstanding, and matches transmit status frames back to them, so
+  delivery results show up in stats() rather than blocking each call. Use flush() to wait for the results.
+  When the queue is full, transmit() raises OSError(ENOBUFS), just as the device does.
+- atcmd() of read-only registers (serial number, versions, etc.) is answered from a cache after the first read.
+
+transmit() sends a Transmit Request (0x10), or a TX64 Request (0x00) on 802.15.4 firmware. Non-default endpoints,
+cluster or profile need an Explicit Addressing Command (0x11), which 802.15.4 firmware doesn't have, so there they
+raise ValueError, as does a broadcast radius (802.15.4 doesn't route).
+"""
+
+import collections
+import errno
+import threading
+import time
+from typing import Any, Optional
+
+from digi.xbee.models.address import XBee16BitAddress, XBee64BitAddress
+from digi.xbee.models.options import XBeeLocalInterface
+from digi.xbee.models.protocol import XBeeProtocol
+from digi.xbee.models.status import TransmitStatus
+from digi.xbee.packets.common import ExplicitAddressingPacket, TransmitPacket, TransmitStatusPacket
+from digi.xbee.packets.raw import TX64Packet, TXStatusPacket
+
+ADDR_BROADCAST = b"\x00\x00\x00\x00\x00\x00\xff\xff"
+ADDR_COORDINATOR = b"\x00\x00\x00\x00\x00\x00\x00\x00"
+
+READ_ONLY_REGISTERS = ("SH", "SL", "HV", "VR", "DD", "NP")  # Safe to cache: they never change while running.
+STRING_REGISTERS = ("NI", "KP")  # atcmd() returns these as str; every other register is returned as an int.
+
+DEFAULT_ENDPOINT = 0xE8
+DEFAULT_CLUSTER = 0x11
+DEFAULT_PROFILE = 0xC105
+
+MAX_PENDING_TRANSMITS = 64
+MAX_IN_FLIGHT = 8
+RECEIVE_QUEUE_SIZE = 256
+TRANSMIT_STATUS_TIMEOUT_SEC = 5.0
+
+
+class XBeeAdapter:
+    """ XBeeAdapter holds the queues and threads that bridge one opened xbee-python device to this module's API. """
+
+    def __init__(self, device, max_pending: int = MAX_PENDING_TRANSMITS, max_in_flight: int = MAX_IN_FLIGHT,
+                 receive_queue_size: int = RECEIVE_QUEUE_SIZE):
+        self.device = device
+        self.raw_802 = device.get_protocol() == XBeeProtocol.RAW_802_15_4
+        self.max_pending = max_pending
+        self.max_in_flight = max_in_flight
+        self.received = collections.deque(maxlen=receive_queue_size)
+        self.relayed = collections.deque(maxlen=receive_queue_size)
+        self.register_cache = {}
+        self._pending = collections.deque()  # Queued (dest, payload, options) transmissions.
+        self._in_flight = {}  # Frame ID -> time sent.
+        self._next_frame_id = 1
+        self._cv = threading.Condition()
+        self._stopping = False
+        self._stats = {"queued": 0, "sent": 0, "delivered": 0, "failed": 0, "timed_out": 0, "rejected": 0,
+                       "received": 0, "receive_dropped": 0, "relay_received": 0, "relay_dropped": 0,
+                       "atcmd": 0, "atcmd_cached": 0, "status_latency_sec": 0.0}
+        device.add_data_received_callback(self._on_data_received)
+        device.add_user_data_relay_received_callback(self._on_relay_received)
+        device.add_packet_received_callback(self._on_packet_received)
+        self._sender = threading.Thread(target=self._send_loop, name="xbee-adapter-sender", daemon=True)
+        self._sender.start()
+
+    def close(self) -> None:
+        """ close stops the sender thread and unhooks from the device. Queued transmissions are discarded. """
+        with self._cv:
+            self._stopping = True
+            self._cv.notify_all()
+        self._sender.join()
+        self.device.del_data_received_callback(self._on_data_received)
+        self.device.del_user_data_relay_received_callback(self._on_relay_received)
+        self.device.del_packet_received_callback(self._on_packet_received)
+
+    def stats(self) -> dict:
+        with self._cv:
+            result = dict(self._stats)
+            result["pending"] = len(self._pending)
+            result["in_flight"] = len(self._in_flight)
+        completed = result["delivered"] + result["failed"]
+        result["mean_status_latency_ms"] = 1000.0 * result.pop("status_latency_sec") / completed if completed else 0.0
+        return result
+
+    def flush(self, timeout_sec: float = 10.0) -> bool:
+        """ flush waits until every queued transmission has its status. Returns False if the timeout expired. """
+        deadline = time.monotonic() + timeout_sec
+        with self._cv:
+            while self._pending or self._in_flight:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._cv.wait(remaining)
+        return True
+
+    # ---- MicroPython xbee API ----
+
+    def transmit(self, dest, payload, source_ep: int = DEFAULT_ENDPOINT, dest_ep: int = DEFAULT_ENDPOINT,
+                 cluster: int = DEFAULT_CLUSTER, profile: int = DEFAULT_PROFILE, bcast_radius: int = 0,
+                 tx_options: int = 0) -> None:
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        explicit = (source_ep, dest_ep, cluster, profile) != (DEFAULT_ENDPOINT, DEFAULT_ENDPOINT, DEFAULT_CLUSTER,
+                                                              DEFAULT_PROFILE)
+        if self.raw_802 and explicit:
+            raise ValueError("802.15.4 firmware doesn't support endpoints, cluster or profile")
+        if self.raw_802 and bcast_radius:
+            raise ValueError("802.15.4 firmware doesn't support bcast_radius")
+        options = (explicit, source_ep, dest_ep, cluster, profile, bcast_radius, tx_options)
+        with self._cv:
+            if len(self._pending) >= self.max_pending:
+                self._stats["rejected"] += 1
+                raise OSError(errno.ENOBUFS, "ENOBUFS")
+            self._pending.append((bytes(dest), bytes(payload), options))
+            self._stats["queued"] += 1
+            self._cv.notify_all()
+
+    def receive(self) -> Optional[dict]:
+        try:
+            return self.received.popleft()
+        except IndexError:
+            return None
+
+    def atcmd(self, cmd: str, value: Any = None) -> Any:
+        cmd = cmd.upper()
+        with self._cv:
+            self._stats["atcmd"] += 1
+        if value is None:
+            if cmd in self.register_cache:
+                with self._cv:
+                    self._stats["atcmd_cached"] += 1
+                return self.register_cache[cmd]
+            result = self._decode(cmd, self.device.get_parameter(cmd))
+            if cmd in READ_ONLY_REGISTERS:
+                self.register_cache[cmd] = result
+            return result
+        self.register_cache.pop(cmd, None)
+        self.device.set_parameter(cmd, self._encode(value))
+        return None
+
+    def relay_send(self, dest: int, data) -> None:
+        self.device.send_user_data_relay(XBeeLocalInterface.get(dest), bytes(data))
+
+    def relay_receive(self) -> Optional[dict]:
+        try:
+            return self.relayed.popleft()
+        except IndexError:
+            return None
+
+    # ---- Internals ----
+
+    @staticmethod
+    def _decode(cmd: str, raw) -> Any:
+        if raw is None or len(raw) == 0:
+            return None
+        if cmd in STRING_REGISTERS:
+            return bytes(raw).decode("utf-8", "replace")
+        return int.from_bytes(raw, "big")
+
+    @staticmethod
+    def _encode(value) -> bytes:
+        if isinstance(value, int):
+            return value.to_bytes(max(1, (value.bit_length() + 7) // 8), "big")
+        if isinstance(value, str):
+            return value.encode("utf-8")
+        return bytes(value)
+
+    def _build_packet(self, frame_id: int, dest: bytes, payload: bytes, options: tuple):
+        explicit, source_ep, dest_ep, cluster, profile, bcast_radius, tx_options = options
+        address = XBee64BitAddress(dest)
+        if self.raw_802:
+            return TX64Packet(frame_id, address, tx_options, rf_data=payload)
+        if explicit:
+            return ExplicitAddressingPacket(frame_id, address, XBee16BitAddress.UNKNOWN_ADDRESS, source_ep, dest_ep,
+                                            cluster, profile, bcast_radius, tx_options, rf_data=payload)
+        return TransmitPacket(frame_id, address, XBee16BitAddress.UNKNOWN_ADDRESS, bcast_radius, tx_options,
+                              rf_data=payload)
+
+    def _allocate_frame_id(self) -> int:
+        """ _allocate_frame_id returns the next frame ID (1 to 255) that isn't already awaiting a status. """
+        while True:
+            frame_id = self._next_frame_id
+            self._next_frame_id = 1 if frame_id == 255 else frame_id + 1
+            if frame_id not in self._in_flight:
+                return frame_id
+
+    def _send_loop(self) -> None:
+        while True:
+            with self._cv:
+                while not self._stopping and (not self._pending or len(self._in_flight) >= self.max_in_flight):
+                    self._expire_in_flight()
+                    self._cv.wait(0.1)
+                if self._stopping:
+                    return
+                dest, payload, options = self._pending.popleft()
+                frame_id = self._allocate_frame_id()
+                self._in_flight[frame_id] = time.monotonic()
+            try:
+                self.device.send_packet(self._build_packet(frame_id, dest, payload, options), sync=False)
+            except Exception:
+                with self._cv:
+                    self._in_flight.pop(frame_id, None)
+                    self._stats["failed"] += 1
+                    self._cv.notify_all()
+                continue
+            with self._cv:
+                self._stats["sent"] += 1
+
+    def _expire_in_flight(self) -> None:
+        """ _expire_in_flight forgets frames whose status never arrived. Call with self._cv held. """
+        now = time.monotonic()
+        for frame_id, sent_at in list(self._in_flight.items()):
+            if now - sent_at > TRANSMIT_STATUS_TIMEOUT_SEC:
+                del self._in_flight[frame_id]
+                self._stats["timed_out"] += 1
+                self._cv.notify_all()
+
+    def _on_packet_received(self, packet) -> None:
+        if not isinstance(packet, (TransmitStatusPacket, TXStatusPacket)):
+            return
+        with self._cv:
+            sent_at = self._in_flight.pop(packet.frame_id, None)
+            if sent_at is None:
+                return  # Not ours (e.g., a synchronous send by other code) or already timed out.
+            self._stats["status_latency_sec"] += time.monotonic() - sent_at
+            if packet.transmit_status == TransmitStatus.SUCCESS:
+                self._stats["delivered"] += 1
+            else:
+                self._stats["failed"] += 1
+            self._cv.notify_all()
+
+    # The receive callbacks run on xbee-python's reader thread, so they update the stats under the same lock.
+
+    def _on_data_received(self, message) -> None:
+        entry = {
+            "broadcast": message.is_broadcast, "dest_ep": DEFAULT_ENDPOINT, "source_ep": DEFAULT_ENDPOINT,
+            "cluster": DEFAULT_CLUSTER, "profile": DEFAULT_PROFILE, "sender_nwk": 0xFFFE,
+            "sender_eui64": bytes(message.remote_device.get_64bit_addr().address), "payload": bytes(message.data)}
+        with self._cv:
+            if len(self.received) == self.received.maxlen:
+                self._stats["receive_dropped"] += 1
+            self._stats["received"] += 1
+            self.received.append(entry)
+
+    def _on_relay_received(self, message) -> None:
+        entry = {"sender": message.local_interface.code, "message": bytes(message.data)}
+        with self._cv:
+            if len(self.relayed) == self.relayed.maxlen:
+                self._stats["relay_dropped"] += 1
+            self._stats["relay_received"] += 1
+            self.relayed.append(entry)
+
+
+_adapter = None  # The XBeeAdapter that the module-level functions use.
+
+
+def attach(device, **kwargs) -> XBeeAdapter:
+    """ attach routes this module's functions to the given opened xbee-python device. """
+    global _adapter
+    detach()
+    _adapter = XBeeAdapter(device, **kwargs)
+    return _adapter
+
+
+def detach() -> None:
+    global _adapter
+    if _adapter is not None:
+        _adapter.close()
+        _adapter = None
+
+
+def transmit(dest, payload, source_ep=DEFAULT_ENDPOINT, dest_ep=DEFAULT_ENDPOINT, cluster=DEFAULT_CLUSTER,
+             profile=DEFAULT_PROFILE, bcast_radius=0, tx_options=0):
+    _adapter.transmit(dest, payload, source_ep, dest_ep, cluster, profile, bcast_radius, tx_options)
+
+
+def receive() -> Optional[dict]:
+    return _adapter.receive()
+
+
+def atcmd(cmd, value=None):
+    return _adapter.atcmd(cmd, value)
+
+
+class _Relay:
+
+    SERIAL = 0
+    BLUETOOTH = 1
+    MICROPYTHON = 2
+
+    def send(self, dest: int, data) -> None:
+        _adapter.relay_send(dest, data)
+
+    def receive(self) -> Optional[dict]:
+        return _adapter.relay_receive()
+
+
+relay = _Relay()
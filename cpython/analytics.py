@@ -0,0 +1,119 @@
+"""
+analytics.py contains host-only, vectorized versions of the sequence number and ButtonBuffer logic in
+upython/core.py, for analyzing captured traffic (millions of packets) with NumPy instead of per-packet Python calls.
+
+Every function here gives exactly the same answers as its scalar counterpart in upython/core.py:
+- sequence_more_recent() / sequence_equal_or_more_recent() elementwise, including the wraparound edge cases.
+- unwrap() turns a stream of 16-bit sequence numbers into ever-increasing int64 values, treating each step as
+  forward or backward exactly as sequence_more_recent() would. Loss and gap figures are then plain arithmetic.
+- button_history() expands serialized ButtonBuffers (one per row) so that column d holds ButtonBuffer.get(d).
+
+Example usage:
+    seqs = np.frombuffer(capture, dtype=">u2")
+    print(loss_stats(seqs))
+"""
+
+from typing import Tuple
+
+import numpy as np
+
+from xbf.upython.core import MAX_SEQUENCE_NUMBER
+
+
+def sequence_more_recent(s1, s2, max_sequence_number: int = MAX_SEQUENCE_NUMBER) -> np.ndarray:
+    """ sequence_more_recent is the elementwise (broadcasting) version of core.sequence_more_recent. """
+    s1 = np.asarray(s1, dtype=np.int64)
+    s2 = np.asarray(s2, dtype=np.int64)
+    half = max_sequence_number // 2
+    return ((s1 > s2) & (s1 - s2 <= half)) | ((s2 > s1) & (s2 - s1 > half))
+
+
+def sequence_equal_or_more_recent(s1, s2, max_sequence_number: int = MAX_SEQUENCE_NUMBER) -> np.ndarray:
+    """ sequence_equal_or_more_recent is the elementwise version of core.sequence_equal_or_more_recent. """
+    return (np.asarray(s1) == np.asarray(s2)) | sequence_more_recent(s1, s2, max_sequence_number)
+
+
+def unwrap(seqs, max_sequence_number: int = MAX_SEQUENCE_NUMBER) -> np.ndarray:
+    """
+    unwrap returns the sequence numbers (in arrival order) as int64 values that no longer wrap around.
+    Each step from one packet to the next counts as forward if sequence_more_recent(next, previous) and as
+    backward otherwise, so unwrap(seqs)[i] % (max_sequence_number + 1) == seqs[i] always holds.
+    """
+    seqs = np.asarray(seqs, dtype=np.int64)
+    if seqs.size == 0:
+        return seqs
+    modulus = max_sequence_number + 1
+    previous, current = seqs[:-1], seqs[1:]
+    forward = (current - previous) % modulus
+    steps = np.where(sequence_more_recent(current, previous, max_sequence_number) | (forward == 0),
+                     forward, forward - modulus)
+    result = np.empty_like(seqs)
+    result[0] = seqs[0]
+    np.cumsum(steps, out=result[1:])
+    result[1:] += seqs[0]
+    return result
+
+
+def gaps(seqs, max_sequence_number: int = MAX_SEQUENCE_NUMBER) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    gaps returns the missing runs of one sender's stream as two arrays: the first missing sequence number of
+    each run (wrapped, as sent) and the run's length. Frames that arrive late (out of order) don't count.
+    """
+    received = np.unique(unwrap(seqs, max_sequence_number))
+    if received.size < 2:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    steps = np.diff(received)
+    missing = steps > 1
+    return (received[:-1][missing] + 1) % (max_sequence_number + 1), steps[missing] - 1
+
+
+def loss_stats(seqs, max_sequence_number: int = MAX_SEQUENCE_NUMBER) -> dict:
+    """
+    loss_stats summarizes one sender's stream: packets received, duplicates, lost (never arrived between the
+    first and last sequence numbers seen), late (arrived after a newer packet), gaps (missing runs) and loss_rate.
+    For a stream without stale packets, these match SequenceWindow's counters in upython/core.py.
+    """
+    unwrapped = unwrap(seqs, max_sequence_number)
+    if unwrapped.size == 0:
+        return {"received": 0, "duplicates": 0, "lost": 0, "late": 0, "gaps": 0, "loss_rate": 0.0}
+    unique, first_index = np.unique(unwrapped, return_index=True)
+    expected = int(unique[-1] - unique[0] + 1)
+    lost = expected - unique.size
+    highest_before = np.maximum.accumulate(unwrapped)[:-1]
+    # A packet is late if something newer arrived before it. Duplicates of such packets are counted only once.
+    late_mask = np.zeros(unwrapped.size, dtype=bool)
+    late_mask[1:] = unwrapped[1:] < highest_before
+    late = int(np.count_nonzero(late_mask[first_index]))
+    return {"received": int(unique.size), "duplicates": int(unwrapped.size - unique.size), "lost": lost,
+            "late": late, "gaps": int(np.count_nonzero(np.diff(unique) > 1)),
+            "loss_rate": lost / expected}
+
+
+def per_sender_loss_stats(senders, seqs, max_sequence_number: int = MAX_SEQUENCE_NUMBER) -> dict:
+    """ per_sender_loss_stats splits a capture by sender (any hashable array values) and runs loss_stats on each. """
+    senders = np.asarray(senders)
+    seqs = np.asarray(seqs)
+    keys, inverse = np.unique(senders, return_inverse=True)
+    order = np.argsort(inverse, kind="stable")  # Groups each sender's packets, keeping their arrival order.
+    bounds = np.searchsorted(inverse[order], np.arange(keys.size + 1))
+    return {keys[i].item(): loss_stats(seqs[order[bounds[i]:bounds[i + 1]]], max_sequence_number)
+            for i in range(keys.size)}
+
+
+def button_history(serialized, bits: int = 32) -> np.ndarray:
+    """
+    button_history expands serialized ButtonBuffers into a (num_buffers, bits) array of 0/1 values, where
+    column d is ButtonBuffer.get(d): column 0 is the current frame, column 1 the previous frame, and so on.
+    serialized may be a (num_buffers, bits // 8) uint8 array or the concatenation of the serialized buffers.
+    """
+    data = np.frombuffer(serialized, dtype=np.uint8) if isinstance(serialized, (bytes, bytearray)) else \
+        np.asarray(serialized, dtype=np.uint8)
+    data = data.reshape(-1, bits // 8)
+    # Serialized buffers are Big Endian, so reverse the bytes and take each byte's bits LSB first.
+    return np.unpackbits(data[:, ::-1], axis=1, bitorder="little")
+
+
+def button_history_from_ints(values, bits: int = 32) -> np.ndarray:
+    """ button_history_from_ints is like button_history but takes ButtonBuffer.get_uint32() values (up to 64 bits). """
+    values = np.asarray(values, dtype=np.uint64)
+    return ((values[:, None] >> np.arange(bits, dtype=np.uint64)) & np.uint64(1)).astype(np.uint8)
@@ -0,0 +1,131 @@
+"""
+bootprofile.py decodes the boot timeline that upython/bootprof.py sends out the User Data Relay and prints it, so that
+startup latency (and heap use) can be compared from one build to the next.
+
+Example usage: python bootprofile.py --port /dev/ttyUSB0 --baud 115200     (then reset the XBee's MicroPython app)
+
+    phase            start_ms   took_ms   mem_free   mem_delta
+    delete_py           0.000    12.345      30112        -256
+    ...
+
+Caution: Ensure that these definitions match the redundant definitions in upython/bootprof.py.
+"""
+
+import argparse
+import queue
+import struct
+import sys
+from typing import List, Optional, Tuple
+
+from digi.xbee.devices import XBeeDevice
+
+from xbf.cpython.core import Error, Success, OpenXBeeDevice, log, new_error
+
+PACKET_TYPE_BOOT_PROFILE = 0x13
+_HEADER = ">BIBBB"
+_RECORD = ">II"
+
+
+class BootProfile:
+    """ BootProfile is one boot's timeline: checkpoints of (name, microseconds since start, mem_free). """
+
+    def __init__(self, start_ms: int, total: int, dropped: int):
+        self.start_ms = start_ms  # The device's ticks_ms when profiling started, i.e., roughly time since reset.
+        self.dropped = dropped
+        self.checkpoints: List[Optional[Tuple[str, int, int]]] = [None] * total
+
+    def complete(self) -> bool:
+        return all(c is not None for c in self.checkpoints)
+
+    def format(self) -> str:
+        """ format returns the timeline as a table: when each phase started, how long it took and the heap after. """
+        lines = ["boot profile (profiling started %d ms after reset)" % self.start_ms,
+                 "%-16s %10s %10s %10s %10s" % ("phase", "start_ms", "took_ms", "mem_free", "mem_delta")]
+        previous_us, previous_free = 0, None
+        for name, elapsed_us, mem_free in self.checkpoints:
+            delta = "" if previous_free is None else "%+d" % (mem_free - previous_free)
+            lines.append("%-16s %10.3f %10.3f %10d %10s" % (name, previous_us / 1000.0,
+                                                            (elapsed_us - previous_us) / 1000.0, mem_free, delta))
+            previous_us, previous_free = elapsed_us, mem_free
+        lines.append("%-16s %10s %10.3f" % ("total", "", previous_us / 1000.0))
+        if self.dropped:
+            lines.append("(%d more checkpoints didn't fit and were dropped)" % self.dropped)
+        return "\n".join(lines)
+
+
+class BootProfileAssembler:
+    """ BootProfileAssembler collects the frames of a timeline, which may arrive split across several frames. """
+
+    def __init__(self):
+        self.profile: Optional[BootProfile] = None
+
+    def handle(self, data: bytes) -> Tuple[Optional[BootProfile], Optional[Error]]:
+        """ handle takes one relay frame and returns the profile once all of its checkpoints have arrived. """
+        if len(data) < struct.calcsize(_HEADER) or data[0] != PACKET_TYPE_BOOT_PROFILE:
+            return None, new_error("not a boot profile frame")
+        _, start_ms, index, total, dropped = struct.unpack_from(_HEADER, data)
+        profile = self.profile
+        if profile is None or profile.start_ms != start_ms or len(profile.checkpoints) != total:
+            profile = self.profile = BootProfile(start_ms, total, dropped)  # A new boot.
+        offset = struct.calcsize(_HEADER)
+        while offset < len(data):
+            if index >= total or offset + struct.calcsize(_RECORD) + 1 > len(data):
+                return None, new_error("malformed boot profile frame")
+            elapsed_us, mem_free = struct.unpack_from(_RECORD, data, offset)
+            offset += struct.calcsize(_RECORD)
+            name_length = data[offset]
+            name = bytes(data[offset + 1:offset + 1 + name_length]).decode(errors="replace")
+            offset += 1 + name_length
+            profile.checkpoints[index] = (name, elapsed_us, mem_free)
+            index += 1
+        if not profile.complete():
+            return None, Success
+        self.profile = None
+        return profile, Success
+
+
+def parse_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="bootprofile.py prints the boot timeline of the local XBee's app.")
+    parser.add_argument("--port", required=True, type=str,
+                        help="Serial port name (e.g., /dev/ttyUSB0).")
+    parser.add_argument("--baud", required=True, type=int,
+                        help="Serial port baud rate (e.g., 115200).")
+    parser.add_argument("--timeout", required=False, type=float, default=None,
+                        help="Seconds to wait for a timeline. Waits forever (printing every boot) by default.")
+    return parser.parse_args()
+
+
+def main() -> Error:
+    args = parse_arguments()
+    frames = queue.Queue()
+    assembler = BootProfileAssembler()
+
+    # broker=False because the broker doesn't forward User Data Relay frames.
+    with OpenXBeeDevice(xbee=XBeeDevice(port=args.port, baud_rate=args.baud), broker=False) as xbee:
+        callback = lambda message: frames.put(bytes(message.data))
+        xbee.add_user_data_relay_received_callback(callback)
+        try:
+            while True:
+                try:
+                    data = frames.get(timeout=args.timeout)
+                except queue.Empty:
+                    log("Error: No boot profile received within %s seconds." % args.timeout)
+                    return Error()
+                if not data or data[0] != PACKET_TYPE_BOOT_PROFILE:
+                    continue  # Log messages, etc.
+                profile, err = assembler.handle(data)
+                if err:
+                    log("Error: Failed to decode boot profile. Details: %s" % err)
+                elif profile is not None:
+                    log(profile.format())
+                    if args.timeout is not None:
+                        return Success
+        except KeyboardInterrupt:
+            return Success
+        finally:
+            xbee.del_user_data_relay_received_callback(callback)
+
+
+if __name__ == "__main__":
+    exit_status = main()
+    sys.exit(0 if exit_status is Success else 1)
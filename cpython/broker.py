@@ -0,0 +1,589 @@
+"""
+broker.py contains a local daemon that owns the XBee serial port and multiplexes it between several client processes.
+
+Only one process at a time can open the serial port, so without the broker our monitoring, deployment and gateway
+tools cannot run concurrently. Reopening the port also costs us xbee-python's device-info discovery every time.
+The broker opens the XBee once and exposes it on a Unix domain socket. OpenXBeeDevice (see core.py) notices the
+broker's socket and hands out a BrokerClient instead of opening the serial port itself.
+
+Example usage: python broker.py --port /dev/ttyUSB0 --baud 115200
+
+Wire protocol: every message (in either direction) is a 4-byte Big Endian length followed by a UTF-8 JSON object.
+Binary fields (addresses, payloads, AT register values) are hex strings. Each request carries an "id" that the
+broker echoes in its reply. A failed request gets a reply of the form {"id": n, "error": "details"}.
+
+    {"id": 1, "op": "send", "dest": "0013a20041000001", "data": "6869"}   ->  {"id": 1}   (dest null = broadcast)
+    {"id": 2, "op": "frame", "data": "7e000408014150..."}                 ->  {"id": 2}   (raw API frame)
+    {"id": 3, "op": "at", "cmd": "PS"}                                    ->  {"id": 3, "value": "01"}
+    {"id": 4, "op": "at", "cmd": "PS", "value": "00", "apply": true}      ->  {"id": 4, "value": "00"}
+    {"id": 5, "op": "info"}                                               ->  {"id": 5, "addr64": ..., ...}
+    {"id": 6, "op": "subscribe"}                                          ->  {"id": 6}
+    {"id": 7, "op": "unsubscribe"}                                        ->  {"id": 7}
+    {"id": 8, "op": "stats"}                                              ->  {"id": 8, "stats": {...}}
+
+Subscribed clients also receive unsolicited events: {"event": "rx", "sender": "...", "data": "...", "broadcast": false}
+
+Fairness: each client has its own bounded request queue and its own bounded outgoing event queue. The broker
+services requests round-robin, one request per client per pass, so a chatty client cannot starve the others. A client
+whose request queue is full stops being read until the broker catches up (backpressure). A subscriber that falls
+behind loses its oldest rx events rather than growing the broker's memory without bound; the losses are counted in
+"stats". Replies are queued separately and never dropped, since the client is waiting for each one.
+
+Caution: the filesystem operations used by make.py --deploy (LocalXBeeFileSystemManager) and the raw AT command mode
+helpers (ensure_api_mode, restore_mode) need the serial port itself, so stop the broker before deploying.
+"""
+
+import argparse
+import collections
+import json
+import os
+import selectors
+import socket
+import struct
+import sys
+import tempfile
+import threading
+from typing import Optional
+
+from digi.xbee.devices import RemoteXBeeDevice, XBeeDevice
+from digi.xbee.models.address import XBee64BitAddress
+from digi.xbee.models.message import XBeeMessage
+from digi.xbee.models.protocol import XBeeProtocol
+from digi.xbee.packets.factory import build_frame
+
+from xbf.cpython.core import Error, Success, OpenXBeeDevice, log, logc, func
+
+HEADER = struct.Struct(">I")
+MAX_MESSAGE_SIZE = 64 * 1024  # Generous; the largest XBee API frame is a few hundred bytes.
+MAX_PENDING_REQUESTS = 16  # Per client. Beyond this, the broker stops reading from the client.
+MAX_PENDING_EVENTS = 1024  # Per client. Beyond this, the oldest rx events get dropped.
+
+
+def broker_socket_path(port: str) -> str:
+    """ broker_socket_path returns the default Unix socket path for the broker that owns the given serial port. """
+    name = os.path.basename(port or "xbee").replace(":", "")
+    return os.path.join(tempfile.gettempdir(), "xbf-broker-%s.sock" % name)
+
+
+def broker_is_listening(socket_path: str) -> bool:
+    """ broker_is_listening returns whether a live broker accepts connections on socket_path (not a stale file). """
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(socket_path)
+        return True
+    except OSError:
+        return False
+    finally:
+        probe.close()
+
+
+def encode_message(msg: dict) -> bytes:
+    """ encode_message serializes a protocol message into its length-prefixed wire format. """
+    body = json.dumps(msg, separators=(",", ":")).encode("utf-8")
+    return HEADER.pack(len(body)) + body
+
+
+class MessageReader:
+    """ MessageReader reassembles length-prefixed protocol messages from a byte stream. """
+
+    def __init__(self):
+        self._buf = bytearray()
+
+    def feed(self, data: bytes) -> None:
+        self._buf += data
+
+    def next_message(self) -> Optional[dict]:
+        """ next_message returns the next complete message, or None if more bytes are needed. """
+        if len(self._buf) < HEADER.size:
+            return None
+        (length,) = HEADER.unpack_from(self._buf)
+        if length > MAX_MESSAGE_SIZE:
+            raise ValueError("Message length %d exceeds maximum of %d bytes" % (length, MAX_MESSAGE_SIZE))
+        end = HEADER.size + length
+        if len(self._buf) < end:
+            return None
+        body = bytes(self._buf[HEADER.size:end])
+        del self._buf[:end]
+        return json.loads(body.decode("utf-8"))
+
+
+class _Client:
+    """ _Client holds the broker's per-connection state. """
+
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+        self.reader = MessageReader()
+        self.requests = collections.deque()
+        self.outgoing = collections.deque()  # Encoded replies. Never dropped: a client waits for each one.
+        self.outgoing_events = collections.deque()  # Encoded rx events, at most MAX_PENDING_EVENTS.
+        self.out_buf = b""
+        self.subscribed = False
+        self.dropped_events = 0
+        self.served = 0
+        self.events = selectors.EVENT_READ  # Currently registered selector events; 0 means unregistered.
+        self.lock = threading.Lock()  # Guards the outgoing queues; the xbee-python reader thread posts rx events.
+
+
+class Broker:
+    """
+    Broker owns an opened XBeeDevice and serves it to clients over a Unix domain socket.
+    See the module comments above for the protocol.
+    """
+
+    def __init__(self, xbee: XBeeDevice, socket_path: str):
+        self.xbee = xbee
+        self.socket_path = socket_path
+        self.clients = []
+        self.info = {}
+        self._selector = selectors.DefaultSelector()
+        self._server = None
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._stop = False
+        self._rr = 0  # Round-robin starting position.
+
+    def serve_forever(self) -> Error:
+        """ serve_forever accepts and services clients until stop() is called. Assumes the xbee is open. """
+
+        err = self._listen()
+        if err:
+            return err
+
+        subscribed = False
+        try:
+            self.info = self._discover()
+            self.xbee.add_data_received_callback(self._on_data_received)
+            subscribed = True
+            while not self._stop:
+                pending = any(c.requests for c in self.clients)
+                for key, events in self._selector.select(timeout=0 if pending else None):
+                    if key.data == "server":
+                        self._accept()
+                    elif key.data == "wake":
+                        self._wake_r.recv(4096)
+                    else:
+                        if events & selectors.EVENT_READ:
+                            self._read(key.data)
+                        if events & selectors.EVENT_WRITE and key.data in self.clients:
+                            self._write(key.data)
+                self._service_one_round()
+                self._update_interest()
+        finally:
+            if subscribed:
+                self.xbee.del_data_received_callback(self._on_data_received)
+            for client in list(self.clients):
+                self._disconnect(client)
+            self._selector.close()
+            self._server.close()
+            self._wake_r.close()
+            self._wake_w.close()
+            os.unlink(self.socket_path)
+            logc("Broker stopped.")
+
+        return Success
+
+    def stop(self) -> None:
+        """ stop asks serve_forever to return. Safe to call from any thread. """
+        self._stop = True
+        self._wake_w.send(b"\x00")
+
+    def _listen(self) -> Error:
+        if os.path.exists(self.socket_path):
+            # Clean up after a broker that died without unlinking its socket, but never hijack a live one.
+            if broker_is_listening(self.socket_path):
+                return Error("%s: Another broker is already listening on %s" % (func(), self.socket_path))
+            os.unlink(self.socket_path)
+
+        self._server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        bound = False
+        try:
+            self._server.bind(self.socket_path)
+            bound = True
+            self._server.listen(16)
+            self._server.setblocking(False)
+        except OSError as ex:
+            self._server.close()
+            if bound:
+                os.unlink(self.socket_path)
+            return Error("%s: Unable to listen on %s. Details: %s" % (func(), self.socket_path, ex))
+
+        self._selector.register(self._server, selectors.EVENT_READ, "server")
+        self._selector.register(self._wake_r, selectors.EVENT_READ, "wake")
+        logc("Broker listening on %s" % self.socket_path)
+        return Success
+
+    def _discover(self) -> dict:
+        """ _discover caches the device info once so that clients never pay for the discovery themselves. """
+        addr64 = self.xbee.get_64bit_addr()
+        protocol = self.xbee.get_protocol()
+        return {
+            "addr64": bytes(addr64.address).hex() if addr64 is not None else None,
+            "protocol": protocol.code if protocol is not None else None,
+            "node_id": self.xbee.get_node_id(),
+        }
+
+    def _accept(self) -> None:
+        sock, _ = self._server.accept()
+        sock.setblocking(False)
+        client = _Client(sock)
+        self.clients.append(client)
+        self._selector.register(sock, selectors.EVENT_READ, client)
+        logc("Client connected. %d client(s) total." % len(self.clients))
+
+    def _disconnect(self, client: _Client) -> None:
+        if client not in self.clients:
+            return
+        self.clients.remove(client)
+        if client.events:
+            self._selector.unregister(client.sock)
+        client.sock.close()
+        logc("Client disconnected. %d client(s) remain." % len(self.clients))
+
+    def _read(self, client: _Client) -> None:
+        try:
+            data = client.sock.recv(65536)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b""
+        if not data:
+            self._disconnect(client)
+            return
+        client.reader.feed(data)
+        try:
+            while True:
+                msg = client.reader.next_message()
+                if msg is None:
+                    break
+                client.requests.append(msg)
+        except ValueError as ex:
+            logc("Dropping client that sent a malformed message. Details: %s" % ex)
+            self._disconnect(client)
+
+    def _write(self, client: _Client) -> None:
+        with client.lock:
+            if not client.out_buf:
+                client.out_buf = b"".join(client.outgoing) + b"".join(client.outgoing_events)
+                client.outgoing.clear()
+                client.outgoing_events.clear()
+        try:
+            sent = client.sock.send(client.out_buf)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            self._disconnect(client)
+            return
+        client.out_buf = client.out_buf[sent:]
+
+    def _post(self, client: _Client, msg: dict, is_event: bool = False) -> None:
+        with client.lock:
+            if not is_event:
+                client.outgoing.append(encode_message(msg))
+                return
+            if len(client.outgoing_events) >= MAX_PENDING_EVENTS:
+                client.outgoing_events.popleft()
+                client.dropped_events += 1
+            client.outgoing_events.append(encode_message(msg))
+
+    def _service_one_round(self) -> None:
+        """ _service_one_round executes at most one queued request from each client, rotating the start point. """
+        if not self.clients:
+            return
+        n = len(self.clients)
+        self._rr = (self._rr + 1) % n
+        for client in self.clients[self._rr:] + self.clients[:self._rr]:
+            if client.requests:
+                request = client.requests.popleft()
+                self._post(client, self._execute(client, request))
+                client.served += 1
+
+    def _update_interest(self) -> None:
+        for client in self.clients:
+            events = 0
+            if len(client.requests) < MAX_PENDING_REQUESTS:
+                events |= selectors.EVENT_READ
+            if client.out_buf or client.outgoing or client.outgoing_events:
+                events |= selectors.EVENT_WRITE
+            if events == client.events:
+                continue
+            if client.events == 0:
+                self._selector.register(client.sock, events, client)
+            elif events == 0:
+                self._selector.unregister(client.sock)
+            else:
+                self._selector.modify(client.sock, events, client)
+            client.events = events
+
+    def _execute(self, client: _Client, request: dict) -> dict:
+        reply = {"id": request.get("id")}
+        op = request.get("op")
+        try:
+            if op == "send":
+                dest = request.get("dest")
+                addr = XBee64BitAddress.BROADCAST_ADDRESS if dest is None else \
+                    XBee64BitAddress(bytearray.fromhex(dest))
+                remote = RemoteXBeeDevice(self.xbee, x64bit_addr=addr)
+                self.xbee.send_data_async(remote, bytearray.fromhex(request["data"]))
+            elif op == "frame":
+                self.xbee.send_packet(build_frame(bytearray.fromhex(request["data"])))
+            elif op == "at":
+                cmd = request["cmd"]
+                value = request.get("value")
+                if value is None:
+                    result = self.xbee.get_parameter(cmd)
+                else:
+                    self.xbee.set_parameter(cmd, bytearray.fromhex(value))
+                    if request.get("apply"):
+                        self.xbee.apply_changes()
+                    result = bytearray.fromhex(value)
+                reply["value"] = bytes(result).hex() if result is not None else None
+            elif op == "execute":
+                self.xbee.execute_command(request["cmd"])
+            elif op == "write":
+                self.xbee.write_changes()
+            elif op == "info":
+                reply.update(self.info)
+            elif op == "subscribe":
+                client.subscribed = True
+            elif op == "unsubscribe":
+                client.subscribed = False
+            elif op == "stats":
+                reply["stats"] = {
+                    "clients": len(self.clients),
+                    "served": client.served,
+                    "dropped_events": client.dropped_events,
+                    "queued_requests": len(client.requests),
+                }
+            else:
+                reply["error"] = "Unknown op %r" % op
+        except Exception as ex:
+            reply["error"] = "%s failed. Details: %s" % (op, ex)
+        return reply
+
+    def _on_data_received(self, msg: XBeeMessage) -> None:
+        """ _on_data_received runs on xbee-python's reader thread; fan the message out to all subscribers. """
+        event = {
+            "event": "rx",
+            "sender": bytes(msg.remote_device.get_64bit_addr().address).hex(),
+            "data": bytes(msg.data).hex(),
+            "broadcast": bool(msg.is_broadcast),
+        }
+        for client in list(self.clients):
+            if client.subscribed:
+                self._post(client, event, is_event=True)
+        self._wake_w.send(b"\x00")
+
+
+class _BrokerRemoteDevice:
+    """ _BrokerRemoteDevice provides the part of RemoteXBeeDevice that receive callbacks rely upon. """
+
+    def __init__(self, addr64: XBee64BitAddress):
+        self._addr64 = addr64
+
+    def get_64bit_addr(self) -> XBee64BitAddress:
+        return self._addr64
+
+
+class _BrokerMessage:
+    """ _BrokerMessage mirrors digi.xbee.models.message.XBeeMessage for messages relayed by the broker. """
+
+    def __init__(self, data: bytearray, remote_device: _BrokerRemoteDevice, is_broadcast: bool):
+        self.data = data
+        self.remote_device = remote_device
+        self.is_broadcast = is_broadcast
+
+
+class BrokerClient:
+    """
+    BrokerClient talks to a Broker and offers the subset of the digi.xbee.devices.XBeeDevice interface that
+    this framework uses, so that code written against an opened XBeeDevice works unchanged through the broker.
+    """
+
+    def __init__(self, socket_path: str, timeout_sec: float = 10.0):
+        self.socket_path = socket_path
+        self._timeout_sec = timeout_sec
+        self._sock = None
+        self._reader_thread = None
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self._send_lock = threading.Lock()  # Keeps concurrent requests' messages from interleaving on the socket.
+        self._replies = {}
+        self._reply_ready = threading.Condition(self._lock)
+        self._callbacks = []
+        self._info = None
+
+    def open(self) -> None:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.socket_path)
+        except OSError:
+            sock.close()
+            raise
+        self._sock = sock
+        self._reader_thread = threading.Thread(target=self._reader_loop, name="BrokerClient", daemon=True)
+        self._reader_thread.start()
+
+    def close(self) -> None:
+        if self._sock is None:
+            return
+        try:
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._sock.close()
+        self._sock = None
+        self._reader_thread.join()
+
+    def is_open(self) -> bool:
+        return self._sock is not None
+
+    def get_sync_ops_timeout(self) -> float:
+        return self._timeout_sec
+
+    def set_sync_ops_timeout(self, timeout_sec: float) -> None:
+        self._timeout_sec = timeout_sec
+
+    def request(self, op: str, **kwargs) -> dict:
+        """ request sends a request to the broker and waits for the matching reply. Raises on error replies. """
+        with self._lock:
+            self._next_id += 1
+            request_id = self._next_id
+        msg = dict(kwargs, id=request_id, op=op)
+        with self._send_lock:
+            self._sock.sendall(encode_message(msg))
+        with self._reply_ready:
+            if not self._reply_ready.wait_for(lambda: request_id in self._replies or self._sock is None,
+                                              timeout=self._timeout_sec):
+                raise TimeoutError("Broker did not reply to %s within %s seconds" % (op, self._timeout_sec))
+            reply = self._replies.pop(request_id, None)
+        if reply is None:
+            raise ConnectionError("Broker connection closed")
+        if "error" in reply:
+            raise IOError(reply["error"])
+        return reply
+
+    def send_data_64(self, x64addr: XBee64BitAddress, data) -> None:
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        self.request("send", dest=bytes(x64addr.address).hex(), data=bytes(data).hex())
+
+    def send_data_broadcast(self, data) -> None:
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        self.request("send", dest=None, data=bytes(data).hex())
+
+    def send_frame(self, frame: bytes) -> None:
+        """ send_frame passes a complete raw API frame (start delimiter through checksum) to the XBee. """
+        self.request("frame", data=bytes(frame).hex())
+
+    def get_parameter(self, parameter: str) -> bytearray:
+        reply = self.request("at", cmd=parameter)
+        return bytearray.fromhex(reply["value"]) if reply.get("value") is not None else None
+
+    def set_parameter(self, parameter: str, value: bytes, apply: bool = False) -> None:
+        self.request("at", cmd=parameter, value=bytes(value).hex(), apply=apply)
+
+    def execute_command(self, parameter: str) -> None:
+        self.request("execute", cmd=parameter)
+
+    def apply_changes(self) -> None:
+        self.request("execute", cmd="AC")
+
+    def write_changes(self) -> None:
+        self.request("write")
+
+    def get_64bit_addr(self) -> XBee64BitAddress:
+        addr = self._get_info()["addr64"]
+        return XBee64BitAddress(bytearray.fromhex(addr)) if addr else None
+
+    def get_protocol(self) -> XBeeProtocol:
+        code = self._get_info()["protocol"]
+        return XBeeProtocol.get(code) if code is not None else None
+
+    def get_node_id(self) -> str:
+        return self._get_info()["node_id"]
+
+    def get_stats(self) -> dict:
+        return self.request("stats")["stats"]
+
+    def add_data_received_callback(self, callback) -> None:
+        first = len(self._callbacks) == 0
+        self._callbacks.append(callback)
+        if first:
+            self.request("subscribe")
+
+    def del_data_received_callback(self, callback) -> None:
+        if callback in self._callbacks:
+            self._callbacks.remove(callback)
+            if len(self._callbacks) == 0 and self.is_open():
+                self.request("unsubscribe")
+
+    def _get_info(self) -> dict:
+        if self._info is None:
+            self._info = self.request("info")
+        return self._info
+
+    def _reader_loop(self) -> None:
+        reader = MessageReader()
+        sock = self._sock
+        while True:
+            try:
+                data = sock.recv(65536)
+            except OSError:
+                data = b""
+            if not data:
+                break
+            reader.feed(data)
+            while True:
+                msg = reader.next_message()
+                if msg is None:
+                    break
+                if msg.get("event") == "rx":
+                    self._dispatch(msg)
+                else:
+                    with self._reply_ready:
+                        self._replies[msg.get("id")] = msg
+                        self._reply_ready.notify_all()
+        with self._reply_ready:
+            self._reply_ready.notify_all()
+
+    def _dispatch(self, event: dict) -> None:
+        sender = _BrokerRemoteDevice(XBee64BitAddress(bytearray.fromhex(event["sender"])))
+        msg = _BrokerMessage(bytearray.fromhex(event["data"]), sender, event.get("broadcast", False))
+        for callback in list(self._callbacks):
+            try:
+                callback(msg)
+            except Exception as ex:
+                log("BrokerClient: Receive callback raised an exception. Details: %s" % ex)
+
+
+def parse_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="broker.py shares one local XBee among several processes.")
+    parser.add_argument("--port", required=True, type=str,
+                        help="Serial port name (e.g., /dev/ttyUSB0).")
+    parser.add_argument("--baud", required=True, type=int,
+                        help="Serial port baud rate (e.g., 115200).")
+    parser.add_argument("--socket", required=False, type=str, default=None,
+                        help="Unix socket path. Defaults to a per-port path in the temp directory.")
+    return parser.parse_args()
+
+
+def main() -> Error:
+    args = parse_arguments()
+    socket_path = args.socket or broker_socket_path(args.port)
+
+    # broker=False makes OpenXBeeDevice open the serial port rather than looking for a broker (i.e., ourselves).
+    with OpenXBeeDevice(xbee=XBeeDevice(port=args.port, baud_rate=args.baud), broker=False) as xbee:
+        broker = Broker(xbee, socket_path)
+        try:
+            err = broker.serve_forever()
+        except KeyboardInterrupt:
+            err = Success
+    if err:
+        log("Error: Broker failed. Details: %s" % err)
+        return Error()
+    return Success
+
+
+if __name__ == "__main__":
+    exit_status = main()
+    sys.exit(0 if exit_status is Success else 1)
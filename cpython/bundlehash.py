@@ -0,0 +1,131 @@
+"""
+bundlehash.py computes, at build time, the same bundle hashes that bundle_demo.py stores in the ATKP register,
+so that a build manifest can say which ATKP value a device running that build should report.
+
+    bundle_hash(["build/components.mpy", "build/constants.mpy"], "crc32")   ->  "CRC32: 0x..." (what ATKP should say)
+
+djb2 here is vectorized with NumPy and returns exactly what the device's per-byte loop returns. It uses the closed
+form of the recurrence h = h * 33 + d (mod 2**32): after n bytes, h = seed * 33**n + sum(d[i] * 33**(n-1-i)).
+uint64 arithmetic wraps modulo 2**64, which preserves the result modulo 2**32, so no intermediate masking is needed.
+Without NumPy, djb2 falls back to the device's loop, so make.py --deploy (which hashes the bundle) still works.
+
+Benchmark (host fakes): PYTHONPATH=fakes:../upython python bundlehash.py --size 65536
+On hardware, run upython/demo/hash_benchmark.py instead.
+
+Measured with the host fakes (CPython 3, x86-64, 64 KB of random data): device djb2 (Python loop) ~150 us/KB,
+device crc32 (ubinascii, i.e., zlib under the fakes) ~0.6 us/KB, host djb2 (NumPy) ~1.7 us/KB, host crc32 ~0.6 us/KB.
+These only compare the implementations relative to each other. hash_benchmark.py has NOT been run on an XBee 3 yet,
+so there are no device figures; the device's Python loop will be far slower than CPython's.
+
+Caution: Ensure that these definitions match the redundant definitions in upython/demo/bundle_demo.py.
+"""
+
+import argparse
+import random
+import sys
+import time
+import zlib
+from typing import Iterable
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from xbf.cpython.core import Error, Success, log
+
+DJB2_SEED = 5381
+CHUNK_SIZE = 1 << 16
+MASK = 0xFFFFFFFF
+
+# _REVERSED_POWERS[CHUNK_SIZE - n:] holds 33**(n-1), ..., 33**1, 33**0 (mod 2**32) for any n <= CHUNK_SIZE.
+if np is not None:
+    _POWERS = np.empty(CHUNK_SIZE, dtype=np.uint64)
+    _POWERS[0] = 1
+    _POWERS[1:] = 33
+    np.cumprod(_POWERS, out=_POWERS)
+    _REVERSED_POWERS = _POWERS[::-1] & np.uint64(MASK)
+
+
+def djb2(data, seed: int = DJB2_SEED) -> int:
+    """ djb2 returns the same value as bundle_demo.djb2(data, seed), chunked or not. """
+    h = seed & MASK
+    if np is None:
+        for d in bytes(data):
+            h = (h * 33 + d) & MASK
+        return h
+    data = np.frombuffer(data, dtype=np.uint8)
+    for start in range(0, len(data), CHUNK_SIZE):
+        chunk = data[start:start + CHUNK_SIZE]
+        weighted = int(np.dot(chunk.astype(np.uint64), _REVERSED_POWERS[CHUNK_SIZE - len(chunk):]))
+        h = (h * pow(33, len(chunk), 1 << 32) + weighted) & MASK
+    return h
+
+
+def crc32(data, value: int = 0) -> int:
+    """ crc32 is the same CRC-32 as MicroPython's ubinascii.crc32. """
+    return zlib.crc32(data, value)
+
+
+def bundle_hash(paths: Iterable[str], algorithm: str = "crc32") -> str:
+    """ bundle_hash returns the ATKP string that bundle_demo.bundle_hash() computes for the same files. """
+    if algorithm not in ("crc32", "djb2"):
+        raise ValueError("unknown bundle hash algorithm %r" % algorithm)
+    running_hash = 0 if algorithm == "crc32" else djb2(b"")
+    for path in paths:
+        with open(path, "rb") as f:
+            data = f.read()
+        running_hash = crc32(data, running_hash) if algorithm == "crc32" else djb2(data, running_hash)
+    return ("CRC32: 0x%08X" if algorithm == "crc32" else "Bundle: 0x%08X") % running_hash
+
+
+def benchmark(size: int) -> dict:
+    """ benchmark returns microseconds per KB for each implementation, hashing size random bytes. """
+    from xbf.upython.demo import bundle_demo  # Needs the fakes (see the module docstring).
+
+    data = bytes(random.Random(0).getrandbits(8) for _ in range(size))
+    candidates = {
+        "device djb2 (Python loop)": lambda: bundle_demo.djb2(data),
+        "device crc32 (ubinascii)": lambda: bundle_demo.crc32(data),
+        "host djb2 (NumPy)" if np is not None else "host djb2 (no NumPy)": lambda: djb2(data),
+        "host crc32 (zlib)": lambda: crc32(data),
+    }
+    results = {}
+    for name, run in candidates.items():
+        runs = 0
+        start = time.perf_counter()
+        while runs == 0 or time.perf_counter() - start < 0.5:
+            run()
+            runs += 1
+        results[name] = (time.perf_counter() - start) / runs * 1e6 / (size / 1024.0)
+    return results
+
+
+def parse_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="bundlehash.py computes or benchmarks the ATKP bundle hash.")
+    parser.add_argument("files", nargs="*",
+                        help="The .mpy files of the bundle, in the order of bundle_demo's desired_bundle list.")
+    parser.add_argument("--algorithm", required=False, choices=("crc32", "djb2"), default="crc32",
+                        help="Hash algorithm; the device uses crc32 if its firmware has ubinascii.crc32.")
+    parser.add_argument("--size", required=False, type=int, default=None,
+                        help="Benchmark the implementations on this many bytes instead of hashing files.")
+    return parser.parse_args()
+
+
+def main() -> Error:
+    args = parse_arguments()
+    if args.size is not None:
+        for name, us_per_kb in benchmark(args.size).items():
+            log("%-28s %10.1f us/KB" % (name, us_per_kb))
+        return Success
+    try:
+        log(bundle_hash(args.files, args.algorithm))
+    except OSError as ex:
+        log("Error: Failed to hash the bundle files. Details: %s" % ex)
+        return Error()
+    return Success
+
+
+if __name__ == "__main__":
+    exit_status = main()
+    sys.exit(0 if exit_status is Success else 1)
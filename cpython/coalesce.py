@@ -0,0 +1,39 @@
+"""
+coalesce.py splits the frames that upython/coalesce.py's CoalescingQueue packs several messages into.
+
+Example usage, with the xbee adapter:
+    msg = adapter.receive()
+    if msg is not None and is_batch(msg["payload"]):
+        messages, err = split_frame(msg["payload"])
+"""
+
+from typing import List, Optional, Tuple
+
+from xbf.cpython.core import Error, Success, new_error
+
+# Caution: Ensure that these definitions match the redundant definitions in upython/coalesce.py.
+PACKET_TYPE_BATCH = 0x12
+
+
+def is_batch(payload: bytes) -> bool:
+    return len(payload) >= 1 and payload[0] == PACKET_TYPE_BATCH
+
+
+def split_frame(payload: bytes) -> Tuple[List[bytes], Optional[Error]]:
+    """
+    split_frame returns the messages packed into a batch frame. If the frame is malformed (e.g., truncated),
+    it returns the messages before the problem along with an error.
+    """
+    if not is_batch(payload):
+        return [], new_error("not a batch frame")
+    messages = []
+    view = memoryview(payload)
+    offset = 1
+    while offset < len(payload):
+        end = offset + 1 + payload[offset]
+        if end > len(payload):
+            return messages, new_error("message at offset %d needs %d bytes but only %d remain" %
+                                       (offset, payload[offset], len(payload) - offset - 1))
+        messages.append(bytes(view[offset + 1:end]))
+        offset = end
+    return messages, Success
@@ -1,3 +1,4 @@
+import ast
 import glob
 import hashlib
 import logging
@@ -19,7 +20,10 @@ import mpy_cross
 import serial
 
 API_MODE_WITHOUT_ESCAPES = 0x01
+RESTORE_MODE_ATTEMPTS = 3  # restore_mode resends its ATAP command this many times if the device is restarting.
 MAIN_PY = "/flash/main.py"
+# Caution: Ensure that BOOT_STATE_PATH matches BOOT_STATE_FILE in upython/demo/bundle_demo.py.
+BOOT_STATE_PATH = "/flash/boot_state.txt"
 
 Error = str
 Success = None
@@ -109,19 +113,50 @@ class OpenXBeeDevice:
     """
     OpenXBeeDevice is a context manager for digi.xbee.devices.XBeeDevice (and its subclasses).
     This class ensures that the serial port gets properly closed even if an error occurs.
+
+    If a broker (see broker.py) already owns the serial port, this connects to the broker instead and returns
+    a BrokerClient, which offers the same subset of the XBeeDevice interface that this framework relies upon.
+    The broker argument is the broker's socket path; None means "use the default path for this serial port if a
+    broker is listening there", and False means "always open the serial port directly".
     """
 
-    def __init__(self, xbee):
+    def __init__(self, xbee, broker=None):
         self.xbee = xbee
+        self.broker = broker
+        self.client = None
         self.log = print
 
     def __enter__(self):
-        self.log("Opening XBee 3 device...")
+        from xbf.cpython.broker import BrokerClient, broker_socket_path
+
+        port = getattr(self.xbee.serial_port, "port", None)
+        socket_path = self.broker
+        if socket_path is None:
+            socket_path = broker_socket_path(port)
+        if socket_path and os.path.exists(socket_path):
+            self.log("Connecting to XBee broker at %s..." % socket_path)
+            client = BrokerClient(socket_path)
+            try:
+                client.open()
+            except (ConnectionRefusedError, FileNotFoundError) as ex:
+                # A socket file left behind by a broker that crashed (or one that just exited).
+                self.log("No XBee broker is listening at %s; opening the serial port instead. Details: %s"
+                         % (socket_path, ex))
+            else:
+                self.client = client
+                self.log("Connected to XBee broker.")
+                return self.client
+
+        self.log("Opening XBee 3 device on %s..." % port)
         self.xbee.open()
         self.log("Opened XBee 3 device.")
         return self.xbee
 
     def __exit__(self, exc_type, exc_value, traceback):
+        if self.client is not None:
+            self.client.close()
+            self.log("Disconnected from XBee broker.")
+            return
         if self.xbee is not None and self.xbee.is_open():
             self.xbee.close()
         self.log("Closed XBee 3 device.")
@@ -243,6 +278,107 @@ def build_mpy(src_dirs: List[str], build_dir: str) -> Error:
                 return err
 
 
+def _parse_sources(src_dirs: List[str]) -> Tuple[dict, Optional[Error]]:
+    """ _parse_sources returns {module name: (source path, ast)} for the .py files that build_mpy() compiles. """
+    modules = {}
+    for src_dir in src_dirs:
+        for py_file_path in glob.glob("%s/*.py" % src_dir):
+            try:
+                with open(py_file_path, "r") as f:
+                    tree = ast.parse(f.read(), filename=py_file_path)
+            except (OSError, SyntaxError) as ex:
+                return {}, Error("%s: Unable to parse %s. Details: %s" % (func(), py_file_path, ex))
+            modules[os.path.basename(py_file_path)[:-len(".py")]] = (py_file_path, tree)
+    return modules, Success
+
+
+def _find_bundle(modules: dict) -> List[str]:
+    """
+    _find_bundle returns the module names that the sources bundle (the desired_bundle list, or the list passed to
+    rebundle_if_necessary()), in order, since the order determines the bundle hash. Returns [] if there's none.
+    """
+    for path, tree in modules.values():
+        for node in ast.walk(tree):
+            elements = None
+            if isinstance(node, ast.Call):
+                name = node.func.attr if isinstance(node.func, ast.Attribute) else getattr(node.func, "id", None)
+                if name == "rebundle_if_necessary" and len(node.args) > 1 and isinstance(node.args[1], ast.List):
+                    elements = node.args[1].elts
+            elif isinstance(node, ast.Assign) and isinstance(node.value, ast.List) and \
+                    any(isinstance(t, ast.Name) and t.id == "desired_bundle" for t in node.targets):
+                elements = node.value.elts
+            if elements is not None:
+                return [e.value for e in elements if isinstance(e, ast.Constant)]
+    return []
+
+
+def check_lazy_modules(src_dirs: List[str], build_dir: str) -> Error:
+    """
+    check_lazy_modules checks the modules that the sources load with lazy.LazyModule("name") (see upython/lazy.py).
+    Since a lazy module isn't imported until the app first uses it, mistakes would otherwise show up only then,
+    possibly long after boot. Each lazy module must be one of the sources and must have been built into build_dir.
+    Modules that are also imported eagerly somewhere are logged, since making them lazy then saves nothing.
+
+    Whether a bundled lazy module is still valid depends on the device, not the build: see expected_bundle_hashes(),
+    which the deploy uses to check the device's bundle.
+    """
+    modules, err = _parse_sources(src_dirs)
+    if err:
+        return err
+
+    lazy = {}  # Module name -> path of a source that loads it lazily.
+    eager = {}  # Module name -> path of a source that imports it.
+    for path, tree in modules.values():
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Call):
+                name = node.func.attr if isinstance(node.func, ast.Attribute) else getattr(node.func, "id", None)
+                if name == "LazyModule" and node.args and isinstance(node.args[0], ast.Constant):
+                    lazy.setdefault(node.args[0].value, path)
+            elif isinstance(node, ast.Import):
+                for alias in node.names:
+                    eager.setdefault(alias.name, path)
+            elif isinstance(node, ast.ImportFrom) and node.module:
+                eager.setdefault(node.module, path)
+
+    problems = []
+    for name, user in sorted(lazy.items()):
+        if name not in modules:
+            problems.append("%s loads unknown module %s lazily" % (user, name))
+            continue
+        mpy_file_path = os.path.join(build_dir, "%s.mpy" % name)
+        if not os.path.isfile(mpy_file_path):
+            problems.append("lazy module %s was not built (%s is missing)" % (name, mpy_file_path))
+        if name in eager:
+            log("%s: Warning: %s imports lazy module %s eagerly, so loading it lazily saves nothing." % (
+                func(), eager[name], name))
+
+    if problems:
+        return Error("%s: %s" % (func(), "; ".join(problems)))
+    log("%s: Checked %d lazy module(s): %s" % (func(), len(lazy), ", ".join(sorted(lazy)) or "none"))
+    return Success
+
+
+def expected_bundle_hashes(src_dirs: List[str], build_dir: str) -> Tuple[List[str], Optional[Error]]:
+    """
+    expected_bundle_hashes returns the ATKP values that a device whose bundle holds the .mpy files in build_dir
+    reports (one per hash algorithm, since that depends on the firmware; see bundlehash.py), or [] if the sources
+    don't bundle anything. A device reporting anything else runs stale bundled code, e.g., an old lazy module.
+    """
+    from xbf.cpython import bundlehash
+
+    modules, err = _parse_sources(src_dirs)
+    if err:
+        return [], err
+    bundle = _find_bundle(modules)
+    if not bundle:
+        return [], Success
+    paths = [os.path.join(build_dir, "%s.mpy" % name) for name in bundle]
+    try:
+        return [bundlehash.bundle_hash(paths, algorithm) for algorithm in ("crc32", "djb2")], Success
+    except OSError as ex:
+        return [], Error("%s: Unable to hash the bundle. Details: %s" % (func(), ex))
+
+
 def shutdown_cleanly(xbee: XBeeDevice) -> Error:
     """
     Helper function to attempt to cleanly shut down the XBee.
@@ -600,26 +736,97 @@ def restore_mode(port: str, baud_rate: int, original_mode: int) -> Error:
 
         logc("Restoring previous operating mode.")
 
-        restore_mode
-
         command = b"AP"
         params = bytes([original_mode])
         tx = api_frame_at_command(command, params)
 
-        logc("TX: %s" % tx)
-        ser.write(tx)
+        # The deploy ends with an ATFR, so the device may still be restarting (and deaf) when we get here, and once
+        # it's back it announces itself with a Modem Status frame. So skip unrelated frames, and resend on silence.
+        # A response alone doesn't prove that the setting survived the restart, so read it back before succeeding.
+        for attempt in range(RESTORE_MODE_ATTEMPTS):
+            logc("TX: %s" % tx)
+            ser.write(tx)
+
+            while True:
+                rx, err = read_api_frame(ser)
+                if err:
+                    logc("No response (attempt %d of %d). Details: %s" % (attempt + 1, RESTORE_MODE_ATTEMPTS, err))
+                    break
+                logc("RX: %s" % rx)
+                if rx[:4] != b"\x88\x01" + command:
+                    continue  # E.g., the Modem Status (0x8A) frame that the device sends after restarting.
+                if rx[4:5] != b"\x00":
+                    return new_error("Failed to restore previous operating mode. AT command status: %s" % rx[4:5])
+                break
+            if err:
+                continue
 
-        expected = b"\x7E\x00\x05\x88\x01\x41\x50\x00\xE5"
-        rx = ser.read(len(expected))
-        logc("RX: %s" % rx)
-        if rx != expected:
-            return new_error("Failed to restore previous operating mode. Did not get the expected response.")
+            current_mode, err = read_atap_in_command_mode(ser)
+            if err:
+                return errorf("Failed to read back the operating mode: %s", err)
+            if current_mode == original_mode:
+                logc("Successfully restored previous operating mode.")
+                return Success
+            logc("ATAP reads back as %d, not %d (attempt %d of %d); the device may have restarted since." % (
+                current_mode, original_mode, attempt + 1, RESTORE_MODE_ATTEMPTS))
 
-        logc("Successfully restored previous operating mode.")
-        return Success
+        return new_error("Failed to restore previous operating mode. Did not get the expected response.")
 
 
-def ensure_running_latest_micropython_app(build_dir: str, xbee: XBeeDevice) -> Error:
+def read_atap_in_command_mode(ser: serial.Serial) -> Tuple[int, Optional[Error]]:
+    """
+    read_atap_in_command_mode reads the ATAP setting via raw AT command mode, which works in every operating mode
+    (unlike API frames, which the device ignores once it has left API mode), and then exits command mode again.
+    Assumes that `ser` has been set up with a suitable read timeout.
+    """
+
+    time.sleep(1.0)  # +++ also requires 1 second of silence before it, and we may have just sent something.
+    err = enter_raw_AT_command_mode(ser)
+    if err:
+        return 0, err
+
+    current_mode, err = get_atap(ser)
+    if err:
+        return 0, err
+
+    err = exit_raw_AT_command_mode(ser)
+    if err:
+        return 0, err
+
+    return current_mode, Success
+
+
+def read_api_frame(ser: serial.Serial) -> Tuple[bytes, Optional[Error]]:
+    """
+    read_api_frame reads one API frame (API Mode Without Escapes) and returns its frame data, i.e., without the
+    start delimiter, length and checksum. Skips any bytes before the start delimiter.
+    Assumes that `ser` has been set up with a suitable read timeout.
+    """
+
+    while True:
+        start = ser.read(1)
+        if len(start) != 1:
+            return b"", new_error("Timed out waiting for an API frame.")
+        if start == b"\x7E":
+            break
+
+    header = ser.read(2)
+    if len(header) != 2:
+        return b"", new_error("Timed out reading the API frame length.")
+    length = struct.unpack(">H", header)[0]
+
+    body = ser.read(length + 1)
+    if len(body) != length + 1:
+        return b"", new_error("Timed out reading the API frame data.")
+    frame, checksum = body[:-1], body[-1:]
+    if api_frame_checksum(frame) != checksum:
+        return b"", new_error("API frame has a bad checksum.")
+
+    return frame, Success
+
+
+def ensure_running_latest_micropython_app(build_dir: str, xbee: XBeeDevice,
+                                          bundle_hashes: Optional[List[str]] = None) -> Error:
     """
     Deploys the compiled .mpy files to the target. Also ensures that no main.py file exists on the device.
 
@@ -636,6 +843,10 @@ def ensure_running_latest_micropython_app(build_dir: str, xbee: XBeeDevice) -> E
     must compile the .py file every time, 2) more complexity because you need to train main.py
     as a special case, 3) you don't the compile-time checking advantages of cross-compiling main.py
     unless you compile it too. Short answer: Use main.mpy on the device.
+
+    bundle_hashes (see expected_bundle_hashes()) are the ATKP values that mean the device's bundle matches the
+    build. If ATKP says otherwise, the device is running stale bundled code even if its files are up to date, so
+    the interpreter is restarted to make it rebundle.
     """
 
     # TODO Make this function also remote any extraneous .mpy file from the device!
@@ -645,6 +856,7 @@ def ensure_running_latest_micropython_app(build_dir: str, xbee: XBeeDevice) -> E
     updated_files = False  # Indicates if file(s) were updated so that MicroPython interpreter can be restarted.
     main_py_was_deleted = False  # Indicates if main.py was removed so that MicroPython interpreter can be restarted.
     updated_atps = False  # Indicates if the ATPS setting (automatically launch MicroPython code at startup) is set.
+    stale_bundle = False  # Indicates if the bundle (ATKP) doesn't match the build, so the device must rebundle.
 
     with OpenFileSystem(xbee) as fs:
 
@@ -676,6 +888,15 @@ def ensure_running_latest_micropython_app(build_dir: str, xbee: XBeeDevice) -> E
 
         log("mpy_files:\n%s" % "\n".join(["%s" % f for f in mpy_files]))
 
+        # Files can change without changing size, so make the next boot run the full bootstrap checks.
+        if updated_files:
+            try:
+                fs.remove_element(BOOT_STATE_PATH)
+                log("Deleted %s to invalidate the device's boot state." % BOOT_STATE_PATH)
+            except FileSystemException as ex:
+                if "ENOENT" not in repr(ex):
+                    return Error("ERROR: Failed to delete %s. Details: %s" % (BOOT_STATE_PATH, ex))
+
         # Ensure that main.py does not exist on the device.
         try:
             fs.remove_element(MAIN_PY)
@@ -700,12 +921,26 @@ def ensure_running_latest_micropython_app(build_dir: str, xbee: XBeeDevice) -> E
             return Error("ERROR: Failed to change AT%s setting" % param)
     log("Confirmed that AT%s is set correctly." % param)
 
+    # Ensure that the bundle matches the build. (The app rebundles at startup when it doesn't.)
+    if bundle_hashes:
+        try:
+            actual = bytes(xbee.get_parameter("KP")).decode("ascii", "replace")
+        except Exception as ex:
+            actual = ""  # xbee-python raises if the register is empty, i.e., the device has never bundled.
+            log("Unable to read ATKP. Details: %s" % ex)
+        if actual not in bundle_hashes:
+            log("The bundle is stale: ATKP is '%s' but the build's bundle hash is '%s'." % (actual, bundle_hashes[0]))
+            stale_bundle = True
+        else:
+            log("Confirmed that the bundle matches the build (ATKP is '%s')." % actual)
+
     # Determine if the MicroPython interpreter needs to be restarted.
-    if updated_files or main_py_was_deleted or updated_atps:
-        log("Need need to restart the MicroPython interpreter because %s%s%s" % (
+    if updated_files or main_py_was_deleted or updated_atps or stale_bundle:
+        log("Need need to restart the MicroPython interpreter because %s%s%s%s" % (
             "one or more MicroPython files changed." if updated_files else "",
             "an old main.py was deleted." if main_py_was_deleted else "",
-            "ATPS was not previously set." if updated_atps else ""))
+            "ATPS was not previously set." if updated_atps else "",
+            "the bundle is stale." if stale_bundle else ""))
         err = restart_micropython_interpreter(xbee)
         if err:
             return Error("Error: Failed to restart MicroPython interpreter. Details: %s" % err)
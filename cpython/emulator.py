@@ -0,0 +1,653 @@
+"""
+emulator.py contains a local XBee 3 emulator that speaks the XBee serial protocol on a Linux pseudo-terminal.
+
+Point make.py, ensure_api_mode()/restore_mode() or any xbee-python code at the emulator's pty (e.g., /dev/pts/7)
+to benchmark and regression-test them without a physical radio:
+
+    python emulator.py --ap 4 &
+    python make.py --build --deploy --port /dev/pts/7 --baud 115200
+
+What the emulator handles:
+- Transparent/REPL modes with "+++" guard-time detection, and AT command mode (ATAP, ATCN, ATWR, ATAC, ATRE, ATFR,
+  and reading/writing any register in the register table).
+- API Mode Without Escapes (ATAP1) and With Escapes (ATAP2): AT Command (0x08/0x09 -> 0x88), Transmit Request
+  (0x10 -> 0x8B), TX64 Request (0x00 -> 0x89), and User Data Relay (0x2D). Received data and relay messages can be
+  injected towards the host as Receive Packet (0x90) and User Data Relay Output (0xAD) frames.
+- The ATFS commands that LocalXBeeFileSystemManager uses (PWD, CD, MD, LS, PUT via YMODEM, MV, RM, HASH, INFO,
+  FORMAT) against an in-memory filesystem. GET is not implemented, so it is not advertised in the ATFS command list.
+- ATFR restarts: the device goes deaf for Timing.restart_ms and comes back with only the written (ATWR) settings,
+  just like the hardware. Unwritten changes, including a temporary ATAP change, are lost.
+
+All delays are configurable through the Timing class, so the same scenario can run at hardware speed for
+benchmarks or with near-zero delays for regression tests in CI.
+"""
+
+import argparse
+import collections
+import hashlib
+import heapq
+import os
+import select
+import struct
+import sys
+import threading
+import time
+import tty
+from typing import Callable, Optional
+
+from xbf.cpython.core import Error, Success, api_frame_checksum, log
+
+API_START = 0x7E
+API_ESCAPE = 0x7D
+API_ESCAPED_BYTES = (0x7E, 0x7D, 0x11, 0x13)
+
+AT_STATUS_OK = 0x00
+AT_STATUS_ERROR = 0x01
+AT_STATUS_INVALID_COMMAND = 0x02
+AT_STATUS_INVALID_PARAMETER = 0x03
+
+XMODEM_SOH = 0x01
+XMODEM_STX = 0x02
+XMODEM_EOT = 0x04
+XMODEM_ACK = 0x06
+XMODEM_NAK = 0x15
+XMODEM_CAN = 0x18
+XMODEM_CRC = b"C"
+
+FS_COMMANDS = ("PWD", "CD", "MD", "LS", "PUT", "MV", "RM", "HASH", "INFO", "FORMAT")
+FS_CAPACITY = 1024 * 1024
+FS_ROOT_DIRS = ("/", "/flash", "/flash/lib", "/flash/cert")
+FS_ERRORS = {"ENOENT": "no such file or directory", "EEXIST": "file exists", "EINVAL": "invalid argument"}
+
+# Register defaults for an XBee 3 TH running 802.15.4 firmware, which is what make.py opens (Raw802Device).
+# xbee-python derives the protocol from HV/VR; VR must stay <= 0x20FF for LocalXBeeFileSystemManager support.
+DEFAULT_REGISTERS = {
+    "HV": b"\x42\x47",
+    "VR": b"\x20\x0E",
+    "SH": b"\x00\x13\xA2\x00",
+    "SL": b"\x41\x00\x00\x01",
+    "MY": b"\x00\x00",
+    "DH": b"\x00\x00\x00\x00",
+    "DL": b"\x00\x00\x00\x00",
+    "ID": b"\x33\x32",
+    "CH": b"\x0C",
+    "CE": b"\x00",
+    "SM": b"\x00",
+    "BD": b"\x07",
+    "AP": b"\x00",
+    "PS": b"\x00",
+    "GT": b"\x03\xE8",
+    "CT": b"\x00\x64",
+    "NI": b" ",
+    "KP": b"",
+}
+STRING_REGISTERS = ("NI", "KP")
+
+
+class Timing:
+    """
+    Timing holds the emulator's configurable delays, in milliseconds unless noted.
+    - guard_time_ms: silence required before and after "+++" (the device's ATGT).
+    - command_timeout_ms: idle time after which AT command mode exits by itself (the device's ATCT).
+    - at_response_ms: processing time before answering an AT command (in either AT command mode or API mode).
+      Keep this above zero when driving the emulator with xbee-python: its synchronous requests start waiting only
+      after sending, so they miss answers that arrive sooner (a real XBee takes a few milliseconds anyway).
+    - fs_op_ms: processing time before answering an ATFS command.
+    - restart_ms: how long the device ignores the serial port after ATFR.
+    - ymodem_poll_ms: interval at which the device repeats "C" while waiting for a YMODEM transfer to start.
+    - baud: if set, output is paced at this many bits per second (10 bits per byte), like a real UART.
+    """
+
+    def __init__(self, guard_time_ms: int = 1000, command_timeout_ms: int = 10000, at_response_ms: int = 2,
+                 fs_op_ms: int = 0, restart_ms: int = 500, ymodem_poll_ms: int = 1000, baud: Optional[int] = None):
+        self.guard_time_ms = guard_time_ms
+        self.command_timeout_ms = command_timeout_ms
+        self.at_response_ms = at_response_ms
+        self.fs_op_ms = fs_op_ms
+        self.restart_ms = restart_ms
+        self.ymodem_poll_ms = ymodem_poll_ms
+        self.baud = baud
+
+
+def crc16_ccitt(data: bytes) -> int:
+    """ crc16_ccitt returns the CRC-16/XMODEM of the given data. """
+    crc = 0
+    for byte in data:
+        crc ^= byte << 8
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x1021) if crc & 0x8000 else (crc << 1)
+            crc &= 0xFFFF
+    return crc
+
+
+def api_frame(frame_data: bytes, escaped: bool = False) -> bytes:
+    """ api_frame wraps the given frame data in a start delimiter, length and checksum, escaping if requested. """
+    body = struct.pack(">H", len(frame_data)) + frame_data + api_frame_checksum(frame_data)
+    if escaped:
+        out = bytearray()
+        for byte in body:
+            if byte in API_ESCAPED_BYTES:
+                out += bytes([API_ESCAPE, byte ^ 0x20])
+            else:
+                out.append(byte)
+        body = bytes(out)
+    return bytes([API_START]) + body
+
+
+def _fs_error(code: str) -> bytes:
+    """ _fs_error formats an ATFS error answer the way the XBee does: the errno name, then a description. """
+    return b"%s %s\r" % (code.encode("ascii"), FS_ERRORS[code].encode("ascii"))
+
+
+class _YModemReceiver:
+    """ _YModemReceiver collects a file sent with YMODEM/CRC (as xbee-python's put_file sends it). """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.buf = bytearray()
+        self.data = bytearray()
+        self.size = None
+        self.expected_seq = 0
+        self.got_eot = False
+        self.done = False
+        self.started = False
+
+
+class XBeeEmulator:
+    """
+    XBeeEmulator emulates one XBee 3 behind a pseudo-terminal. Call start() and open self.port like a serial port.
+    Hooks on_transmit(dest64, payload) and on_relay(dest_interface, data) observe what the host sends; by default
+    these are recorded in the transmitted and relayed deques.
+    """
+
+    def __init__(self, timing: Optional[Timing] = None, registers: Optional[dict] = None,
+                 files: Optional[dict] = None):
+        self.timing = timing if timing is not None else Timing()
+        self.persisted = dict(DEFAULT_REGISTERS)
+        self.persisted.update(registers or {})
+        self.registers = dict(self.persisted)
+        self.files = dict(files or {})  # Absolute path -> bytes.
+        self.dirs = set(FS_ROOT_DIRS)
+        self.cwd = "/flash"
+        self.transmitted = collections.deque()
+        self.relayed = collections.deque()
+        self.on_transmit: Callable[[bytes, bytes], None] = lambda dest, payload: self.transmitted.append(
+            (dest, payload))
+        self.on_relay: Callable[[int, bytes], None] = lambda dest, data: self.relayed.append((dest, data))
+        self.restarts = 0
+        self.frames_handled = 0
+        self.port = None
+
+        self._master = None
+        self._slave = None
+        self._thread = None
+        self._stop = False
+        self._write_lock = threading.Lock()
+        self._timers = []  # (deadline, sequence, callback)
+        self._timer_seq = 0
+        self._last_rx = float("-inf")
+        self._plus_count = 0
+        self._held = bytearray()  # "+" characters held back while we wait to see if this is an escape sequence.
+        self._command_mode = False
+        self._command_line = bytearray()
+        self._command_deadline = None
+        self._offline_until = 0.0
+        self._api_buf = bytearray()
+        self._api_escape_next = False
+        self._ymodem = None
+
+    # ---- Lifecycle ----
+
+    def start(self) -> str:
+        """ start creates the pseudo-terminal and the emulator thread. Returns the pty path to open. """
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._slave)  # No echo and no line discipline, like a real UART.
+        self.port = os.ttyname(self._slave)
+        self._thread = threading.Thread(target=self._run, name="XBeeEmulator", daemon=True)
+        self._thread.start()
+        return self.port
+
+    def stop(self) -> None:
+        self._stop = True
+        if self._thread is not None:
+            self._thread.join()
+        os.close(self._master)
+        os.close(self._slave)
+
+    @property
+    def api_mode(self) -> int:
+        return self.registers["AP"][-1]
+
+    # ---- Host-facing injection (thread safe) ----
+
+    def inject_receive(self, source64: bytes, payload: bytes) -> None:
+        """ inject_receive sends a Receive Packet (0x90) to the host, as if payload had arrived over the air. """
+        self._send_frame(bytes([0x90]) + bytes(source64) + b"\xFF\xFE\x01" + bytes(payload))
+
+    def inject_relay(self, source_interface: int, data: bytes) -> None:
+        """ inject_relay sends a User Data Relay Output (0xAD) frame to the host. """
+        self._send_frame(bytes([0xAD, source_interface]) + bytes(data))
+
+    # ---- Main loop ----
+
+    def _run(self) -> None:
+        while not self._stop:
+            now = time.monotonic()
+            self._run_due_timers(now)
+            if self._command_mode and self._command_deadline is not None and now >= self._command_deadline:
+                self._command_mode = False
+            timeout = 0.05
+            if self._timers:
+                timeout = max(0.0, min(timeout, self._timers[0][0] - now))
+            readable, _, _ = select.select([self._master], [], [], timeout)
+            if not readable:
+                continue
+            try:
+                data = os.read(self._master, 4096)
+            except OSError:
+                continue  # No process has the pty open right now.
+            now = time.monotonic()
+            self._run_due_timers(now)  # E.g., a restart that has just finished must restore the registers first.
+            for byte in data:
+                if now < self._offline_until:
+                    break  # Restarting (maybe by an ATFR earlier in data); bytes sent to a rebooting XBee are lost.
+                self._on_byte(byte, now)
+            self._last_rx = now
+
+    def _run_due_timers(self, now: float) -> None:
+        while self._timers and self._timers[0][0] <= now:
+            _, _, callback = heapq.heappop(self._timers)
+            callback()
+
+    def _schedule(self, delay_ms: float, callback) -> None:
+        self._timer_seq += 1
+        heapq.heappush(self._timers, (time.monotonic() + delay_ms / 1000.0, self._timer_seq, callback))
+
+    def _write(self, data: bytes) -> None:
+        with self._write_lock:
+            if self.timing.baud:
+                time.sleep(len(data) * 10.0 / self.timing.baud)
+            view = memoryview(data)
+            while view:
+                written = os.write(self._master, view)
+                view = view[written:]
+
+    def _delay(self, ms: int) -> None:
+        if ms > 0:
+            time.sleep(ms / 1000.0)
+
+    # ---- Byte dispatch, including "+++" escape detection ----
+
+    def _on_byte(self, byte: int, now: float) -> None:
+        if self._ymodem is not None:
+            self._on_ymodem_byte(byte)
+            return
+        if self._command_mode:
+            self._on_command_byte(byte)
+            return
+
+        guard_sec = self.timing.guard_time_ms / 1000.0
+        if byte == ord("+") and self._plus_count < 3 and \
+                (self._plus_count > 0 or now - self._last_rx >= guard_sec):
+            self._plus_count += 1
+            self._held.append(byte)
+            if self._plus_count == 3:
+                self._schedule(self.timing.guard_time_ms, self._check_escape_sequence)
+            return
+        if self._held:
+            held, self._held, self._plus_count = bytes(self._held), bytearray(), 0
+            for b in held:
+                self._on_data_byte(b)
+        self._on_data_byte(byte)
+
+    def _check_escape_sequence(self) -> None:
+        silence = time.monotonic() - self._last_rx
+        if self._plus_count == 3 and silence >= self.timing.guard_time_ms / 1000.0 - 0.001:
+            self._plus_count = 0
+            self._held = bytearray()
+            self._enter_command_mode()
+
+    def _on_data_byte(self, byte: int) -> None:
+        if self.api_mode in (1, 2):
+            self._on_api_byte(byte)
+        # Transparent and REPL mode data has nowhere to go in the emulator; it is discarded.
+
+    # ---- AT command mode ----
+
+    def _enter_command_mode(self) -> None:
+        self._command_mode = True
+        self._command_line = bytearray()
+        self._touch_command_mode()
+        self._write(b"OK\r")
+
+    def _touch_command_mode(self) -> None:
+        self._command_deadline = time.monotonic() + self.timing.command_timeout_ms / 1000.0
+
+    def _on_command_byte(self, byte: int) -> None:
+        if byte != ord("\r"):
+            self._command_line.append(byte)
+            return
+        line = self._command_line.decode("ascii", "replace").strip()
+        self._command_line = bytearray()
+        self._touch_command_mode()
+        if not line.upper().startswith("AT"):
+            self._write(b"ERROR\r")
+            return
+        command = line[2:4].upper()
+        params = line[4:].strip()
+
+        if command == "FS":
+            self._delay(self.timing.fs_op_ms)
+            self._write(self._filesystem_command(params))
+            return
+
+        self._delay(self.timing.at_response_ms)
+        if command == "":
+            self._write(b"OK\r")
+        elif command == "CN":
+            self._write(b"OK\r")
+            self._command_mode = False
+        elif command in ("WR", "AC", "RE", "FR"):
+            self._execute(command)
+            self._write(b"OK\r")
+            if command == "FR":
+                self._restart()
+        elif command not in self.registers:
+            self._write(b"ERROR\r")
+        elif params == "":
+            self._write(self._format_register(command) + b"\r")
+        else:
+            value = self._parse_register(command, params)
+            if value is None:
+                self._write(b"ERROR\r")
+            else:
+                self.registers[command] = value
+                self._write(b"OK\r")
+
+    def _format_register(self, name: str) -> bytes:
+        value = self.registers[name]
+        if name in STRING_REGISTERS:
+            return value
+        return b"%X" % int.from_bytes(value, "big") if value else b""
+
+    def _parse_register(self, name: str, params: str) -> Optional[bytes]:
+        if name in STRING_REGISTERS:
+            return params.encode("ascii", "replace")
+        try:
+            number = int(params, 16)
+        except ValueError:
+            return None
+        width = max(len(self.registers[name]), (number.bit_length() + 7) // 8, 1)
+        return number.to_bytes(width, "big")
+
+    def _execute(self, command: str) -> None:
+        """ _execute handles the AT commands that act rather than read or write a register. """
+        if command == "WR":
+            self.persisted = dict(self.registers)
+        elif command == "RE":
+            self.registers = dict(DEFAULT_REGISTERS)
+
+    def _restart(self) -> None:
+        """ _restart emulates ATFR: a period of deafness, then only the persisted settings survive. """
+        self.restarts += 1
+        self._offline_until = float("inf")  # Until come_back() has run, so no command can reach the old registers.
+        self._command_mode = False
+        self._api_buf = bytearray()
+        self._api_escape_next = False
+        self._plus_count = 0
+        self._held = bytearray()
+
+        def come_back():
+            self.registers = dict(self.persisted)
+            self._offline_until = 0.0
+            if self.api_mode in (1, 2):
+                self._send_frame(b"\x8A\x00")  # Modem Status: hardware reset.
+        self._schedule(self.timing.restart_ms, come_back)
+
+    # ---- API mode ----
+
+    def _on_api_byte(self, byte: int) -> None:
+        # Without escaping (ATAP1), 0x7E may appear inside a frame as data; only the length field delimits frames.
+        if byte == API_START and (self.api_mode == 2 or not self._api_buf):
+            self._api_buf = bytearray([API_START])
+            self._api_escape_next = False
+            return
+        if not self._api_buf:
+            return  # Not inside a frame; ignore noise.
+        if self.api_mode == 2:
+            if self._api_escape_next:
+                byte ^= 0x20
+                self._api_escape_next = False
+            elif byte == API_ESCAPE:
+                self._api_escape_next = True
+                return
+        self._api_buf.append(byte)
+        if len(self._api_buf) < 3:
+            return
+        length = (self._api_buf[1] << 8) | self._api_buf[2]
+        if len(self._api_buf) < 3 + length + 1:
+            return
+        frame_data = bytes(self._api_buf[3:3 + length])
+        checksum = self._api_buf[3 + length]
+        self._api_buf = bytearray()
+        if api_frame_checksum(frame_data)[0] != checksum:
+            return  # The XBee silently discards frames with bad checksums.
+        self.frames_handled += 1
+        self._on_api_frame(frame_data)
+
+    def _send_frame(self, frame_data: bytes) -> None:
+        self._write(api_frame(frame_data, escaped=self.api_mode == 2))
+
+    def _on_api_frame(self, frame: bytes) -> None:
+        frame_type = frame[0]
+        if frame_type in (0x08, 0x09) and len(frame) >= 4:  # AT Command / Queue Parameter Value.
+            self._on_api_at_command(frame[1], frame[2:4].decode("ascii", "replace").upper(), frame[4:])
+        elif frame_type == 0x10 and len(frame) >= 14:  # Transmit Request.
+            frame_id, dest64, payload = frame[1], frame[2:10], frame[14:]
+            self.on_transmit(dest64, payload)
+            if frame_id:
+                self._send_frame(bytes([0x8B, frame_id, 0xFF, 0xFE, 0x00, 0x00, 0x00]))
+        elif frame_type == 0x00 and len(frame) >= 11:  # TX Request: 64-bit address.
+            frame_id, dest64, payload = frame[1], frame[2:10], frame[11:]
+            self.on_transmit(dest64, payload)
+            if frame_id:
+                self._send_frame(bytes([0x89, frame_id, 0x00]))
+        elif frame_type == 0x2D and len(frame) >= 3:  # User Data Relay.
+            self.on_relay(frame[2], frame[3:])
+
+    def _on_api_at_command(self, frame_id: int, command: str, param: bytes) -> None:
+        self._delay(self.timing.at_response_ms)
+        status = AT_STATUS_OK
+        value = b""
+        restart = False
+        new_registers = None
+        if command in ("WR", "AC", "RE", "FR"):
+            self._execute(command)
+            restart = command == "FR"
+        elif command not in self.registers:
+            status = AT_STATUS_INVALID_COMMAND
+        elif param:
+            new_registers = dict(self.registers)
+            new_registers[command] = bytes(param)
+        else:
+            value = self.registers[command]
+
+        if frame_id:
+            self._send_frame(bytes([0x88, frame_id]) + command.encode("ascii") + bytes([status]) + value)
+        if new_registers is not None:
+            self.registers = new_registers  # Applied after responding, so an ATAP change answers in the old mode.
+        if restart:
+            self._restart()
+
+    # ---- File system (ATFS) ----
+
+    def _abspath(self, path: str) -> str:
+        if not path.startswith("/"):
+            path = self.cwd.rstrip("/") + "/" + path
+        parts = []
+        for part in path.split("/"):
+            if part in ("", "."):
+                continue
+            if part == "..":
+                if parts:
+                    parts.pop()
+                continue
+            parts.append(part)
+        return "/" + "/".join(parts)
+
+    def _filesystem_command(self, params: str) -> bytes:
+        if params == "":
+            return b"ATFS commands: %s\r" % " ".join(FS_COMMANDS).encode("ascii")
+        words = params.split(" ", 1)
+        name = words[0].upper()
+        arg = words[1].strip() if len(words) > 1 else ""
+
+        if name == "PWD":
+            return self.cwd.encode() + b"\r"
+        if name == "CD":
+            path = self._abspath(arg or "/flash")
+            if path not in self.dirs:
+                return _fs_error("ENOENT")
+            self.cwd = path
+            return self.cwd.encode() + b"\r"
+        if name == "MD":
+            path = self._abspath(arg)
+            if path in self.dirs or path in self.files:
+                return _fs_error("EEXIST")
+            if os.path.dirname(path) not in self.dirs:
+                return _fs_error("ENOENT")
+            self.dirs.add(path)
+            return b"OK\r"
+        if name == "LS":
+            path = self._abspath(arg) if arg else self.cwd
+            if path not in self.dirs:
+                return _fs_error("ENOENT")
+            lines = []
+            for d in sorted(self.dirs):
+                if os.path.dirname(d) == path and d != path:
+                    lines.append(b"     <DIR> %s/" % os.path.basename(d).encode())
+            for f in sorted(self.files):
+                if os.path.dirname(f) == path:
+                    lines.append(b"%10d %s" % (len(self.files[f]), os.path.basename(f).encode()))
+            return b"\r".join(lines) + b"\r" if lines else b"\r"
+        if name == "RM":
+            path = self._abspath(arg)
+            if path in self.files:
+                del self.files[path]
+            elif path in self.dirs and not any(os.path.dirname(p) == path for p in list(self.files) + list(self.dirs)):
+                self.dirs.discard(path)
+            else:
+                return _fs_error("ENOENT")
+            return b"OK\r"
+        if name == "MV":
+            src, _, dst = arg.partition(" ")
+            src, dst = self._abspath(src), self._abspath(dst.strip())
+            if src not in self.files:
+                return _fs_error("ENOENT")
+            self.files[dst] = self.files.pop(src)
+            return b"OK\r"
+        if name == "HASH":
+            path = self._abspath(arg)
+            if path not in self.files:
+                return _fs_error("ENOENT")
+            return b"sha256 %s\r" % hashlib.sha256(self.files[path]).hexdigest().encode()
+        if name == "INFO":
+            used = sum(len(data) for data in self.files.values())
+            return b"%10d used\r%10d free\r%10d bad\r%10d total\r" % (used, FS_CAPACITY - used, 0, FS_CAPACITY)
+        if name == "FORMAT":
+            self.files.clear()
+            self.dirs = set(FS_ROOT_DIRS)
+            self.cwd = "/flash"
+            return b"Formatting...\rOK\r"
+        if name == "PUT":
+            path = self._abspath(arg)
+            if os.path.dirname(path) not in self.dirs:
+                return _fs_error("ENOENT")
+            self._ymodem = _YModemReceiver(path)
+            self._schedule(self.timing.ymodem_poll_ms, self._ymodem_poll)
+            return XMODEM_CRC
+        return _fs_error("EINVAL")
+
+    def _ymodem_poll(self) -> None:
+        """ _ymodem_poll repeats the "C" request until the sender starts transmitting. """
+        if self._ymodem is not None and not self._ymodem.started:
+            self._write(XMODEM_CRC)
+            self._schedule(self.timing.ymodem_poll_ms, self._ymodem_poll)
+
+    def _on_ymodem_byte(self, byte: int) -> None:
+        rx = self._ymodem
+        rx.started = True
+        rx.buf.append(byte)
+        header = rx.buf[0]
+        if header == XMODEM_EOT:
+            rx.buf = bytearray()
+            rx.got_eot = True
+            self._write(bytes([XMODEM_ACK]))
+            self._write(XMODEM_CRC)  # Ask for the final (empty) block 0.
+            return
+        if header == XMODEM_CAN:
+            self._ymodem = None
+            return
+        if header not in (XMODEM_SOH, XMODEM_STX):
+            rx.buf = bytearray()  # Noise between packets.
+            return
+        block_size = 1024 if header == XMODEM_STX else 128
+        if len(rx.buf) < 3 + block_size + 2:
+            return
+        packet, rx.buf = bytes(rx.buf), bytearray()
+        seq, data, crc = packet[1], packet[3:3 + block_size], (packet[-2] << 8) | packet[-1]
+        if packet[2] != (255 - seq) & 0xFF or crc16_ccitt(data) != crc:
+            self._write(bytes([XMODEM_NAK]))
+            return
+
+        if rx.got_eot:  # Empty block 0 ends the YMODEM batch.
+            self._write(bytes([XMODEM_ACK]))
+            self.files[rx.path] = bytes(rx.data[:rx.size] if rx.size is not None else rx.data)
+            self._ymodem = None
+            self._write(b"\rOK\r")
+            return
+        if seq == 0 and rx.expected_seq == 0:  # Block 0: file name NUL size SPACE mtime.
+            fields = data.split(b"\x00", 1)[1].split(b" ")[0].rstrip(b"\x00")
+            rx.size = int(fields) if fields.isdigit() else None
+            rx.expected_seq = 1
+        elif seq == rx.expected_seq & 0xFF:
+            rx.data += data
+            rx.expected_seq += 1
+        # Otherwise it is a retransmission of a block we already have; acknowledge it again.
+        self._write(bytes([XMODEM_ACK]))
+
+
+def parse_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="emulator.py emulates an XBee 3 on a pseudo-terminal.")
+    parser.add_argument("--ap", required=False, type=int, default=0,
+                        help="Initial (persisted) ATAP operating mode: 0, 1, 2 or 4.")
+    parser.add_argument("--guard-time-ms", required=False, type=int, default=1000,
+                        help="Guard time around +++ in milliseconds.")
+    parser.add_argument("--at-response-ms", required=False, type=int, default=2,
+                        help="Emulated AT command processing time in milliseconds.")
+    parser.add_argument("--restart-ms", required=False, type=int, default=500,
+                        help="Emulated ATFR restart time in milliseconds.")
+    parser.add_argument("--baud", required=False, type=int, default=None,
+                        help="Pace output at this baud rate (default: as fast as possible).")
+    return parser.parse_args()
+
+
+def main() -> Error:
+    args = parse_arguments()
+    timing = Timing(guard_time_ms=args.guard_time_ms, at_response_ms=args.at_response_ms,
+                    restart_ms=args.restart_ms, baud=args.baud)
+    emulator = XBeeEmulator(timing=timing, registers={"AP": bytes([args.ap])})
+    port = emulator.start()
+    log("XBee emulator listening on %s (ATAP=%d). Press Ctrl-C to quit." % (port, args.ap))
+    try:
+        while True:
+            time.sleep(1.0)
+    except KeyboardInterrupt:
+        pass
+    emulator.stop()
+    return Success
+
+
+if __name__ == "__main__":
+    exit_status = main()
+    sys.exit(0 if exit_status is Success else 1)
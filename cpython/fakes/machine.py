@@ -0,0 +1,246 @@
+"""
+machine.py is a mock/fake implementation of the MicroPython 'machine' module (Pin and ADC) for the CPython3 tests.
+
+Input pins and ADC channels are driven by waveforms evaluated against utime's clock, so with
+utime.use_virtual_clock() a sampling loop sees exactly the same inputs on every run:
+
+    machine.drive("D0", machine.bounce(machine.square(period_ms=200), bounce_ms=5, seed=1))
+    machine.drive_adc("D1", machine.from_csv("capture.csv"))
+    button = Pin("D0", Pin.IN, Pin.PULL_UP)
+    while True:
+        buf.put(invert(button.value()))
+        utime.sleep_ms(1)
+
+A Waveform is a list of (time_us, value) steps, optionally repeating with a period; evaluating one is a binary
+search, so the fake adds little overhead to the loop being benchmarked. Output pins record what was written in
+Pin.history, and every Pin and ADC counts its reads.
+"""
+
+import bisect
+import collections
+import csv
+import math
+import random
+import time as cpython3_time
+
+import utime
+
+_wall_start = cpython3_time.perf_counter()
+
+
+def _now_us() -> int:
+    clock = utime.get_clock()
+    if clock is not None:
+        return clock.now_us
+    return int((cpython3_time.perf_counter() - _wall_start) * 1000000)
+
+
+class Waveform:
+    """
+    Waveform holds a step function: the value changes at each (time_us, value) in steps and holds until the next.
+    Before the first step it reads `initial`. If period_us is given, the waveform repeats forever, holding the last
+    step's value from the end of one period until the first step of the next.
+    """
+
+    def __init__(self, steps, period_us=None, initial=0):
+        steps = sorted(steps)
+        self.times = [t for t, _ in steps]
+        self.values = [v for _, v in steps]
+        self.period_us = period_us
+        self.initial = initial
+
+    def value_at(self, t_us: int):
+        if self.period_us:
+            t_us %= self.period_us
+        i = bisect.bisect_right(self.times, t_us) - 1
+        if i < 0:
+            # Before the first step of a period, a repeating waveform still holds the previous period's last value.
+            return self.values[-1] if self.period_us and self.values else self.initial
+        return self.values[i]
+
+    def steps(self):
+        return list(zip(self.times, self.values))
+
+
+def constant(value) -> Waveform:
+    return Waveform([], initial=value)
+
+
+def square(period_ms: float, duty: float = 0.5, high=1, low=0, phase_ms: float = 0) -> Waveform:
+    """ square returns a square wave that starts high (after the optional phase delay). """
+    period_us = int(period_ms * 1000)
+    high_us = int(period_us * duty)
+    phase_us = int(phase_ms * 1000) % period_us
+    return Waveform([(phase_us, high), ((phase_us + high_us) % period_us, low)], period_us=period_us)
+
+
+def bounce(waveform: Waveform, bounce_ms: float = 5, chatter_us: int = 250, seed=None) -> Waveform:
+    """
+    bounce adds contact bounce to a two-level waveform: for bounce_ms after each edge, the value chatters
+    between the old and new levels at random intervals averaging chatter_us before settling.
+    """
+    rng = random.Random(seed)
+    steps = []
+    previous = waveform.value_at(-1) if waveform.period_us else waveform.initial
+    limit = waveform.period_us
+    for t, value in waveform.steps():
+        end = t + int(bounce_ms * 1000)
+        if limit:
+            end = min(end, limit)  # Keep the bounce within the period so the waveform still repeats cleanly.
+        levels = (value, previous)
+        toggles = 0
+        edge = t
+        while edge < end:
+            steps.append((edge, levels[toggles % 2]))
+            toggles += 1
+            edge += max(1, int(rng.expovariate(1.0 / chatter_us)))
+        steps.append((end, value) if end > t else (t, value))
+        previous = value
+    merged = {}
+    for t, value in steps:
+        merged[t] = value  # Later steps at the same instant win.
+    return Waveform(list(merged.items()), period_us=waveform.period_us, initial=waveform.initial)
+
+
+def sine(period_ms: float, amplitude: float, offset: float, samples_per_period: int = 64) -> Waveform:
+    """ sine returns a sampled sine wave of integer values, e.g., for an ADC channel. """
+    period_us = int(period_ms * 1000)
+    steps = [(period_us * i // samples_per_period,
+              int(round(offset + amplitude * math.sin(2 * math.pi * i / samples_per_period))))
+             for i in range(samples_per_period)]
+    return Waveform(steps, period_us=period_us)
+
+
+def from_csv(path: str, loop: bool = False) -> Waveform:
+    """
+    from_csv loads a recorded capture: rows of "time_ms,value" (a header row is allowed). With loop=True the
+    capture repeats, with a period one sample interval longer than the capture.
+    """
+    steps = []
+    with open(path, newline="") as f:
+        for row in csv.reader(f):
+            try:
+                steps.append((int(float(row[0]) * 1000), int(float(row[1]))))
+            except (ValueError, IndexError):
+                continue  # Header or blank line.
+    period_us = None
+    if loop and len(steps) >= 2:
+        period_us = steps[-1][0] + (steps[-1][0] - steps[-2][0])
+    return Waveform(steps, period_us=period_us, initial=steps[0][1] if steps else 0)
+
+
+_pin_waveforms = {}  # Pin name -> Waveform driving the digital input.
+_adc_waveforms = {}  # Pin name -> Waveform driving the ADC channel.
+
+
+def drive(pin_id, waveform: Waveform) -> None:
+    """ drive connects a waveform to a digital input pin. """
+    _pin_waveforms[_name(pin_id)] = waveform
+
+
+def drive_adc(pin_id, waveform: Waveform) -> None:
+    """ drive_adc connects a waveform (of raw 12-bit readings) to an ADC channel. """
+    _adc_waveforms[_name(pin_id)] = waveform
+
+
+def reset() -> None:
+    """ reset disconnects every waveform. """
+    _pin_waveforms.clear()
+    _adc_waveforms.clear()
+
+
+def _name(pin_id) -> str:
+    return pin_id.name() if isinstance(pin_id, Pin) else str(pin_id)
+
+
+class _Board:
+    """ _Board lets code write Pin.board.D0 as on the XBee; each attribute is just the pin's name. """
+
+    def __getattr__(self, name):
+        return name
+
+
+class Pin:
+
+    IN = 0
+    OUT = 1
+    OPEN_DRAIN = 2
+    ALT = 3
+    ANALOG = 4
+    PULL_UP = 1
+    PULL_DOWN = 2
+    board = _Board()
+
+    def __init__(self, id, mode=-1, pull=-1, value=None):
+        self._id = _name(id)
+        self._mode = self.IN if mode == -1 else mode
+        self._pull = None if pull == -1 else pull
+        self._out = 0 if value is None else value
+        self.history = collections.deque(maxlen=1024)  # (time_us, value) for each write to an output pin.
+        self.reads = 0
+
+    def __repr__(self):
+        return "Pin(%s, mode=%s)" % (self._id, self._mode)
+
+    def __call__(self, *args):
+        return self.value(*args)
+
+    def init(self, mode=-1, pull=-1, value=None):
+        if mode != -1:
+            self._mode = mode
+        if pull != -1:
+            self._pull = pull
+        if value is not None:
+            self.value(value)
+
+    def value(self, *args):
+        if args:
+            self._out = 1 if args[0] else 0
+            self.history.append((_now_us(), self._out))
+            return None
+        self.reads += 1
+        if self._mode == self.OUT:
+            return self._out
+        waveform = _pin_waveforms.get(self._id)
+        if waveform is None:
+            return 1 if self._pull == self.PULL_UP else 0  # Floating inputs read their pull.
+        return waveform.value_at(_now_us())
+
+    def on(self):
+        self.value(1)
+
+    def off(self):
+        self.value(0)
+
+    def toggle(self):
+        self.value(0 if self._out else 1)
+
+    def name(self):
+        return self._id
+
+    def mode(self, mode=-1):
+        if mode == -1:
+            return self._mode
+        self._mode = mode
+
+    def pull(self, pull=-1):
+        if pull == -1:
+            return self._pull
+        self._pull = pull
+
+
+class ADC:
+    """ ADC reads a 12-bit channel (0 to 4095), as on the XBee 3. """
+
+    MAX = 4095
+
+    def __init__(self, pin):
+        self._id = _name(pin)
+        self.reads = 0
+
+    def read(self):
+        self.reads += 1
+        waveform = _adc_waveforms.get(self._id)
+        if waveform is None:
+            return 0
+        return max(0, min(self.MAX, int(waveform.value_at(_now_us()))))
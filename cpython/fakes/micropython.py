@@ -1,9 +1,16 @@
 """ micropython.py is a CPython3 implementation of MicroPython's "micropython" module. """
 
+import ugc
+
 
 def mem_info():
+    """ mem_info prints canned numbers, or the live ugc heap figures while ugc.start_heap() is in effect. """
     print("stack: 576 out of 5632")
-    print("GC: total: 64000, used: 3296, free: 60704")
+    if ugc._heap_size is None:
+        print("GC: total: 64000, used: 3296, free: 60704")
+    else:
+        print("GC: total: %d, used: %d, free: %d, peak: %d" % (
+            ugc._heap_size, ugc.mem_alloc(), ugc.mem_free(), ugc.mem_peak()))
     print("No. of 1-blocks: 41, 2-blocks: 47, max blk sz: 8, max free sz: 3750")
 
 
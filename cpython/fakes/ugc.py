@@ -8,16 +8,118 @@ but the latter does not have these.)
 It is unfortunate that the only way to import 'gc' in Digi XBee 3 MicroPython is with "import gc",
 not "import ugc". Oh well. So what I've done is defined upython/ugc.py that wraps the MicroPython
 version of gc. And the file that you're currently reading is the CPython3 analogue.
+
+By default mem_alloc() and mem_free() return 0, like before. Call start_heap() to emulate the device's heap:
+allocations made from then on are measured with tracemalloc, mem_alloc()/mem_free() report them against the
+given heap size, and growing past the heap size raises MemoryError in the device code, just like on the XBee.
+The budget is checked on every Python and builtin function call (via sys.setprofile) on the calling thread,
+so an over-budget allocation is reported at the next call rather than at the exact allocation.
+
+Limitations of the emulation:
+- Only the thread that called start_heap() is checked (sys.setprofile is per thread), although tracemalloc counts
+  every thread's allocations, so other threads can use up the budget without ever getting a MemoryError.
+- Once it has raised MemoryError, the check is disarmed until the device code calls collect(), which raises again
+  if the heap is still over budget. (Device code typically collects and retries after a MemoryError.)
+
+    ugc.start_heap(32 * 1024, name="test_button_buffer")
+    ...run device code...
+    peak = ugc.stop_heap()   # Also recorded in ugc.peaks["test_button_buffer"].
+
+Numbers are CPython object sizes, which are larger than MicroPython's, so pick budgets by measuring
+(see print_peaks()) rather than copying the device's figures verbatim.
 """
 
+import collections
+import gc as cpython3_gc
+import sys
+import tracemalloc
+
+DEFAULT_HEAP_SIZE = 32 * 1024  # Roughly what an XBee 3 leaves free for MicroPython code.
+
+_heap_size = None  # Heap size in bytes while emulating the heap, else None.
+_baseline = 0  # Traced bytes when start_heap() was called; allocations before that don't count.
+_started_tracemalloc = False
+_name = None
+peaks = collections.OrderedDict()  # Name given to start_heap() -> peak bytes used, for reporting.
+
+
+def start_heap(heap_size: int = DEFAULT_HEAP_SIZE, name: str = None) -> None:
+    """ start_heap starts measuring allocations against a heap of the given size. """
+    global _heap_size, _baseline, _started_tracemalloc, _name
+    if _heap_size is not None:
+        stop_heap()
+    _started_tracemalloc = not tracemalloc.is_tracing()
+    if _started_tracemalloc:
+        tracemalloc.start()
+    cpython3_gc.collect()
+    tracemalloc.reset_peak()
+    _baseline = tracemalloc.get_traced_memory()[0]
+    _heap_size = heap_size
+    _name = name
+    sys.setprofile(_enforce_heap_size)
+
+
+def stop_heap() -> int:
+    """ stop_heap stops emulating the heap and returns the peak number of bytes used since start_heap(). """
+    global _heap_size, _started_tracemalloc, _name
+    if _heap_size is None:
+        return 0
+    sys.setprofile(None)
+    peak = max(0, tracemalloc.get_traced_memory()[1] - _baseline)
+    if _name is not None:
+        peaks[_name] = peak
+    if _started_tracemalloc:
+        tracemalloc.stop()
+    _heap_size = None
+    _started_tracemalloc = False
+    _name = None
+    return peak
+
+
+def mem_peak() -> int:
+    """ mem_peak returns the peak number of bytes used since start_heap(). Not part of MicroPython. """
+    if _heap_size is None:
+        return 0
+    return max(0, tracemalloc.get_traced_memory()[1] - _baseline)
+
+
+def print_peaks() -> None:
+    """ print_peaks prints the peak heap usage recorded for each named start_heap() call. """
+    for name, peak in peaks.items():
+        print("heap peak: %6d bytes: %s" % (peak, name))
+
+
+def _used() -> int:
+    return max(0, tracemalloc.get_traced_memory()[0] - _baseline)
+
+
+def _check() -> None:
+    if _heap_size is not None and _used() > _heap_size:
+        raise MemoryError("memory allocation failed, heap of %d bytes exhausted" % _heap_size)
+
+
+def _enforce_heap_size(frame, event, arg):
+    if event in ("call", "c_call") and _used() > _heap_size:
+        sys.setprofile(None)  # CPython drops the profiler when it raises; collect() re-arms it.
+        raise MemoryError("memory allocation failed, heap of %d bytes exhausted" % _heap_size)
+
 
 def mem_alloc():
-    return 0
+    if _heap_size is None:
+        return 0
+    return _used()
 
 
 def mem_free():
-    return 0
+    if _heap_size is None:
+        return 0
+    return max(0, _heap_size - _used())
 
 
 def collect():
+    if _heap_size is None:
+        return None
+    cpython3_gc.collect()
+    _check()
+    sys.setprofile(_enforce_heap_size)
     return None
@@ -1,7 +1,12 @@
 """
 umachine.py is a mock/fake implementation of the MicroPython 'umachine' module for use by the CPython3 tests.
+On the device 'umachine' and 'machine' are the same module, so Pin and ADC come from the 'machine' fake.
 """
 
+from machine import ADC, Pin
+
+__all__ = ["ADC", "Pin", "soft_reset", "unique_id", "rng"]
+
 
 def soft_reset():
     pass
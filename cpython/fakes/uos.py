@@ -1,25 +1,356 @@
-""" uos.py is a mock/fake implementation of the Digi XBee 3 MicroPython uos module for use by cpython unit tests. """
+"""
+uos.py is a mock/fake implementation of the Digi XBee 3 MicroPython uos module for use by cpython unit tests.
 
-_bundle_contents = []
+The XBee's /flash filesystem is emulated in memory: listdir(), ilistdir() (with sizes), remove(), mkdir(), stat(),
+rename() and friends operate on it, and so does open() once it is routed there. Device code uses the builtin open(),
+so wrap the code under test in mounted() to send relative and /flash paths to the fake:
 
+    uos.flash.load_host_dir("build")            # Copy the deployed .mpy files in.
+    uos.flash.cost = uos.FlashCostModel(write_us_per_byte=20, erase_ms=30)
+    with uos.mounted():
+        bootstrap(logger)                        # May raise uos.InterpreterRestart (see bundle()).
 
-def bundle(*args, **kwargs):
-    global _bundle_contents
+Flash operations cost virtual (or real) time through utime.sleep_us() according to flash.cost, so boot-time code
+can be benchmarked deterministically with utime.use_virtual_clock().
+
+bundle(*files) restarts the MicroPython interpreter on the device, so here it raises InterpreterRestart,
+which test code catches in order to "reboot" and run main again.
+"""
+
+import builtins
+import io
+
+import utime
+
+S_IFDIR = 0x4000
+S_IFREG = 0x8000
+
+
+class InterpreterRestart(BaseException):
+    """
+    InterpreterRestart is raised where the device would restart the MicroPython interpreter (e.g., uos.bundle()).
+    It derives from BaseException so that device code's "except Exception" handlers do not swallow it.
+    """
+    pass
+
+
+class FlashCostModel:
+    """
+    FlashCostModel describes how long flash operations take.
+    - read_us_per_byte / write_us_per_byte: transfer cost of file reads and writes.
+    - erase_ms: cost of erasing a file's blocks (remove, or truncating an existing file by opening it with "w").
+    - op_us: fixed cost of any filesystem call (directory lookups, open, stat, etc.).
+    - bundle_ms_per_kb: cost of copying bytecode into the bundle area.
+    The default model is free, so tests that don't care about timing aren't slowed down.
+    """
+
+    def __init__(self, read_us_per_byte: float = 0.0, write_us_per_byte: float = 0.0, erase_ms: int = 0,
+                 op_us: int = 0, bundle_ms_per_kb: int = 0):
+        self.read_us_per_byte = read_us_per_byte
+        self.write_us_per_byte = write_us_per_byte
+        self.erase_ms = erase_ms
+        self.op_us = op_us
+        self.bundle_ms_per_kb = bundle_ms_per_kb
+
+
+class _Flash:
+    """ _Flash holds the emulated filesystem: absolute path -> bytes for files, plus a set of directories. """
+
+    ROOT_DIRS = ("/flash", "/flash/lib", "/flash/cert")
+
+    def __init__(self):
+        self.cost = FlashCostModel()
+        self.files = {}
+        self.dirs = set(self.ROOT_DIRS)
+        self.cwd = "/flash"
+        self.bundle = []
+        self.restarts = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.erases = 0
+
+    def reset(self) -> None:
+        """ reset returns the flash to factory state: empty filesystem, empty bundle, free cost model. """
+        self.__init__()
+
+    def format(self) -> None:
+        self.files.clear()
+        self.dirs = set(self.ROOT_DIRS)
+        self.cwd = "/flash"
+
+    def load_host_dir(self, host_dir: str, flash_dir: str = "/flash") -> None:
+        """ load_host_dir copies the regular files in a host directory into the emulated flash (at no cost). """
+        import os
+        for name in sorted(os.listdir(host_dir)):
+            path = os.path.join(host_dir, name)
+            if os.path.isfile(path):
+                with io.open(path, "rb") as f:
+                    self.files[flash_dir.rstrip("/") + "/" + name] = f.read()
+
+    def abspath(self, path: str) -> str:
+        if not path.startswith("/"):
+            path = self.cwd.rstrip("/") + "/" + path
+        parts = []
+        for part in path.split("/"):
+            if part in ("", "."):
+                continue
+            if part == "..":
+                if parts:
+                    parts.pop()
+                continue
+            parts.append(part)
+        return "/" + "/".join(parts)
+
+    def charge_op(self) -> None:
+        if self.cost.op_us:
+            utime.sleep_us(self.cost.op_us)
+
+    def charge_read(self, num_bytes: int) -> None:
+        self.bytes_read += num_bytes
+        if self.cost.read_us_per_byte:
+            utime.sleep_us(int(num_bytes * self.cost.read_us_per_byte))
+
+    def charge_write(self, num_bytes: int) -> None:
+        self.bytes_written += num_bytes
+        if self.cost.write_us_per_byte:
+            utime.sleep_us(int(num_bytes * self.cost.write_us_per_byte))
+
+    def charge_erase(self) -> None:
+        self.erases += 1
+        if self.cost.erase_ms:
+            utime.sleep_ms(self.cost.erase_ms)
+
+    def entries(self, path: str):
+        """ entries yields (name, type, size) for each directory entry, directories first as on the XBee. """
+        prefix = path.rstrip("/") + "/"
+        for d in sorted(self.dirs):
+            if d.startswith(prefix) and "/" not in d[len(prefix):]:
+                yield d[len(prefix):], S_IFDIR, 0
+        for f in sorted(self.files):
+            if f.startswith(prefix) and "/" not in f[len(prefix):]:
+                yield f[len(prefix):], S_IFREG, len(self.files[f])
+
+
+flash = _Flash()
+
+
+def _enoent():
+    return OSError(2, "ENOENT")
+
+
+def listdir(dir="."):
+    flash.charge_op()
+    path = flash.abspath(dir)
+    if path not in flash.dirs:
+        raise _enoent()
+    return [name for name, _, _ in flash.entries(path)]
+
+
+def ilistdir(dir="."):
+    """ ilistdir yields (name, type, inode, size) tuples, like the XBee (e.g., ('main.mpy', 32768, 0, 1976)). """
+    flash.charge_op()
+    path = flash.abspath(dir)
+    if path not in flash.dirs:
+        raise _enoent()
+    return ((name, kind, 0, size) for name, kind, size in flash.entries(path))
+
+
+def stat(path):
+    flash.charge_op()
+    path = flash.abspath(path)
+    if path in flash.dirs:
+        return S_IFDIR, 0, 0, 0, 0, 0, 0, 0, 0, 0
+    if path in flash.files:
+        return S_IFREG, 0, 0, 0, 0, 0, len(flash.files[path]), 0, 0, 0
+    raise _enoent()
+
+
+def remove(path):
+    flash.charge_op()
+    path = flash.abspath(path)
+    if path not in flash.files:
+        raise _enoent()
+    del flash.files[path]
+    flash.charge_erase()
+
+
+def rename(old_path, new_path):
+    flash.charge_op()
+    old_path, new_path = flash.abspath(old_path), flash.abspath(new_path)
+    if old_path not in flash.files:
+        raise _enoent()
+    flash.files[new_path] = flash.files.pop(old_path)
 
+
+def mkdir(path):
+    flash.charge_op()
+    path = flash.abspath(path)
+    if path in flash.dirs or path in flash.files:
+        raise OSError(17, "EEXIST")
+    if path.rsplit("/", 1)[0] not in flash.dirs:
+        raise _enoent()
+    flash.dirs.add(path)
+
+
+def rmdir(path):
+    flash.charge_op()
+    path = flash.abspath(path)
+    if path not in flash.dirs:
+        raise _enoent()
+    if any(True for _ in flash.entries(path)):
+        raise OSError(39, "ENOTEMPTY")
+    flash.dirs.discard(path)
+
+
+def chdir(path):
+    flash.charge_op()
+    path = flash.abspath(path)
+    if path not in flash.dirs:
+        raise _enoent()
+    flash.cwd = path
+
+
+def getcwd():
+    return flash.cwd
+
+
+def sync():
+    pass
+
+
+class _FlashFile:
+    """ _FlashFile is an open file on the emulated flash. Writes are committed to the filesystem on close(). """
+
+    def __init__(self, path: str, mode: str):
+        self.path = path
+        self.mode = mode
+        self.binary = "b" in mode
+        self.writable = any(c in mode for c in "wa+")
+        exists = path in flash.files
+        if "r" in mode and not exists:
+            raise _enoent()
+        if path.rsplit("/", 1)[0] not in flash.dirs:
+            raise _enoent()
+        initial = b"" if "w" in mode else flash.files.get(path, b"")
+        if "w" in mode and exists and flash.files[path]:
+            flash.charge_erase()
+        self._buf = io.BytesIO(initial)
+        if "a" in mode:
+            self._buf.seek(0, io.SEEK_END)
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __iter__(self):
+        line = self.readline()
+        while line:
+            yield line
+            line = self.readline()
+
+    def _out(self, data: bytes):
+        return data if self.binary else data.decode("utf-8")
+
+    def read(self, size=-1):
+        data = self._buf.read(size if size is not None else -1)
+        flash.charge_read(len(data))
+        return self._out(data)
+
+    def readinto(self, buf, nbytes=None):
+        if nbytes is not None:
+            buf = memoryview(buf)[:nbytes]
+        num = self._buf.readinto(buf)
+        flash.charge_read(num)
+        return num
+
+    def readline(self):
+        data = self._buf.readline()
+        flash.charge_read(len(data))
+        return self._out(data)
+
+    def write(self, data):
+        if not self.writable:
+            raise OSError(9, "EBADF")
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        num = self._buf.write(data)
+        flash.charge_write(num)
+        return num
+
+    def seek(self, offset, whence=0):
+        return self._buf.seek(offset, whence)
+
+    def tell(self):
+        return self._buf.tell()
+
+    def flush(self):
+        if self.writable:
+            flash.files[self.path] = self._buf.getvalue()
+
+    def close(self):
+        if not self.closed:
+            self.flush()
+            self.closed = True
+
+
+def open(path, mode="r"):
+    """ open opens a file on the emulated flash. Not part of uos; see mounted() for routing the builtin open(). """
+    flash.charge_op()
+    return _FlashFile(flash.abspath(path), mode)
+
+
+class mounted:
+    """
+    mounted is a context manager that routes the builtin open() to the emulated flash for relative paths and
+    paths under /flash, as they would resolve on the device. Any other absolute path still opens a host file.
+    """
+
+    def __enter__(self):
+        self._saved_open = builtins.open
+        host_open = self._saved_open
+
+        def device_open(file, mode="r", *args, **kwargs):
+            if isinstance(file, str) and (file.startswith("/flash") or not file.startswith("/")):
+                return open(file, mode)
+            return host_open(file, mode, *args, **kwargs)
+
+        builtins.open = device_open
+        return flash
+
+    def __exit__(self, *args):
+        builtins.open = self._saved_open
+
+
+def bundle(*args, **kwargs):
     if len(args) == 0:
         # bundle() (without args) returns the list of current bundled files.
-        return _bundle_contents
+        return flash.bundle
 
     if args[0] is None:
         # bundle(None) (with None as the arg) clears the bundle and returns the empty list
-        _bundle_contents.clear()
-        return _bundle_contents
-
-    # bundle('file1.mpy', 'file2.mpy', ...) replaces the contents of the bundle with the given files.
-    # Note that the .mpy extensions are stripped.
-    _bundle_contents = [x.replace(".mpy", "") for x in args]
+        flash.bundle = []
+        return flash.bundle
 
-    return _bundle_contents
+    # bundle('file1.mpy', 'file2.mpy', ...) replaces the contents of the bundle with the given files
+    # and then restarts the MicroPython interpreter. Note that the .mpy extensions are stripped.
+    # A file that's missing from the filesystem leaves an empty module name, as observed on the XBee.
+    total_bytes = 0
+    names = []
+    for filename in args:
+        path = flash.abspath(filename)
+        if path in flash.files:
+            total_bytes += len(flash.files[path])
+            names.append(filename.replace(".mpy", ""))
+        else:
+            names.append("")
+    if flash.cost.bundle_ms_per_kb:
+        utime.sleep_ms(flash.cost.bundle_ms_per_kb * total_bytes // 1024)
+    flash.bundle = names
+    flash.restarts += 1
+    raise InterpreterRestart("uos.bundle() restarts the MicroPython interpreter")
 
 
 def urandom(num_bytes):
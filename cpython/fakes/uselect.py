@@ -0,0 +1,82 @@
+"""
+uselect.py is an implementation of the MicroPython 'uselect' module that uses the CPython3 selectors module.
+
+Any object with a fileno() method can be registered, including the usocket and ussl fakes. As in MicroPython,
+timeouts are in milliseconds (-1 or None waits forever), poll() returns a list of (obj, event) tuples,
+and ipoll() yields them instead; passing flags=1 to ipoll() makes each report one-shot, i.e., the object's
+event mask drops to 0 until you call modify() again.
+"""
+
+import errno
+import select as cpython3_select
+import selectors
+
+POLLIN = 0x0001
+POLLOUT = 0x0004
+POLLERR = 0x0008
+POLLHUP = 0x0010
+
+
+def _to_selector_events(eventmask: int) -> int:
+    events = 0
+    if eventmask & POLLIN:
+        events |= selectors.EVENT_READ
+    if eventmask & POLLOUT:
+        events |= selectors.EVENT_WRITE
+    return events
+
+
+class poll:
+
+    def __init__(self):
+        self._selector = selectors.DefaultSelector()
+        self._masks = {}  # id(obj) -> [obj, eventmask]
+
+    def register(self, obj, eventmask=POLLIN | POLLOUT):
+        entry = self._masks.get(id(obj))
+        if entry is None:
+            self._masks[id(obj)] = [obj, 0]
+        self._set_mask(obj, eventmask)
+
+    def unregister(self, obj):
+        entry = self._masks.pop(id(obj), None)
+        if entry is not None and entry[1]:
+            self._selector.unregister(obj)
+
+    def modify(self, obj, eventmask):
+        if id(obj) not in self._masks:
+            raise OSError(errno.ENOENT, "ENOENT")
+        self._set_mask(obj, eventmask)
+
+    def poll(self, timeout=-1):
+        return list(self.ipoll(timeout))
+
+    def ipoll(self, timeout=-1, flags=0):
+        if not self._selector.get_map():
+            ready = []  # CPython's selectors complain about an empty wait on some platforms; MicroPython doesn't.
+            if timeout is not None and timeout > 0:
+                cpython3_select.select([], [], [], timeout / 1000.0)
+        else:
+            ready = self._selector.select(None if timeout is None or timeout < 0 else timeout / 1000.0)
+        for key, events in ready:
+            obj = key.fileobj
+            event = (POLLIN if events & selectors.EVENT_READ else 0) | \
+                    (POLLOUT if events & selectors.EVENT_WRITE else 0)
+            if flags & 1:
+                self._set_mask(obj, 0)
+            yield obj, event
+
+    def _set_mask(self, obj, eventmask):
+        entry = self._masks[id(obj)]
+        old, new = _to_selector_events(entry[1]), _to_selector_events(eventmask)
+        entry[1] = eventmask
+        if old and new:
+            self._selector.modify(obj, new)
+        elif new:
+            self._selector.register(obj, new)
+        elif old:
+            self._selector.unregister(obj)
+
+
+def select(rlist, wlist, xlist, timeout=None):
+    return cpython3_select.select(rlist, wlist, xlist, timeout)
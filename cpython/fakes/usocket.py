@@ -10,6 +10,12 @@ IPPROTO_IP = cpython3_socket.IPPROTO_IP
 IPPROTO_UDP = cpython3_socket.IPPROTO_UDP
 IPPROTO_TCP = cpython3_socket.IPPROTO_TCP
 IPPROTO_SEC = cpython3_socket.IPPROTO_TCP  # CPython3 doesn't define IPPROTO_SEC. Use a regular TCP protocol instead.
+SOL_SOCKET = cpython3_socket.SOL_SOCKET
+SO_REUSEADDR = cpython3_socket.SO_REUSEADDR
+
+
+def getaddrinfo(host, port, af=0, type=0, proto=0, flags=0):
+    return cpython3_socket.getaddrinfo(host, port, af, type, proto, flags)
 
 
 class socket:
@@ -18,6 +24,30 @@ class socket:
         self.sock = cpython3_socket.socket(family=af, type=type, proto=proto)
         self.fail = False
 
+    @classmethod
+    def _wrap(cls, sock):
+        wrapped = cls.__new__(cls)
+        wrapped.sock = sock
+        wrapped.fail = False
+        return wrapped
+
+    def fileno(self):
+        # fileno lets uselect.poll() (and CPython's selectors) watch this socket.
+        return self.sock.fileno()
+
+    def bind(self, address):
+        return self.sock.bind(address)
+
+    def listen(self, backlog=5):
+        return self.sock.listen(backlog)
+
+    def accept(self):
+        sock, address = self.sock.accept()
+        return socket._wrap(sock), address
+
+    def setsockopt(self, level, optname, value):
+        return self.sock.setsockopt(level, optname, value)
+
     def connect(self, address):
         if self.fail:
             raise Exception("Fake connect error")
@@ -35,25 +65,70 @@ class socket:
     def settimeout(self, value):
         return self.sock.settimeout(value)
 
-    def read(self, size):
+    def read(self, size=-1):
         # https://docs.python.org/3/library/socket.html - "Note that there are no methods
         # read() or write(); use recv() and send() without flags argument instead."
         #
         # The Digi XBee MicroPython TCP socket returns None when no data is available for non-blocking TCP sockets.
-        # This disagrees with CPython3 sockets, which instead throw an ETIMEDOUT or EAGAIN exception if no data
-        # is available.
+        # This disagrees with CPython3 sockets, which instead throw an EAGAIN (BlockingIOError) exception if no data
+        # is available. So catch only that exception and return None in order to make this behave like the
+        # MicroPython version. Other errors (e.g., ETIMEDOUT on a socket with a timeout, or ECONNRESET) propagate,
+        # just like they do on the device.
         #
-        # In standard MicroPython, socket.read() returns None if the TCP socket is nonblocking and no data is available.
-        # However, in CPython3, socket.recv() raises an exception if no data is available.
-        # Since this file contains the CPython3 implementation, we need to catch the exception
-        # and return None in order to make this behave like the MicroPython version.
+        # As with MicroPython streams, read() with no size reads until EOF.
         if self.fail:
             raise Exception("Fake read error")
+        if size is not None and size >= 0:
+            try:
+                return self.sock.recv(size)
+            except BlockingIOError:
+                return None
+        chunks = []
+        while True:
+            try:
+                chunk = self.sock.recv(4096)
+            except BlockingIOError:
+                if not chunks:
+                    return None
+                break
+            if not chunk:
+                break
+            chunks.append(chunk)
+        return b"".join(chunks)
+
+    def readinto(self, buf, nbytes=None):
+        # readinto receives directly into the caller's buffer (which may be a memoryview into a larger buffer),
+        # without allocating. Returns the number of bytes read, or None if the socket is non-blocking and no data
+        # is available.
+        if self.fail:
+            raise Exception("Fake readinto error")
         try:
-            ret = self.sock.recv(size)
-        except Exception as ex:
-            ret = None
-        return ret
+            return self.sock.recv_into(buf, len(buf) if nbytes is None else nbytes)
+        except BlockingIOError:
+            return None
+
+    def readline(self):
+        # readline returns bytes up to and including the newline. The socket's receive queue doubles as the buffer:
+        # we peek for the newline and then consume only through it, so nothing after the line is lost.
+        # For a non-blocking socket a partial line may be returned, or None if no data is available at all.
+        if self.fail:
+            raise Exception("Fake readline error")
+        line = b""
+        while True:
+            try:
+                peeked = self.sock.recv(256, cpython3_socket.MSG_PEEK)
+            except BlockingIOError:
+                return line if line else None
+            if not peeked:
+                return line
+            newline = peeked.find(b"\n")
+            line += self.sock.recv(len(peeked) if newline < 0 else newline + 1)
+            if newline >= 0:
+                return line
+
+    def makefile(self, mode="rb", buffering=0):
+        # MicroPython sockets are already stream objects, so makefile() just returns the socket itself.
+        return self
 
     def write(self, buf, num=None):
         # https://docs.python.org/3/library/socket.html - "Note that there are no methods
@@ -65,12 +140,35 @@ class socket:
         # objects are also stream objects. In CPython3, however, this is not the case-- socket.write() does NOT
         # take a second argument. However, this implementation of usocket MUST support the second argument because
         # umqtt.py and potentially other MicroPython code relies upon it.
+        #
+        # As with MicroPython streams, a non-blocking write that can't make progress returns None.
+        # A memoryview limits the write to num bytes without copying the buffer the way buf[:num] would.
 
         if self.fail:
             raise Exception("Fake write error")
-        if num is None:
-            num = len(buf)
-        return self.sock.send(buf[:num])
+        try:
+            if num is None:
+                return self.sock.send(buf)
+            with memoryview(buf) as view:
+                return self.sock.send(view[:num])
+        except BlockingIOError:
+            return None
+
+    def send(self, buf):
+        if self.fail:
+            raise Exception("Fake send error")
+        return self.sock.send(buf)
+
+    def sendall(self, buf):
+        if self.fail:
+            raise Exception("Fake sendall error")
+        return self.sock.sendall(buf)
+
+    def recv(self, size):
+        # Unlike read(), recv() keeps the exception when no data is available, like MicroPython's socket.recv().
+        if self.fail:
+            raise Exception("Fake recv error")
+        return self.sock.recv(size)
 
     def sendto(self, buf, addr):
         if self.fail:
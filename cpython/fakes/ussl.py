@@ -1,20 +1,112 @@
-""" ussl.py is an implementation of the MicroPython ussl interface that uses the CPython3 ssl module. """
+"""
+ussl.py is an implementation of the MicroPython ussl interface that uses the CPython3 ssl module.
+
+Each distinct (keyfile, certfile, ca_certs) combination gets one cached SSLContext, so the certificates are parsed
+once rather than per connection. Client sessions are remembered per context and server (server_hostname if
+given, otherwise the peer address), and later connections to the same server with the same certificates offer
+that session for resumption, which skips most of the handshake. (Only the context that made a session can resume
+it.) stats() reports how many handshakes ran, how many resumed a session, and how long they took.
+"""
+
+import ssl
+import time
+
+_contexts = {}  # (keyfile, certfile, ca_certs, server_side) -> ssl.SSLContext
+_sessions = {}  # (context key, server) -> most recent ssl.SSLSession for that server.
+_stats = {"contexts": 0, "handshakes": 0, "resumed": 0, "handshake_sec": 0.0}
+
+
+def get_context(keyfile=None, certfile=None, ca_certs=None, server_side=False) -> ssl.SSLContext:
+    """ get_context returns the shared SSLContext for the given certificate files, creating it on first use. """
+    key = (keyfile, certfile, ca_certs, server_side)
+    context = _contexts.get(key)
+    if context is None:
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER if server_side else ssl.PROTOCOL_TLS_CLIENT)
+        if not server_side:
+            context.check_hostname = False  # Same as the ssl.wrap_socket() call this replaced.
+            context.verify_mode = ssl.CERT_REQUIRED
+            if ca_certs is not None:
+                context.load_verify_locations(cafile=ca_certs)
+            else:
+                context.load_default_certs()
+        if certfile is not None:
+            context.load_cert_chain(certfile, keyfile)
+        _contexts[key] = context
+        _stats["contexts"] += 1
+    return context
+
+
+def stats() -> dict:
+    """ stats returns the handshake metrics gathered since the last reset_stats(). """
+    handshakes = _stats["handshakes"]
+    result = dict(_stats)
+    result["resumption_rate"] = _stats["resumed"] / handshakes if handshakes else 0.0
+    result["mean_handshake_ms"] = 1000.0 * _stats["handshake_sec"] / handshakes if handshakes else 0.0
+    return result
+
+
+def reset_stats() -> None:
+    _stats.update({"contexts": 0, "handshakes": 0, "resumed": 0, "handshake_sec": 0.0})
+
+
+def clear_caches() -> None:
+    """ clear_caches forgets every cached context and session, so the next connection does a full handshake. """
+    _contexts.clear()
+    _sessions.clear()
+
 
 class WrappedSocket:
 
     def __init__(self, s, keyfile=None, certfile=None, ca_certs=None, server_side=False, server_hostname=None):
-        import ssl
-        self.wrap = ssl.wrap_socket(s.sock,
-                                    keyfile=keyfile, certfile=certfile, ca_certs=ca_certs,
-                                    cert_reqs=ssl.CERT_REQUIRED)
+        self.server_side = server_side
+        self.server_hostname = server_hostname
+        self._server_key = None
+        self._context_key = (keyfile, certfile, ca_certs, server_side)
+        context = get_context(keyfile=keyfile, certfile=certfile, ca_certs=ca_certs, server_side=server_side)
+        try:
+            peer = s.sock.getpeername()
+        except OSError:
+            peer = None  # Not connected yet; the handshake happens in connect().
+        if peer is None or server_side:
+            self.wrap = context.wrap_socket(s.sock, server_side=server_side, server_hostname=server_hostname)
+            return
+        # MicroPython code usually connects the plain socket first and then wraps it, handshaking right away.
+        self._server_key = (self._context_key, server_hostname or peer)
+        start = time.perf_counter()
+        self.wrap = context.wrap_socket(s.sock, server_hostname=server_hostname,
+                                        session=_sessions.get(self._server_key))
+        self._handshake_done(start)
+
+    def _handshake_done(self, start: float) -> None:
+        _stats["handshake_sec"] += time.perf_counter() - start
+        _stats["handshakes"] += 1
+        if self.wrap.session_reused:
+            _stats["resumed"] += 1
+        self._remember_session()
+
+    def _remember_session(self) -> None:
+        # With TLS 1.3 the session ticket may only arrive after some application data, so this runs again on close.
+        if self._server_key is not None and self.wrap.session is not None:
+            _sessions[self._server_key] = self.wrap.session
 
     def connect(self, address):
-        return self.wrap.connect(address)
+        self._server_key = (self._context_key, self.server_hostname or address)
+        session = _sessions.get(self._server_key)
+        if session is not None:
+            self.wrap.session = session
+        start = time.perf_counter()
+        ret = self.wrap.connect(address)
+        self._handshake_done(start)
+        return ret
 
     def shutdown(self, how):
         return self.wrap.shutdown(how)
 
     def close(self):
+        try:
+            self._remember_session()
+        except (OSError, ValueError):
+            pass
         return self.wrap.close()
 
     def setblocking(self, flag):
@@ -34,10 +126,23 @@ class WrappedSocket:
             ret = None
         return ret
 
+    def readinto(self, buf, nbytes=None):
+        # readinto decrypts directly into the caller's buffer. Returns the number of bytes read, or None if the
+        # socket is non-blocking and no data is available (like read()).
+        try:
+            return self.wrap.recv_into(buf, len(buf) if nbytes is None else nbytes)
+        except (BlockingIOError, ssl.SSLWantReadError):
+            return None
+
     def write(self, buf, num=None):
+        # A memoryview limits the write to num bytes without copying the buffer the way buf[:num] would.
         if num is None:
-            num = len(buf)
-        return self.wrap.write(buf[:num])
+            return self.wrap.send(buf)
+        with memoryview(buf) as view:
+            return self.wrap.send(view[:num])
+
+    def fileno(self):
+        return self.wrap.fileno()
 
 
 def wrap_socket(sock, keyfile=None, certfile=None, ca_certs=None, server_side=False, server_hostname=None):
@@ -1,19 +1,120 @@
+"""
+utime.py is a mock/fake implementation of the MicroPython 'utime' module for use by the CPython3 tests.
+
+By default it follows the wall clock, so utime.sleep_ms() really sleeps. Tests that exercise polling loops can
+instead switch to a virtual clock: sleep_ms() then advances simulated time instantly, so an hour of device
+behavior runs in milliseconds. Tests drive the virtual clock explicitly with advance_ms(), for example:
+
+    clock = utime.use_virtual_clock()
+    ...run device code...
+    utime.advance_ms(500)
+    utime.use_wall_clock()
+
+The ticks_* functions wrap around at TICKS_PERIOD just like on the device (the XBee's small ints are 31 bits),
+so ticks_diff()/ticks_add() must be used for arithmetic on tick values, exactly as on the device.
+"""
+
 import time as cpython3_time
 
+TICKS_PERIOD = 2**30
+_TICKS_MAX = TICKS_PERIOD - 1
+_TICKS_HALFPERIOD = TICKS_PERIOD // 2
+
 _start = cpython3_time.time()
 
 
+class VirtualClock:
+    """
+    VirtualClock holds simulated time in microseconds. Nothing advances it except calls to
+    sleep_ms()/sleep_us()/sleep() from device code and advance_ms()/advance_us() from tests.
+    """
+
+    def __init__(self, start_ms: int = 0, epoch: float = None):
+        self.now_us = start_ms * 1000
+        self.epoch = _start if epoch is None else epoch  # Value of time() when the virtual clock reads zero.
+
+    def advance_us(self, us: int) -> None:
+        if us > 0:
+            self.now_us += int(us)
+
+    def advance_ms(self, ms: int) -> None:
+        self.advance_us(ms * 1000)
+
+    def sleep_us(self, us: int) -> None:
+        self.advance_us(us)
+
+    def ticks_us(self) -> int:
+        return self.now_us & _TICKS_MAX
+
+    def ticks_ms(self) -> int:
+        return (self.now_us // 1000) & _TICKS_MAX
+
+    def time(self) -> float:
+        return self.epoch + self.now_us / 1000000.0
+
+
+_clock = None  # The active VirtualClock, or None to follow the wall clock.
+
+
+def use_virtual_clock(clock: VirtualClock = None) -> VirtualClock:
+    """ use_virtual_clock switches this module to the given (or a new) virtual clock and returns it. """
+    global _clock
+    _clock = clock if clock is not None else VirtualClock()
+    return _clock
+
+
+def use_wall_clock() -> None:
+    """ use_wall_clock switches this module back to following the real time. """
+    global _clock
+    _clock = None
+
+
+def get_clock() -> VirtualClock:
+    """ get_clock returns the active virtual clock, or None if following the wall clock. """
+    return _clock
+
+
+def advance_ms(ms: int) -> None:
+    """ advance_ms moves the virtual clock forward. Only valid in virtual clock mode. """
+    if _clock is None:
+        raise RuntimeError("advance_ms requires the virtual clock; call use_virtual_clock() first")
+    _clock.advance_ms(ms)
+
+
+def ticks_us():
+    if _clock is not None:
+        return _clock.ticks_us()
+    return int((cpython3_time.time() - _start) * 1000000) & _TICKS_MAX
+
+
 def ticks_ms():
-    return int((cpython3_time.time() - _start) * 1000)
+    if _clock is not None:
+        return _clock.ticks_ms()
+    return int((cpython3_time.time() - _start) * 1000) & _TICKS_MAX
+
+
+def ticks_add(ticks, delta):
+    return (ticks + delta) & _TICKS_MAX
 
 
 def ticks_diff(after, before):
-    # Note that this doesn't handle wraparound. But we shouldn't have any for the purposes of the testing.
-    return after - before
+    # Same as MicroPython: the signed distance from before to after, assuming they are less than half a period apart.
+    return ((after - before + _TICKS_HALFPERIOD) & _TICKS_MAX) - _TICKS_HALFPERIOD
+
+
+def sleep_us(us):
+    if _clock is not None:
+        _clock.sleep_us(us)
+    else:
+        cpython3_time.sleep(us / 1000000.0)
 
 
 def sleep_ms(ms):
-    cpython3_time.sleep(ms / 1000.0)
+    sleep_us(ms * 1000)
+
+
+def sleep(secs):
+    sleep_us(secs * 1000000)
 
 
 def ctime(secs):
@@ -21,4 +122,6 @@ def ctime(secs):
 
 
 def time():
+    if _clock is not None:
+        return _clock.time()
     return cpython3_time.time()
@@ -1,7 +1,104 @@
-""" xbee.py is a mock/fake implementation of the Digi XBee 3 MicroPython xbee module for use in CPython3 unit tests. """
+"""
+xbee.py is a mock/fake implementation of the Digi XBee 3 MicroPython xbee module for use in CPython3 unit tests.
 
+Every path into or out of the fake device (each relay interface, and the radio's transmit/receive) is a _Channel:
+a deque-backed FIFO shaped by a LinkModel that adds latency, limits the byte rate, randomly drops messages and caps
+the queue depth. The default LinkModel is an ideal link, so messages arrive immediately and nothing is lost.
+Timing follows the utime fake, so combine this with utime.use_virtual_clock() to load-test relay and receive
+handlers at realistic or worst-case rates without waiting in real time.
+
+Test-side (host) helpers:
+    relay.set_link(relay.SERIAL, LinkModel(latency_ms=20, bytes_per_sec=11520, drop_probability=0.01))
+    relay.inject(relay.SERIAL, b"...")   # Something arrives for relay.receive().
+    relay.pop_sent()                     # Something that relay.send() delivered, or None.
+    radio.inject(sender_eui64, b"...")   # Something arrives for xbee.receive().
+    radio.pop_transmitted()              # Something that xbee.transmit() delivered, or None.
+"""
+
+import collections
+import errno
+import random
 from typing import Any, Optional
 
+import utime
+
+ADDR_BROADCAST = b"\x00\x00\x00\x00\x00\x00\xff\xff"
+ADDR_COORDINATOR = b"\x00\x00\x00\x00\x00\x00\x00\x00"
+
+
+class LinkModel:
+    """
+    LinkModel describes the properties of one direction of one interface.
+    - latency_ms: fixed propagation delay added to each message.
+    - bytes_per_sec: serialization rate; messages queue up behind each other. None means unlimited.
+    - drop_probability: chance (0.0 to 1.0) that any given message is silently lost.
+    - queue_cap: maximum number of messages in flight. None means unlimited.
+    - seed: seed for the drop decisions, so that lossy runs are reproducible.
+    """
+
+    def __init__(self, latency_ms: int = 0, bytes_per_sec: Optional[int] = None, drop_probability: float = 0.0,
+                 queue_cap: Optional[int] = None, seed: Optional[int] = None):
+        self.latency_ms = latency_ms
+        self.bytes_per_sec = bytes_per_sec
+        self.drop_probability = drop_probability
+        self.queue_cap = queue_cap
+        self._random = random.Random(seed)
+
+    def should_drop(self) -> bool:
+        return self.drop_probability > 0.0 and self._random.random() < self.drop_probability
+
+
+class _Channel:
+    """ _Channel is a FIFO of messages in flight through a LinkModel. All operations are O(1). """
+
+    def __init__(self, link: Optional[LinkModel] = None):
+        self.link = link if link is not None else LinkModel()
+        self._queue = collections.deque()  # Stores (ready_ticks_ms, message) tuples in arrival order.
+        self._busy_until = None  # Tick at which the link finishes serializing the last accepted message.
+        self._carry_ms = 0.0  # Fractional milliseconds of serialization time not yet accounted for.
+        self.accepted = 0
+        self.delivered = 0
+        self.dropped = 0
+        self.overflowed = 0
+
+    def __len__(self):
+        return len(self._queue)
+
+    def put(self, message: Any, num_bytes: int) -> bool:
+        """ put accepts a message into the channel. Returns False if the queue is full (the message is discarded). """
+        link = self.link
+        if link.queue_cap is not None and len(self._queue) >= link.queue_cap:
+            self.overflowed += 1
+            return False
+        self.accepted += 1
+        if link.should_drop():
+            self.dropped += 1  # Lost on the air; the sender can't tell.
+            return True
+
+        now = utime.ticks_ms()
+        start = now
+        if self._busy_until is not None and utime.ticks_diff(self._busy_until, now) > 0:
+            start = self._busy_until
+        if link.bytes_per_sec:
+            serialization_ms = num_bytes * 1000.0 / link.bytes_per_sec + self._carry_ms
+            whole_ms = int(serialization_ms)
+            self._carry_ms = serialization_ms - whole_ms
+            start = utime.ticks_add(start, whole_ms)
+            self._busy_until = start
+        self._queue.append((utime.ticks_add(start, link.latency_ms), message))
+        return True
+
+    def get(self) -> Any:
+        """ get returns the oldest message whose delivery time has arrived, or None. """
+        if not self._queue or utime.ticks_diff(utime.ticks_ms(), self._queue[0][0]) < 0:
+            return None
+        self.delivered += 1
+        return self._queue.popleft()[1]
+
+    def stats(self) -> dict:
+        return {"accepted": self.accepted, "delivered": self.delivered, "dropped": self.dropped,
+                "overflowed": self.overflowed, "in_flight": len(self._queue)}
+
 
 class _Relay:
 
@@ -10,25 +107,100 @@ class _Relay:
     MICROPYTHON = 2
 
     def __init__(self):
-        self.incoming = []  # Stores messages of format:  { "sender": 0, "message" : b"" }
-        self.outgoing = []  # Stores messages of format: { "dest": 0, "data": b"" }
+        self.incoming = collections.deque()  # Arrived messages of format:  { "sender": 0, "message" : b"" }
+        self.outgoing = collections.deque()  # Delivered messages of format: { "dest": 0, "data": b"" }
+        self.inbound = {}  # Interface -> _Channel carrying messages toward relay.receive().
+        self.outbound = {}  # Interface -> _Channel carrying messages from relay.send().
+        for interface in (self.SERIAL, self.BLUETOOTH, self.MICROPYTHON):
+            self.set_link(interface, LinkModel())
+
+    def set_link(self, interface: int, link: LinkModel, outbound_link: Optional[LinkModel] = None) -> None:
+        """ set_link applies a LinkModel to both directions of the given interface (or separate ones per direction). """
+        self.inbound[interface] = _Channel(link)
+        self.outbound[interface] = _Channel(outbound_link if outbound_link is not None else link)
+
+    def inject(self, sender: int, message: bytes) -> bool:
+        """ inject is the test-side entry point for messages arriving from the given interface. """
+        return self.inbound[sender].put({"sender": sender, "message": message}, len(message))
 
     def receive(self) -> Optional[dict]:
         if len(self.incoming) == 0:
-            return None
-        return self.incoming.pop(0)
+            self._pump(self.inbound, self.incoming)
+            if len(self.incoming) == 0:
+                return None
+        return self.incoming.popleft()
 
     def send(self, dest: int, data: Any) -> None:
-        self.outgoing.append({"dest": dest, "data": data})
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        if not self.outbound[dest].put({"dest": dest, "data": bytes(data)}, len(data)):
+            raise OSError(errno.ENOBUFS, "ENOBUFS")
+
+    def pop_sent(self) -> Optional[dict]:
+        """ pop_sent is the test-side accessor for messages that relay.send() delivered to their destination. """
+        if len(self.outgoing) == 0:
+            self._pump(self.outbound, self.outgoing)
+            if len(self.outgoing) == 0:
+                return None
+        return self.outgoing.popleft()
+
+    def stats(self) -> dict:
+        return {"inbound": {i: c.stats() for i, c in self.inbound.items()},
+                "outbound": {i: c.stats() for i, c in self.outbound.items()}}
+
+    @staticmethod
+    def _pump(channels: dict, arrived: collections.deque) -> None:
+        for channel in channels.values():
+            message = channel.get()
+            while message is not None:
+                arrived.append(message)
+                message = channel.get()
+
+
+class _Radio:
+    """ _Radio backs xbee.transmit() and xbee.receive(). """
+
+    def __init__(self):
+        self.inbound = _Channel()
+        self.outbound = _Channel()
+
+    def set_link(self, link: LinkModel, outbound_link: Optional[LinkModel] = None) -> None:
+        self.inbound = _Channel(link)
+        self.outbound = _Channel(outbound_link if outbound_link is not None else link)
+
+    def inject(self, sender_eui64: bytes, payload: bytes, broadcast: bool = False, sender_nwk: int = 0) -> bool:
+        """ inject is the test-side entry point for messages arriving over the air for xbee.receive(). """
+        message = {"broadcast": broadcast, "dest_ep": 0xE8, "source_ep": 0xE8, "cluster": 0x11, "profile": 0xC105,
+                   "sender_nwk": sender_nwk, "sender_eui64": sender_eui64, "payload": payload}
+        return self.inbound.put(message, len(payload))
+
+    def pop_transmitted(self) -> Optional[dict]:
+        """ pop_transmitted is the test-side accessor for messages that xbee.transmit() put on the air. """
+        return self.outbound.get()
 
 
 relay = _Relay()
+radio = _Radio()
 
 _registers = {}
+_atcmd_history = collections.deque(maxlen=256)  # Most recent (cmd, value) calls, for tests to inspect.
 
 
 def atcmd(cmd, value=None):
-    global _registers
+    _atcmd_history.append((cmd, value))
     if value is not None:
         _registers[cmd] = value
     return _registers.get(cmd, None)
+
+
+def transmit(dest, payload, source_ep=0xE8, dest_ep=0xE8, cluster=0x11, profile=0xC105, bcast_radius=0, tx_options=0):
+    if isinstance(payload, str):
+        payload = payload.encode("utf-8")
+    message = {"dest": bytes(dest) if not isinstance(dest, int) else dest, "payload": bytes(payload),
+               "source_ep": source_ep, "dest_ep": dest_ep, "cluster": cluster, "profile": profile}
+    if not radio.outbound.put(message, len(payload)):
+        raise OSError(errno.ENOBUFS, "ENOBUFS")
+
+
+def receive() -> Optional[dict]:
+    return radio.inbound.get()
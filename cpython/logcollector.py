@@ -0,0 +1,218 @@
+"""
+logcollector.py collects the log messages that the MicroPython app on the local XBee sends as User Data Relay
+frames (see UserDataRelayLogger and BufferedUserDataRelayLogger in upython/demo/bundle_demo.py) and writes them,
+one timestamped line per message, into a set of rotating log files.
+
+Example usage: python logcollector.py --port /dev/ttyUSB0 --baud 115200 --dir logs
+
+Each CSXB_MSG_LOG frame (UserDataRelayLogger) is the packet type followed by one message. Each CSXB_MSG_LOG_STREAM
+frame (BufferedUserDataRelayLogger) is the packet type followed by a chunk of a text stream of newline-terminated
+messages: that logger packs several messages into a frame and may split a message across frames, so the collector
+joins the chunks back together and only writes complete lines.
+
+Performance notes: xbee-python's reader thread only appends each frame to a bounded deque (oldest dropped first,
+and counted), and a writer thread turns them into lines and writes them in batches through one buffered file,
+so bursts of thousands of frames per second don't hold up the serial port reader. Files are named the way
+logging.handlers.RotatingFileHandler names them: xbee_log.txt is the current one, then xbee_log.txt.1, .2, etc.
+"""
+
+import argparse
+import collections
+import os
+import sys
+import threading
+import time
+from typing import Optional
+
+from digi.xbee.devices import XBeeDevice
+
+from xbf.cpython.core import Error, Success, OpenXBeeDevice, log
+
+# Caution: Ensure that these match the redundant definitions in upython/demo/bundle_demo.py.
+CSXB_MSG_LOG = 0x00
+CSXB_MSG_LOG_STREAM = 0x14
+
+MAX_LINE_SIZE = 4096  # A partial line that grows beyond this is written out as is rather than buffered forever.
+QUEUE_SIZE = 65536
+
+
+class RotatingFile:
+    """ RotatingFile appends to path and, once it reaches max_bytes, rotates it to path.1 (keeping backup_count). """
+
+    def __init__(self, path: str, max_bytes: int = 5 * 1024 * 1024, backup_count: int = 5):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.rotations = 0
+        self._file = open(path, "ab")
+        self._size = self._file.tell()
+
+    def write(self, data: bytes) -> None:
+        if self._size > 0 and self._size + len(data) > self.max_bytes:
+            self.rotate()
+        self._file.write(data)
+        self._size += len(data)
+
+    def rotate(self) -> None:
+        self._file.close()
+        for i in range(self.backup_count - 1, 0, -1):
+            older = "%s.%d" % (self.path, i)
+            if os.path.exists(older):
+                os.replace(older, "%s.%d" % (self.path, i + 1))
+        if self.backup_count > 0:
+            os.replace(self.path, self.path + ".1")
+        else:
+            os.remove(self.path)
+        self._file = open(self.path, "ab")
+        self._size = 0
+        self.rotations += 1
+
+    def flush(self) -> None:
+        self._file.flush()
+
+    def close(self) -> None:
+        self._file.close()
+
+
+class LogCollector:
+    """
+    LogCollector turns CSXB_MSG_LOG and CSXB_MSG_LOG_STREAM frames into lines in a RotatingFile.
+    handle() processes one frame synchronously; start() instead hooks the collector up to an opened xbee-python
+    device and processes frames on a writer thread until close().
+    """
+
+    def __init__(self, file: RotatingFile, clock=time.time, queue_size: int = QUEUE_SIZE,
+                 flush_interval_sec: float = 0.5):
+        self.file = file
+        self.clock = clock
+        self.flush_interval_sec = flush_interval_sec
+        self._partial = bytearray()
+        self._queue = collections.deque(maxlen=queue_size)
+        self._wakeup = threading.Event()
+        self._closed = False
+        self._device = None
+        self._thread: Optional[threading.Thread] = None
+        self._stats = {"frames": 0, "lines": 0, "bytes": 0, "other_frames": 0, "dropped_frames": 0}
+
+    def stats(self) -> dict:
+        return dict(self._stats, rotations=self.file.rotations, queued=len(self._queue))
+
+    def handle(self, data: bytes) -> bool:
+        """ handle processes one relay frame. Returns False if it isn't a log frame. """
+        if len(data) == 0 or data[0] not in (CSXB_MSG_LOG, CSXB_MSG_LOG_STREAM):
+            self._stats["other_frames"] += 1
+            return False
+        self._stats["frames"] += 1
+        text = data[1:]
+        if data[0] == CSXB_MSG_LOG:
+            self._write_lines(bytes(text).split(b"\n"))  # One whole message, which may span several lines.
+            return True
+        self._partial += text
+        if b"\n" not in text:
+            if len(self._partial) > MAX_LINE_SIZE:
+                self._write_lines([bytes(self._partial)])
+                self._partial.clear()
+            return True
+        lines = self._partial.split(b"\n")
+        self._partial = bytearray(lines.pop())
+        self._write_lines(lines)
+        return True
+
+    def start(self, device) -> None:
+        """ start collects the log frames that the opened xbee-python device receives, until close(). """
+        self._device = device
+        device.add_user_data_relay_received_callback(self._on_relay_received)
+        self._thread = threading.Thread(target=self._write_loop, name="LogCollector", daemon=True)
+        self._thread.start()
+
+    def close(self) -> None:
+        if self._device is not None:
+            self._device.del_user_data_relay_received_callback(self._on_relay_received)
+            self._device = None
+        self._closed = True
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._drain()
+        if self._partial:
+            self._write_lines([bytes(self._partial)])
+            self._partial.clear()
+        self.file.close()
+
+    # ---- Internals ----
+
+    def _on_relay_received(self, message) -> None:
+        if len(self._queue) == self._queue.maxlen:
+            self._stats["dropped_frames"] += 1
+        self._queue.append(bytes(message.data))
+        self._wakeup.set()
+
+    def _write_loop(self) -> None:
+        while not self._closed:
+            self._wakeup.wait(self.flush_interval_sec)
+            self._wakeup.clear()
+            self._drain()
+            self.file.flush()
+
+    def _drain(self) -> None:
+        while True:
+            try:
+                data = self._queue.popleft()
+            except IndexError:
+                return
+            self.handle(data)
+
+    def _write_lines(self, lines) -> None:
+        now = self.clock()
+        stamp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(now)).encode() + b".%03d: " % (now % 1 * 1000)
+        for line in lines:
+            self.file.write(stamp + line.rstrip(b"\r") + b"\n")
+            self._stats["bytes"] += len(line)
+        self._stats["lines"] += len(lines)
+
+
+def parse_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="logcollector.py writes the local XBee app's log messages to files.")
+    parser.add_argument("--port", required=True, type=str,
+                        help="Serial port name (e.g., /dev/ttyUSB0).")
+    parser.add_argument("--baud", required=True, type=int,
+                        help="Serial port baud rate (e.g., 115200).")
+    parser.add_argument("--dir", required=False, type=str, default="logs",
+                        help="Directory for the log files.")
+    parser.add_argument("--file", required=False, type=str, default="xbee_log.txt",
+                        help="Name of the current log file.")
+    parser.add_argument("--max-file-size", required=False, type=int, default=5 * 1024 * 1024,
+                        help="Size in bytes at which the log file is rotated.")
+    parser.add_argument("--max-num-files", required=False, type=int, default=5,
+                        help="Number of rotated log files to keep.")
+    return parser.parse_args()
+
+
+def main() -> Error:
+    args = parse_arguments()
+    try:
+        os.makedirs(args.dir, exist_ok=True)
+        file = RotatingFile(os.path.join(args.dir, args.file), args.max_file_size, args.max_num_files)
+    except OSError as ex:
+        log("Error: Unable to open the log file. Details: %s" % ex)
+        return Error()
+
+    # broker=False because the broker doesn't forward User Data Relay frames.
+    with OpenXBeeDevice(xbee=XBeeDevice(port=args.port, baud_rate=args.baud), broker=False) as xbee:
+        collector = LogCollector(file)
+        collector.start(xbee)
+        try:
+            while True:
+                time.sleep(10)
+                log("Log collector stats: %s" % collector.stats())
+        except KeyboardInterrupt:
+            pass
+        finally:
+            collector.close()
+    return Success
+
+
+if __name__ == "__main__":
+    exit_status = main()
+    sys.exit(0 if exit_status is Success else 1)
@@ -7,9 +7,11 @@ import sys
 
 from digi.xbee.devices import Raw802Device
 
+from xbf.cpython.broker import broker_is_listening, broker_socket_path
 from xbf.cpython.core import Error, Success
 from xbf.cpython.core import ensure_api_mode, restore_mode, OpenXBeeDevice
-from xbf.cpython.core import log, build_mpy, ensure_running_latest_micropython_app
+from xbf.cpython.core import log, build_mpy, check_lazy_modules, expected_bundle_hashes
+from xbf.cpython.core import ensure_running_latest_micropython_app
 
 
 SRC_DIRS = ["upython", "deps/xbf/upython"]
@@ -86,18 +88,33 @@ def main() -> Error:
         if err:
             log("Failed to build .mpy files. Details: %s" % err)
             return Error()
+        err = check_lazy_modules(src_dirs=SRC_DIRS, build_dir=BUILD_DIR)
+        if err:
+            log("Lazy module check failed. Details: %s" % err)
+            return Error()
         log("Build .mpy files succeeded.")
 
     if args.deploy:
         log("Deploying .mpy files...")
 
+        # Deploying needs the serial port itself: the broker doesn't forward the file system (ATFS) traffic.
+        socket_path = broker_socket_path(args.port)
+        if broker_is_listening(socket_path):
+            log("Error: An XBee broker owns %s (see %s). Stop the broker before deploying." % (args.port, socket_path))
+            return Error()
+
+        bundle_hashes, err = expected_bundle_hashes(src_dirs=SRC_DIRS, build_dir=BUILD_DIR)
+        if err:
+            log("Error: Failed to compute the bundle hash. Details: %s" % err)
+            return Error()
+
         original_mode, err = ensure_api_mode(port=args.port, baud_rate=args.baud)
         if err:
             log("Error: Failed to enter API Mode! Details: %s" % err)
             return Error()
 
-        with OpenXBeeDevice(xbee=Raw802Device(port=args.port, baud_rate=args.baud)) as xbee:
-            err = ensure_running_latest_micropython_app(build_dir=BUILD_DIR, xbee=xbee)
+        with OpenXBeeDevice(xbee=Raw802Device(port=args.port, baud_rate=args.baud), broker=False) as xbee:
+            err = ensure_running_latest_micropython_app(build_dir=BUILD_DIR, xbee=xbee, bundle_hashes=bundle_hashes)
             if err:
                 log("Error: Failed to deploy .mpy files. Details: %s" % err)
                 return Error()
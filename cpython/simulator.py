@@ -0,0 +1,333 @@
+"""
+simulator.py runs a fleet of virtual XBee nodes in one CPython process, each node running unmodified device code.
+
+Every node gets private copies of the fakes in cpython/fakes (xbee, utime, uos, machine, umachine) plus private
+copies of any app modules it imports, so module-level state never leaks between nodes. Each node's app runs on its own
+thread, but only one node runs at a time: a node runs until it calls utime.sleep_ms() (or sleep_us()/sleep()),
+at which point the scheduler advances the shared virtual clock to the earliest pending wakeup and resumes that
+node. This is a discrete-event simulation, so an hour of fleet behavior takes only as long as the nodes' own CPU work.
+
+xbee.transmit() on one node is routed to xbee.receive() on the destination node(s) by 64-bit address.
+xbee.ADDR_COORDINATOR reaches the coordinator node and xbee.ADDR_BROADCAST reaches every other node.
+Each node's radio channels take an xbee.LinkModel, so coordinator bottlenecks show up as in-flight backlog,
+queue overflows and drops in stats().
+
+Example:
+    sim = Simulator()
+    sim.add_node("coordinator.py", coordinator=True)
+    for _ in range(200):
+        sim.add_node("main.py", link=LinkModel(latency_ms=30, bytes_per_sec=25000))
+    sim.run(3600 * 1000)
+    print(sim.stats())
+    sim.close()
+
+An app that restarts the MicroPython interpreter (e.g., by calling uos.bundle()) starts over from the top,
+with its own modules forgotten but its flash filesystem and xbee registers intact, just like on the device.
+
+Caution: a node must sleep in order to yield to the others. A node that spins in a loop without calling
+utime.sleep_ms() stalls the whole simulation, just as it would starve the REPL on the device.
+"""
+
+import heapq
+import importlib.util
+import os
+import sys
+import threading
+import traceback
+import types
+from typing import Optional
+
+FAKES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fakes")
+
+# Fakes that get a private copy per node, in dependency order (xbee, uos and machine import utime; umachine imports
+# machine).
+PER_NODE_FAKES = ("utime", "xbee", "uos", "machine", "umachine")
+
+
+class NodeStopped(BaseException):
+    """
+    NodeStopped is raised inside a node's sleep call when the simulation is closed. It derives from BaseException
+    so that device code's "except Exception" handlers do not swallow it.
+    """
+    pass
+
+
+def _load_fake(name: str) -> types.ModuleType:
+    """ _load_fake returns a brand new module object for the given fake, independent of any previous copies. """
+    spec = importlib.util.spec_from_file_location(name, os.path.join(FAKES_DIR, name + ".py"))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module  # Lets the fakes loaded after this one import this copy.
+    spec.loader.exec_module(module)
+    return module
+
+
+class Node:
+    """ Node is one virtual XBee: its address, its private modules, and the thread running its app. """
+
+    def __init__(self, sim: "Simulator", app_path: str, eui64: bytes, coordinator: bool):
+        self.sim = sim
+        self.app_path = app_path
+        self.eui64 = eui64
+        self.coordinator = coordinator
+        self.modules = {}  # Module name -> this node's private module object.
+        self.app = None  # The app's module (what the device would call __main__), once it has started.
+        self.error = None  # Stack trace if the app raised an exception.
+        self.finished = False
+        self.wakeups = 0
+        self.restarts = 0  # Number of times the app restarted the interpreter (e.g., with uos.bundle()).
+        self._go = threading.Semaphore(0)
+        self._thread = threading.Thread(target=self._thread_main, name="node-%s" % eui64.hex(), daemon=True)
+
+    def __repr__(self):
+        return "Node(eui64=%s, coordinator=%s, app_path=%s)" % (self.eui64.hex(), self.coordinator, self.app_path)
+
+    @property
+    def xbee(self) -> types.ModuleType:
+        return self.modules["xbee"]
+
+    def _thread_main(self) -> None:
+        self._go.acquire()
+        try:
+            if self.sim._stopping:
+                raise NodeStopped()
+            with open(self.app_path, "r") as f:
+                code = compile(f.read(), self.app_path, "exec")
+            while True:
+                self.app = types.ModuleType("__main__")
+                self.app.__file__ = self.app_path
+                try:
+                    exec(code, self.app.__dict__)
+                    break
+                except self.modules["uos"].InterpreterRestart:
+                    self._restart_interpreter()
+        except NodeStopped:
+            pass
+        except BaseException:
+            self.error = traceback.format_exc()
+        self.finished = True
+        self.sim._yielded.release()
+
+    def _restart_interpreter(self) -> None:
+        """ _restart_interpreter forgets the app's own modules, so that they are imported afresh on the next run. """
+        self.restarts += 1
+        for name in list(self.modules):
+            if name not in PER_NODE_FAKES:
+                del self.modules[name]
+                sys.modules.pop(name, None)
+
+    def _sleep_us(self, us: int) -> None:
+        """ _sleep_us runs on the node's thread: hand control back to the scheduler until the wakeup time. """
+        self.sim._schedule(self, self.sim.clock.now_us + max(0, int(us)))
+        self.sim._yielded.release()
+        self._go.acquire()
+        if self.sim._stopping:
+            raise NodeStopped()
+
+
+class Simulator:
+    """ Simulator owns the shared virtual clock, the scheduler, the mesh routing table and the nodes. """
+
+    def __init__(self, start_ms: int = 0):
+        self._isolated = set(PER_NODE_FAKES)  # Names of every module that is private per node.
+        self._saved = {}  # The host's own entries for those names, restored whenever the scheduler returns.
+        self._baseline = set()  # Every module name the host had loaded before the current step.
+        self._save_sys_modules()
+        self.clock = _load_fake("utime").VirtualClock(start_ms=start_ms)
+        self._restore_sys_modules()
+        self.nodes = []
+        self.by_address = {}
+        self.coordinator = None
+        self._heap = []  # (wake_time_us, sequence, node)
+        self._sequence = 0
+        self._yielded = threading.Semaphore(0)
+        self._stopping = False
+        self._in_flight = set()  # Nodes whose outbound radio channel still holds undelivered messages.
+        self.routed = 0
+        self.unroutable = 0
+
+    def add_node(self, app_path: str, eui64: Optional[bytes] = None, coordinator: bool = False,
+                 link=None, outbound_link=None) -> Node:
+        """
+        add_node creates a node that will run the given app file. The optional xbee.LinkModel(s) shape the node's
+        receive (and transmit) path. The node starts running on the first call to run().
+        """
+        if eui64 is None:
+            eui64 = (0x0013A20000000000 + len(self.nodes) + 1).to_bytes(8, "big")
+        if eui64 in self.by_address:
+            raise ValueError("Duplicate node address %s" % eui64.hex())
+        if coordinator and self.coordinator is not None:
+            raise ValueError("Only one coordinator is allowed")
+
+        node = Node(self, app_path, eui64, coordinator)
+        self._save_sys_modules()
+        for name in PER_NODE_FAKES:
+            node.modules[name] = _load_fake(name)
+        self._restore_sys_modules()
+
+        node_clock = _NodeClock(self.clock, node)
+        node.modules["utime"].use_virtual_clock(node_clock)
+        node.modules["umachine"].unique_id = lambda: eui64
+        registers = node.modules["xbee"]._registers
+        registers["SH"] = int.from_bytes(eui64[:4], "big")
+        registers["SL"] = int.from_bytes(eui64[4:], "big")
+        registers["CE"] = 1 if coordinator else 0
+        if link is not None:
+            node.xbee.radio.set_link(link, outbound_link)
+
+        self.nodes.append(node)
+        self.by_address[eui64] = node
+        if coordinator:
+            self.coordinator = node
+        self._schedule(node, self.clock.now_us)
+        node._thread.start()
+        return node
+
+    def run(self, duration_ms: int) -> None:
+        """ run advances the simulation by the given amount of virtual time, stepping nodes cooperatively. """
+        end_us = self.clock.now_us + duration_ms * 1000
+        self._save_sys_modules()
+        # The app's directory plays the role of /flash, from which the device imports the app's other modules.
+        app_dirs = [d for d in {os.path.dirname(os.path.abspath(n.app_path)) for n in self.nodes} if d not in sys.path]
+        sys.path[0:0] = app_dirs
+        try:
+            while self._heap and self._heap[0][0] <= end_us:
+                wake_us, _, node = heapq.heappop(self._heap)
+                if wake_us > self.clock.now_us:
+                    self.clock.now_us = wake_us
+                self._step(node)
+                self._route(node)
+                for sender in list(self._in_flight):
+                    self._route(sender)
+            if self.clock.now_us < end_us:
+                self.clock.now_us = end_us
+            for sender in list(self._in_flight):
+                self._route(sender)
+        finally:
+            for d in app_dirs:
+                sys.path.remove(d)
+            self._restore_sys_modules()
+
+    def close(self) -> None:
+        """ close terminates every node's app by raising NodeStopped inside its pending sleep call. """
+        self._stopping = True
+        self._save_sys_modules()
+        try:
+            for node in self.nodes:
+                if not node.finished:
+                    self._step(node)
+        finally:
+            self._restore_sys_modules()
+        self._heap.clear()
+
+    def stats(self) -> dict:
+        """ stats summarizes traffic per node (keyed by hex address) and for the mesh as a whole. """
+        nodes = {}
+        for node in self.nodes:
+            nodes[node.eui64.hex()] = {
+                "coordinator": node.coordinator,
+                "wakeups": node.wakeups,
+                "restarts": node.restarts,
+                "finished": node.finished,
+                "error": node.error,
+                "transmit": node.xbee.radio.outbound.stats(),
+                "receive": node.xbee.radio.inbound.stats(),
+            }
+        return {"now_ms": self.clock.now_us // 1000, "routed": self.routed, "unroutable": self.unroutable,
+                "nodes": nodes}
+
+    def _schedule(self, node: Node, wake_us: int) -> None:
+        self._sequence += 1
+        heapq.heappush(self._heap, (wake_us, self._sequence, node))
+
+    def _step(self, node: Node) -> None:
+        """ _step lets the node run until it sleeps or finishes. Only one node ever runs at a time. """
+        self._switch_modules(node)
+        num_modules = len(sys.modules)
+        node.wakeups += 1
+        node._go.release()
+        self._yielded.acquire()
+        if len(sys.modules) == num_modules:
+            return
+        # Adopt any modules the app imported during this step (e.g., its own helpers) as private to this node.
+        for name, module in list(sys.modules.items()):
+            if name not in self._isolated and name not in self._baseline:
+                self._isolated.add(name)
+            if name in self._isolated and name not in node.modules:
+                node.modules[name] = module
+
+    def _switch_modules(self, node: Node) -> None:
+        for name in self._isolated:
+            module = node.modules.get(name)
+            if module is None:
+                sys.modules.pop(name, None)
+            else:
+                sys.modules[name] = module
+
+    def _save_sys_modules(self) -> None:
+        self._baseline = set(sys.modules)
+        self._saved = {name: sys.modules.get(name) for name in self._isolated}
+
+    def _restore_sys_modules(self) -> None:
+        for name in self._isolated:
+            module = self._saved.get(name)
+            if module is None:
+                sys.modules.pop(name, None)
+            else:
+                sys.modules[name] = module
+
+    def _route(self, sender: Node) -> None:
+        """ _route moves the sender's delivered transmissions into the destination nodes' receive channels. """
+        radio = sender.xbee.radio
+        message = radio.pop_transmitted()
+        while message is not None:
+            dest = message["dest"]
+            if dest == sender.xbee.ADDR_BROADCAST:
+                for node in self.nodes:
+                    if node is not sender:
+                        node.xbee.radio.inject(sender.eui64, message["payload"], broadcast=True)
+                self.routed += 1
+            else:
+                node = self.coordinator if dest == sender.xbee.ADDR_COORDINATOR else self.by_address.get(dest)
+                if node is None:
+                    self.unroutable += 1
+                else:
+                    node.xbee.radio.inject(sender.eui64, message["payload"])
+                    self.routed += 1
+            message = radio.pop_transmitted()
+        if len(radio.outbound):
+            self._in_flight.add(sender)
+        else:
+            self._in_flight.discard(sender)
+
+
+class _NodeClock:
+    """
+    _NodeClock is what a node's private utime module sees: it reads the shared virtual clock,
+    but sleeping yields to the scheduler instead of advancing the clock directly.
+    """
+
+    def __init__(self, shared, node: Node):
+        self._shared = shared
+        self._node = node
+
+    def sleep_us(self, us: int) -> None:
+        self._node._sleep_us(us)
+
+    def advance_us(self, us: int) -> None:
+        self._node._sleep_us(us)
+
+    def advance_ms(self, ms: int) -> None:
+        self._node._sleep_us(ms * 1000)
+
+    @property
+    def now_us(self) -> int:
+        return self._shared.now_us
+
+    def ticks_us(self) -> int:
+        return self._shared.ticks_us()
+
+    def ticks_ms(self) -> int:
+        return self._shared.ticks_ms()
+
+    def time(self) -> float:
+        return self._shared.time()
@@ -1,15 +1,68 @@
 # test.py contains unit tests.
 
+import contextlib
+import importlib
+import importlib.util
+import io
+import os
+import random
+import shutil
+import socket
+import ssl
+import subprocess
 import sys
+import tempfile
+import threading
+import time
 import unittest
+import unittest.mock
 
-from xbf.upython.core import ButtonBuffer
+from digi.xbee.devices import Raw802Device, XBeeDevice
+import serial
+import machine
+import micropython
+import ugc
+import uos
+import uselect
+import usocket
+import ussl
+import utime
+import xbee
+
+from xbf.upython.core import ButtonBuffer, MultiButtonBuffer, PacketBuilder, invert
+from xbf.upython.demo import bundle_demo
+from xbf.upython import bootprof
 from xbf.upython.core import sequence_equal_or_more_recent, sequence_more_recent, MAX_SEQUENCE_NUMBER
+from xbf.upython.core import SequenceWindow, MAX_PACKET_SIZE
 
 # Your app would typically use the path 'xbf.cpython.core' to import these from the deps dir,
 # but since we're already inside the 'xbf' project, we can import relative to this project's
 # top-level dir (not deps), so we omit the 'xbf' below.
-from xbf.cpython.core import Error, Success, new_error, errorf
+from xbf.cpython.core import Error, Success, new_error, errorf, ensure_api_mode, restore_mode
+from xbf.cpython.core import check_lazy_modules, ensure_running_latest_micropython_app, expected_bundle_hashes
+from xbf.cpython.core import OpenXBeeDevice
+from xbf.cpython.coalesce import split_frame
+from xbf.cpython.adapters import xbee as xbee_adapter
+from xbf.cpython.bootprofile import BootProfileAssembler
+from xbf.cpython import bundlehash
+from xbf.cpython.broker import Broker, BrokerClient, broker_is_listening, encode_message, MAX_PENDING_EVENTS
+from xbf.cpython.broker import _Client as broker_client_state
+from xbf.cpython.emulator import Timing, XBeeEmulator, api_frame
+from xbf.cpython.logcollector import LogCollector, RotatingFile
+from xbf.cpython.simulator import Simulator
+from xbf.cpython.transport import Transport as HostTransport
+
+
+class HeapTestCase(unittest.TestCase):
+    """ HeapTestCase runs each test against an emulated device heap and records the test's peak heap usage. """
+
+    HEAP_SIZE = ugc.DEFAULT_HEAP_SIZE
+
+    def setUp(self):
+        ugc.start_heap(self.HEAP_SIZE, name=self.id())
+
+    def tearDown(self):
+        ugc.stop_heap()
 
 
 class TestErrors(unittest.TestCase):
@@ -23,7 +76,7 @@ class TestErrors(unittest.TestCase):
         self.assertEqual("test_errors: blah blah 7: test_errors: hello", y)
 
 
-class TestSequenceNumbers(unittest.TestCase):
+class TestSequenceNumbers(HeapTestCase):
 
     def test_basic(self):
         self.assertEqual(65535, MAX_SEQUENCE_NUMBER)  # These tests assume a 16-bit sequence number.
@@ -53,7 +106,79 @@ class TestSequenceNumbers(unittest.TestCase):
         self.assertFalse(sequence_equal_or_more_recent(1, 9, max_sequence_number=20))
 
 
-class TestButtonBuffer(unittest.TestCase):
+class TestSequenceWindow(HeapTestCase):
+
+    def test_accept(self):
+        w = SequenceWindow(window=8)
+        self.assertEqual(SequenceWindow.NEW, w.accept(b"a", MAX_SEQUENCE_NUMBER - 1))
+        self.assertEqual(SequenceWindow.NEW, w.accept(b"a", MAX_SEQUENCE_NUMBER))
+        self.assertEqual(SequenceWindow.GAP, w.accept(b"a", 2))  # Wrapped around, skipping 0 and 1.
+        self.assertEqual(SequenceWindow.DUPLICATE, w.accept(b"a", 2))
+        self.assertEqual(SequenceWindow.LATE, w.accept(b"a", 0))
+        self.assertEqual(SequenceWindow.DUPLICATE, w.accept(b"a", 0))
+        self.assertEqual(SequenceWindow.DUPLICATE, w.accept(b"a", MAX_SEQUENCE_NUMBER))
+        self.assertEqual(SequenceWindow.NEW, w.accept(b"b", 0))  # Senders are independent.
+        self.assertEqual(SequenceWindow.GAP, w.accept(b"a", 100))
+        self.assertEqual(SequenceWindow.STALE, w.accept(b"a", 1))
+
+        stats = w.stats(b"a")
+        self.assertEqual(5, stats["received"])
+        self.assertEqual(3, stats["duplicates"])
+        self.assertEqual(1 + 97, stats["lost"])
+        self.assertEqual(1, stats["late"])
+        self.assertEqual(1, stats["stale"])
+        self.assertEqual(6, w.stats()["received"])
+        self.assertEqual(2, len(w))
+
+    def test_reordered_at_start(self):
+        w = SequenceWindow(window=8)
+        self.assertEqual(SequenceWindow.NEW, w.accept(b"a", 5))
+        self.assertEqual(SequenceWindow.LATE, w.accept(b"a", 4))  # Older than the first frame: nothing was lost.
+        self.assertEqual(0, w.stats()["lost"])
+        self.assertEqual(SequenceWindow.LATE, w.accept(b"a", 1))  # 2 and 3 are now missing.
+        self.assertEqual(2, w.stats()["lost"])
+        self.assertEqual(SequenceWindow.LATE, w.accept(b"a", 3))
+        self.assertEqual(1, w.stats()["lost"])
+
+    def test_late_frame_after_many_frames(self):
+        # Once more than half the sequence space has gone by, the first frame seen looks more recent than the
+        # current ones, so it must no longer be mistaken for the start of the stream.
+        w = SequenceWindow()
+        for seq in range(40000):
+            if seq != 39990:
+                w.accept(b"a", seq % (MAX_SEQUENCE_NUMBER + 1))
+        self.assertEqual(1, w.stats()["lost"])
+        self.assertEqual(SequenceWindow.LATE, w.accept(b"a", 39990))
+        self.assertEqual(0, w.stats()["lost"])
+        self.assertEqual(0.0, w.stats()["loss_rate"])
+
+    def test_reorder(self):
+        delivered = []
+        w = SequenceWindow(reorder_size=2, deliver=lambda sender, seq, payload: delivered.append(payload))
+        for seq in (10, 12, 11, 11, 13, 15, 16, 17, 14, 18, 20):
+            w.push(b"a", seq, seq)
+        # 14 was given up on when 17 arrived (three frames held), so it was dropped when it finally came.
+        self.assertEqual([10, 11, 12, 13, 15, 16, 17, 18], delivered)
+        self.assertEqual(1, w.stats()["held"])
+        w.flush()
+        self.assertEqual(20, delivered[-1])
+        self.assertEqual(1, w.stats()["lost"])
+        self.assertEqual(1, w.stats()["duplicates"])
+
+    def test_many_senders(self):
+        for senders in (30, 2000):
+            if senders > 100:
+                ugc.stop_heap()  # Thousands of senders is the coordinator's job, on the host.
+            w = SequenceWindow(window=64)
+            for seq in range(50):
+                for sender in range(senders):
+                    if (seq + sender) % 10:  # Every sender loses one frame in ten.
+                        w.accept(sender, seq)
+            self.assertEqual(senders, len(w))
+            self.assertAlmostEqual(0.1, w.stats()["loss_rate"], delta=0.01)
+
+
+class TestButtonBuffer(HeapTestCase):
 
     def test_basic(self):
         bb = ButtonBuffer()
@@ -74,7 +199,1622 @@ class TestButtonBuffer(unittest.TestCase):
         assert 0xDEADBEEF == bb.get_uint32()
         assert b"\xDE\xAD\xBE\xEF" == bb.serialize()
 
+    def test_window_sizes(self):
+        for bits in ButtonBuffer.WINDOW_SIZES:
+            bb = ButtonBuffer(bits=bits)
+            for i in range(bits + 3):
+                bb.put(1 if i in (3, 4) else 0)
+            self.assertEqual(1, bb.get(bits - 1))
+            self.assertEqual(0, bb.get(bits))
+            self.assertEqual(bits // 8, len(bb.serialize()))
+            copy = ButtonBuffer(bits=bits)
+            self.assertIsNone(copy.deserialize(bb.serialize()))
+            self.assertEqual(bb.get_uint32(), copy.get_uint32())
+        self.assertEqual("ButtonBuffer(uint8=0x05)", repr(ButtonBuffer(0x105, bits=8)))
+        with self.assertRaises(ValueError):
+            ButtonBuffer(bits=24)
+
+    def test_transitions(self):
+        sender = ButtonBuffer(bits=128)
+        receiver = ButtonBuffer(bits=128)
+        acked = 0
+        sizes = []
+        for seq in range(1, 400):
+            sender.put(1 if 100 <= seq % 200 < 140 else 0)
+            if seq % 7 == 0:  # The receiver acknowledges every 7th frame, so each update covers 7 frames.
+                d = sender.encode_transitions(seq, acked)
+                sizes.append(len(d))
+                self.assertIsNone(receiver.put_transitions(d))
+                acked = seq
+                self.assertEqual(sender.get_uint32(), receiver.get_uint32())
+        self.assertEqual(1, min(sizes))
+        self.assertEqual(2, max(sizes))
+
+        d = sender.encode_transitions(5, 65530)  # Wraps around: frames 65531..5 are 11 frames.
+        self.assertEqual(10, d[0] & 0x7F)
+        self.assertEqual(127, sender.encode_transitions(1000, 1)[0] & 0x7F)  # Clamped to the window.
+        self.assertIsNotNone(receiver.put_transitions(b""))
+        self.assertIsNotNone(receiver.put_transitions(b"\x02\x03"))  # A 3-frame run in 3 frames isn't valid.
+
+
+class TestMultiButtonBuffer(HeapTestCase):
+
+    def test_matches_button_buffers(self):
+        channels = 12
+        mbb = MultiButtonBuffer(channels)
+        singles = [ButtonBuffer() for _ in range(channels)]
+        for frame in range(45):
+            bits = (frame * 0x9E3779B1) & 0xFFFF  # Sets bits above channel 11 too, which must be ignored.
+            mbb.put_all(bits)
+            for c in range(channels):
+                singles[c].put((bits >> c) & 1)
+        self.assertEqual(bits & 0x0FFF, mbb.get_all())
+        for c in range(channels):
+            self.assertEqual(singles[c].get_uint32(), mbb.channel(c).get_uint32())
+            self.assertEqual(singles[c].get(5), mbb.get(c, 5))
+        self.assertEqual(0, mbb.get(channels, 0))
+        self.assertEqual(0, mbb.get_all(32))
+
+    def test_serialize(self):
+        mbb = MultiButtonBuffer(16)
+        for frame in range(40):
+            mbb.put_all(frame | 0x8000)
+        d = mbb.serialize()
+        self.assertEqual(64, len(d))
+        self.assertEqual(b"\x08\x80", d[:2])  # Oldest remaining frame first, little endian.
+        self.assertEqual(b"\x27\x80", d[-2:])
+
+        copy = MultiButtonBuffer(16)
+        self.assertIsNotNone(copy.deserialize(d[:-1]))
+        self.assertIsNone(copy.deserialize(d))
+        self.assertEqual(d, copy.serialize())
+        self.assertEqual(mbb.get_all(3), copy.get_all(3))
+
+
+class TestPacketBuilder(HeapTestCase):
+
+    def test_serialize_into(self):
+        bb = ButtonBuffer(0xDEADBEEF)
+        buf = bytearray(8)
+        self.assertEqual(6, bb.serialize_into(buf, 2))
+        self.assertEqual(b"\x00\x00\xDE\xAD\xBE\xEF\x00\x00", buf)
+        copy = ButtonBuffer()
+        self.assertIsNotNone(copy.deserialize_from(buf, 5))
+        self.assertIsNone(copy.deserialize_from(buf, 2))
+        self.assertEqual(0xDEADBEEF, copy.get_uint32())
+
+        mbb = MultiButtonBuffer(8)
+        for frame in range(40):
+            mbb.put_all(frame)
+        buf = bytearray(33)
+        self.assertEqual(33, mbb.serialize_into(buf, 1))
+        self.assertEqual(mbb.serialize(), buf[1:])
+
+    def test_builder(self):
+        builder = PacketBuilder(8)
+        builder.put_u8(0x1FF)
+        builder.put_u16(0xABCD)
+        builder.put_button_buffer(ButtonBuffer(0x01020304))
+        self.assertEqual(b"\xFF\xAB\xCD\x01\x02\x03\x04", builder.packet())
+        with self.assertRaises(ValueError):
+            builder.put_u16(0)
+        builder.put_bytes(b"!")
+        self.assertEqual(8, len(builder.packet()))
+        builder.reset()
+        builder.put_bytes(b"hi")
+        self.assertEqual(b"hi", bytes(builder.packet()))
+
+    def test_steady_state_loop_does_not_allocate(self):
+        buttons = ButtonBuffer()
+        builder = PacketBuilder()
+        sent = [None]
+
+        def loop(frames):
+            for frame in range(frames):
+                buttons.put(frame & 1)
+                builder.reset()
+                builder.put_u8(1)
+                builder.put_u16(frame)
+                builder.put_button_buffer(buttons)
+                sent[0] = builder.packet()
+
+        loop(10)  # Warm up, e.g., the builder's view cache.
+        before = ugc.mem_alloc()
+        loop(1)
+        one_frame = ugc.mem_alloc() - before
+        loop(1000)
+        self.assertLessEqual(ugc.mem_alloc() - before, one_frame + 64)
+        # CPython ints never allocate here, but MicroPython's do beyond 30 bits: check that nothing gets that big.
+        for bits in ButtonBuffer.WINDOW_SIZES:
+            bb = ButtonBuffer(bits=bits)
+            for _ in range(bits):
+                bb.put(1)
+            self.assertEqual((1 << bits) - 1, bb.get_uint32())
+            self.assertLess(max(bb._words), 1 << 16)
+
+    def test_put_u32_masks(self):
+        builder = PacketBuilder(4)
+        builder.put_u32(0x123456789)
+        self.assertEqual(b"\x23\x45\x67\x89", builder.packet())
+
+
+@unittest.skipUnless(importlib.util.find_spec("numpy"), "needs numpy, which only the host-side analytics use")
+class TestAnalytics(unittest.TestCase):
+
+    def test_sequence_comparison_matches_core(self):
+        import numpy as np
+        from xbf.cpython import analytics
+        rng = np.random.default_rng(1)
+        s1 = rng.integers(0, MAX_SEQUENCE_NUMBER + 1, 5000)
+        s2 = np.concatenate([rng.integers(0, MAX_SEQUENCE_NUMBER + 1, 4000),
+                             (s1[4000:] + np.arange(-500, 500)) % (MAX_SEQUENCE_NUMBER + 1)])
+        s2[:4] = [0, 32767, 32768, 65535]  # The boundaries of the half-range test.
+        s1[:4] = [32768, 0, 0, 32767]
+        more = analytics.sequence_more_recent(s1, s2)
+        equal_or_more = analytics.sequence_equal_or_more_recent(s1, s2)
+        for a, b, m, e in zip(s1.tolist(), s2.tolist(), more.tolist(), equal_or_more.tolist()):
+            self.assertEqual(sequence_more_recent(a, b), m, (a, b))
+            self.assertEqual(sequence_equal_or_more_recent(a, b), e, (a, b))
+
+    def test_loss_stats_match_sequence_window(self):
+        import numpy as np
+        from xbf.cpython import analytics
+        rng = np.random.default_rng(2)
+        seqs = (np.arange(65000, 65000 + 3000) % (MAX_SEQUENCE_NUMBER + 1))
+        seqs = seqs[rng.random(seqs.size) > 0.05]  # 5% loss...
+        swaps = rng.integers(1, seqs.size - 1, 100)
+        seqs[swaps], seqs[swaps + 1] = seqs[swaps + 1], seqs[swaps].copy()  # ...some reordering...
+        seqs = np.insert(seqs, rng.integers(0, seqs.size, 50), seqs[rng.integers(0, seqs.size, 50)])  # ...and repeats.
+        seqs = seqs[(seqs != 65001) & (seqs != 65002)]
+        seqs[:2] = seqs[1::-1]  # Out of order from the very start.
+
+        window = SequenceWindow(window=4096)
+        for seq in seqs.tolist():
+            window.accept(b"a", seq)
+        expected = window.stats()
+        stats = analytics.loss_stats(seqs)
+        for key in ("received", "duplicates", "lost", "late", "loss_rate"):
+            self.assertEqual(expected[key], stats[key], key)
+
+        unwrapped = analytics.unwrap(seqs)
+        self.assertTrue(np.array_equal(seqs, unwrapped % (MAX_SEQUENCE_NUMBER + 1)))
+        starts, lengths = analytics.gaps(seqs)
+        self.assertEqual(stats["lost"], lengths.sum())
+        self.assertEqual(stats["gaps"], starts.size)
+        self.assertIn(65001, starts.tolist())
+
+        per_sender = analytics.per_sender_loss_stats([1, 2, 1, 2, 1], [7, 0, 9, 65535, 8])
+        self.assertEqual({"received": 3, "duplicates": 0, "lost": 0, "late": 1, "gaps": 0, "loss_rate": 0.0},
+                         per_sender[1])
+        self.assertEqual(1, per_sender[2]["late"])
+
+    def test_button_history_matches_core(self):
+        import numpy as np
+        from xbf.cpython import analytics
+        rng = np.random.default_rng(3)
+        for bits in (8, 32, 128):
+            buffers = []
+            for _ in range(20):
+                bb = ButtonBuffer(bits=bits)
+                for value in rng.integers(0, 2, bits).tolist():
+                    bb.put(value)
+                buffers.append(bb)
+            history = analytics.button_history(b"".join(bytes(bb.serialize()) for bb in buffers), bits=bits)
+            expected = [[bb.get(d) for d in range(bits)] for bb in buffers]
+            self.assertEqual(expected, history.tolist())
+            if bits <= 64:
+                from_ints = analytics.button_history_from_ints([bb.get_uint32() for bb in buffers], bits=bits)
+                self.assertEqual(expected, from_ints.tolist())
+
+
+class TestHeap(unittest.TestCase):
+
+    def tearDown(self):
+        ugc.stop_heap()
+
+    def test_allocations_are_measured(self):
+        ugc.start_heap(64 * 1024)
+        free_before = ugc.mem_free()
+        data = [bytearray(100) for _ in range(50)]
+        self.assertGreater(free_before - ugc.mem_free(), 50 * 100)
+        del data
+        ugc.collect()
+        self.assertGreater(ugc.mem_peak(), 50 * 100)
+
+    def test_heap_ceiling(self):
+        ugc.start_heap(8 * 1024, name="ceiling")
+        data = []
+        with self.assertRaises(MemoryError):
+            for _ in range(1000):
+                data.append(bytearray(100))
+        self.assertLess(len(data), 100)
+        del data[:]
+        ugc.collect()  # Back under budget, so this doesn't raise, and the ceiling is enforced again.
+        self.assertGreater(ugc.stop_heap(), 8 * 1024)
+        self.assertGreater(ugc.peaks["ceiling"], 8 * 1024)
+
+    def test_default_is_unlimited(self):
+        self.assertEqual(0, ugc.mem_free())
+        self.assertEqual(0, ugc.mem_alloc())
+        data = bytearray(ugc.DEFAULT_HEAP_SIZE * 4)  # Without start_heap(), nothing enforces a ceiling.
+        self.assertEqual(0, ugc.mem_peak())
+        self.assertIsNone(ugc.collect())
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            micropython.mem_info()
+        self.assertIn("GC: total: 64000, used: 3296, free: 60704", out.getvalue())  # The canned numbers.
+        del data
+
+
+def _tcp_pair():
+    """ _tcp_pair returns a connected (client, server) pair of usocket sockets over the loopback interface. """
+    listener = usocket.socket()
+    listener.setsockopt(usocket.SOL_SOCKET, usocket.SO_REUSEADDR, 1)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(1)
+    client = usocket.socket()
+    client.connect(listener.sock.getsockname())
+    server, _ = listener.accept()
+    listener.close()
+    return client, server
+
+
+class TestNonBlockingSockets(unittest.TestCase):
+
+    def test_poll_driven_echo(self):
+        client, server = _tcp_pair()
+        client.setblocking(False)
+        server.setblocking(False)
+
+        poller = uselect.poll()
+        poller.register(server, uselect.POLLIN)
+        self.assertEqual([], poller.poll(0))
+        self.assertIsNone(server.read(10))
+        self.assertIsNone(server.readline())
+
+        client.write(b"hello\nwor")
+        self.assertEqual([(server, uselect.POLLIN)], poller.poll(1000))
+        stream = server.makefile("rwb")
+        self.assertEqual(b"hello\n", stream.readline())
+        self.assertEqual(b"wor", stream.readline())  # Partial line; the rest hasn't arrived yet.
+
+        client.write(memoryview(b"ld!xyz"), 3)
+        buf = bytearray(8)
+        self.assertEqual([(server, uselect.POLLIN)], list(poller.ipoll(1000, 1)))
+        self.assertEqual([], poller.poll(0))  # One-shot: the mask is 0 until modify().
+        self.assertEqual(2, server.readinto(buf, 2))
+        self.assertEqual(b"ld", bytes(buf[:2]))
+        poller.modify(server, uselect.POLLIN | uselect.POLLOUT)
+        self.assertEqual([(server, uselect.POLLIN | uselect.POLLOUT)], poller.poll(1000))
+        self.assertEqual(b"!", server.read())
+
+        client.close()
+        self.assertEqual(b"", server.read(10))  # EOF, not None.
+        poller.unregister(server)
+        self.assertRaises(OSError, poller.modify, server, uselect.POLLIN)
+        server.close()
+
+    def test_zero_copy_streaming(self):
+        client, server = _tcp_pair()
+        payload = memoryview(bytearray(range(256)) * 4)
+        buf = bytearray(len(payload))
+        view = memoryview(buf)
+        ugc.start_heap(64 * 1024)
+        for _ in range(256):  # 256 KB through preallocated buffers.
+            sent = 0
+            while sent < 1000:
+                sent += client.write(payload[sent:], 1000 - sent)
+            received = 0
+            while received < 1000:
+                received += server.readinto(view[received:], 1000 - received)
+        peak = ugc.stop_heap()
+        self.assertEqual(payload[:1000], buf[:1000])
+        self.assertLess(peak, 2048)  # Nothing proportional to the data streamed.
+        client.close()
+        server.close()
+
+
+@unittest.skipIf(shutil.which("openssl") is None, "needs the openssl command to make a test certificate")
+class TestTLSSessionReuse(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cert = os.path.join(self.tmpdir, "cert.pem")
+        self.key = os.path.join(self.tmpdir, "key.pem")
+        subprocess.run(["openssl", "req", "-x509", "-newkey", "ec", "-pkeyopt", "ec_paramgen_curve:prime256v1",
+                        "-nodes", "-keyout", self.key, "-out", self.cert, "-days", "1", "-subj", "/CN=localhost"],
+                       check=True, capture_output=True)
+        ussl.clear_caches()
+        ussl.reset_stats()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _serve(self, listener, count):
+        # A local stand-in broker that echoes one message per connection.
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(self.cert, self.key)
+        for _ in range(count):
+            conn, _ = listener.accept()
+            with context.wrap_socket(conn, server_side=True) as tls:
+                tls.sendall(tls.recv(100))
+
+    def test_session_resumption(self):
+        listener = usocket.socket()
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(5)
+        thread = threading.Thread(target=self._serve, args=(listener.sock, 5), daemon=True)
+        thread.start()
+
+        for _ in range(5):
+            self._ping(listener.sock.getsockname(), self.cert)
+        thread.join()
+        listener.close()
+
+        stats = ussl.stats()
+        self.assertEqual(1, stats["contexts"])
+        self.assertEqual(5, stats["handshakes"])
+        self.assertEqual(4, stats["resumed"])
+        self.assertGreater(stats["mean_handshake_ms"], 0.0)
+
+    def test_sessions_are_per_context(self):
+        listener = usocket.socket()
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(5)
+        thread = threading.Thread(target=self._serve, args=(listener.sock, 3), daemon=True)
+        thread.start()
+
+        other_cert = os.path.join(self.tmpdir, "other.pem")  # Same CA, but a different context.
+        shutil.copy(self.cert, other_cert)
+        self._ping(listener.sock.getsockname(), self.cert)
+        self._ping(listener.sock.getsockname(), other_cert)  # Mustn't offer the first context's session.
+        self._ping(listener.sock.getsockname(), self.cert)
+        thread.join()
+        listener.close()
+
+        stats = ussl.stats()
+        self.assertEqual(2, stats["contexts"])
+        self.assertEqual(3, stats["handshakes"])
+        self.assertEqual(1, stats["resumed"])
+
+    def _ping(self, address, ca_certs):
+        s = usocket.socket()
+        s.connect(address)
+        tls = ussl.wrap_socket(s, ca_certs=ca_certs, server_hostname="localhost")
+        tls.write(b"ping")
+        buf = bytearray(16)
+        self.assertEqual(4, tls.readinto(buf))
+        self.assertEqual(b"ping", bytes(buf[:4]))
+        tls.close()
+
+
+class _ListLogger:
+
+    def __init__(self):
+        self.lines = []
+
+    def print(self, msg):
+        self.lines.append(msg)
+
+    def flush(self):
+        pass
+
+
+class TestFlashFilesystem(unittest.TestCase):
+
+    def setUp(self):
+        uos.flash.reset()
+        xbee._registers.pop("KP", None)
+        self.clock = utime.use_virtual_clock()
+
+    def tearDown(self):
+        utime.use_wall_clock()
+        uos.flash.reset()
+        xbee._registers.pop("KP", None)
+
+    def test_listing_and_file_io(self):
+        with uos.mounted():
+            with open("small.txt", "w") as f:
+                f.write("hello world!")
+            with open("/flash/lib/blob.bin", "wb") as f:
+                f.write(bytes(100))
+            with open("/flash/small.txt") as f:
+                self.assertEqual("hello world!", f.read())
+        self.assertEqual([("cert", 0x4000, 0, 0), ("lib", 0x4000, 0, 0), ("small.txt", 0x8000, 0, 12)],
+                         list(uos.ilistdir("/flash")))
+        self.assertEqual(["blob.bin"], uos.listdir("lib"))
+        self.assertEqual(100, uos.stat("lib/blob.bin")[6])
+        uos.remove("/flash/small.txt")
+        self.assertRaises(OSError, uos.remove, "/flash/small.txt")
+        self.assertEqual(1, uos.flash.erases)
+
+    def test_bootstrap_bundles_once_and_costs_deterministic_time(self):
+        modules = ["components", "constants", "ugc", "umqtt"]
+        for name in modules:
+            uos.flash.files["/flash/%s.mpy" % name] = bytes(2048)
+        uos.flash.files["/flash/main.py"] = b"stale"
+        uos.flash.files["/flash/components.py"] = b"stale"
+        uos.flash.cost = uos.FlashCostModel(read_us_per_byte=1, erase_ms=30, bundle_ms_per_kb=50)
+
+        boots = 0
+        with uos.mounted():
+            while True:
+                boots += 1
+                try:
+                    bundle_demo.bootstrap(_ListLogger())
+                    break
+                except uos.InterpreterRestart:
+                    pass
+
+        self.assertEqual(2, boots)  # The first boot rebundles and restarts; the second finds the bundle current.
+        self.assertEqual(modules, uos.bundle())
+        self.assertEqual(["cert", "lib", "boot_state.txt"] + ["%s.mpy" % m for m in modules], uos.listdir("/flash"))
+        # Two .py erases, 8 KB bundled, and the 8 KB of .mpy files hashed on each boot.
+        self.assertEqual(2 * 30000 + 8 * 50000 + 2 * 8192, self.clock.now_us)
+
+    def test_bootstrap_fast_path(self):
+        modules = ["components", "constants", "ugc", "umqtt"]
+        for name in modules:
+            uos.flash.files["/flash/%s.mpy" % name] = bytes(2048)
+
+        def boot():
+            logger = _ListLogger()
+            start_us = self.clock.now_us
+            with uos.mounted():
+                while True:
+                    try:
+                        bundle_demo.bootstrap(logger)
+                        return self.clock.now_us - start_us, logger.lines
+                    except uos.InterpreterRestart:
+                        pass
+
+        boot()
+        uos.flash.cost = uos.FlashCostModel(read_us_per_byte=1, erase_ms=30, bundle_ms_per_kb=50)
+        took_us, lines = boot()
+        marker_size = len(uos.flash.files["/flash/boot_state.txt"])
+        self.assertEqual(marker_size, took_us)  # Only the marker is read. Nothing is hashed, erased or bundled.
+        self.assertEqual(["Boot state unchanged; skipping .py cleanup and bundle check."], lines)
+
+        uos.flash.files["/flash/constants.mpy"] = bytes(2049)  # A new build (of a different size) was deployed.
+        took_us, lines = boot()
+        self.assertGreater(took_us, 8 * 50000 + 2 * 8193 + 30000)  # Rebundled, and the marker was rewritten.
+        self.assertIn("Updating bundle. Reason: Stored hash of bundle does not match hash of .mpy files.", lines)
+
+        uos.flash.files["/flash/main.py"] = b"stale"
+        took_us, lines = boot()
+        self.assertNotIn("/flash/main.py", uos.flash.files)
+        self.assertEqual(marker_size, boot()[0])
+
+        uos.bundle(None)  # Someone emptied the bundle (e.g., via XCTU).
+        boot()
+        self.assertEqual(modules, uos.bundle())
+
+
+class TestBundleHash(unittest.TestCase):
+
+    def test_host_djb2_matches_device(self):
+        rng = random.Random(7)
+        for size in (0, 1, 2, 1023, 70000):
+            data = bytes(rng.getrandbits(8) for _ in range(size))
+            self.assertEqual(bundle_demo.djb2(data), bundlehash.djb2(data), size)
+            self.assertEqual(bundle_demo.djb2(data[size // 3:], bundle_demo.djb2(data[:size // 3])),
+                             bundlehash.djb2(data))
+        self.assertEqual(bundle_demo.djb2(b"\xff" * 10, seed=0xFFFFFFFF), bundlehash.djb2(b"\xff" * 10, 0xFFFFFFFF))
+        with unittest.mock.patch.object(bundlehash, "np", None):  # The fallback for hosts without numpy.
+            self.assertEqual(bundle_demo.djb2(data, 7), bundlehash.djb2(data, 7))
+
+    def test_host_bundle_hash_matches_device(self):
+        modules = {"components": bytes(range(256)) * 9, "constants": b"x" * 1500}
+        host_dir = tempfile.mkdtemp()
+        uos.flash.reset()
+        try:
+            for name, data in modules.items():
+                uos.flash.files["/flash/%s.mpy" % name] = data
+                with open(os.path.join(host_dir, "%s.mpy" % name), "wb") as f:
+                    f.write(data)
+            host_paths = [os.path.join(host_dir, "%s.mpy" % name) for name in modules]
+            with uos.mounted():
+                for algorithm in ("crc32", "djb2"):
+                    device = bundle_demo.bundle_hash(["%s.mpy" % name for name in modules], algorithm)
+                    self.assertEqual(bundlehash.bundle_hash(host_paths, algorithm), device)
+                    self.assertLessEqual(len(device), 20)  # It has to fit in ATKP.
+                self.assertTrue(bundle_demo.bundle_hash(["components.mpy"]).startswith("CRC32: "))
+        finally:
+            uos.flash.reset()
+            shutil.rmtree(host_dir)
+
+
+class TestBootProfiler(unittest.TestCase):
+
+    def setUp(self):
+        uos.flash.reset()
+        xbee._registers.pop("KP", None)
+        self.clock = utime.use_virtual_clock()
+        self.bootprof = bootprof
+        self.frames = []
+
+    def tearDown(self):
+        self.bootprof.profiler = None
+        utime.use_wall_clock()
+        uos.flash.reset()
+        xbee._registers.pop("KP", None)
+
+    def decode(self):
+        assembler = BootProfileAssembler()
+        profile = None
+        for frame in self.frames:
+            self.assertLessEqual(len(frame), MAX_PACKET_SIZE)
+            profile, err = assembler.handle(frame)
+            self.assertIsNone(err)
+        return profile
+
+    def test_bootstrap_timeline(self):
+        for name in ["components", "constants", "ugc", "umqtt"]:
+            uos.flash.files["/flash/%s.mpy" % name] = bytes(2048)
+        uos.flash.files["/flash/components.py"] = b"stale"
+        uos.flash.cost = uos.FlashCostModel(read_us_per_byte=1, erase_ms=30, bundle_ms_per_kb=50)
+        with uos.mounted():
+            while True:
+                boot_marks = bundle_demo.EarlyBootMarks()
+                try:
+                    bundle_demo.bootstrap(_ListLogger(), boot_marks)
+                    break
+                except uos.InterpreterRestart:
+                    pass
+        self.assertNotIn("bootprof", vars(bundle_demo))  # main.py must not import it before rebundling.
+        self.bootprof.start(boot_marks)
+        self.clock.advance_ms(5)
+        self.bootprof.mark("app_init")
+        self.assertIsNone(self.bootprof.report(lambda frame: self.frames.append(bytes(frame))))
+        self.assertIsNone(self.bootprof.report(self.frames.append))  # Only once.
+
+        profile = self.decode()
+        self.assertEqual([("boot_state", 0), ("delete_py", 0), ("rebundle", 8192), ("app_init", 13192)],
+                         [(name, elapsed_us) for name, elapsed_us, _ in profile.checkpoints])
+        table = profile.format()
+        self.assertIn("rebundle", table)
+        self.assertRegex(table, r"app_init +8\.192 +5\.000")
+
+    def test_checkpoints_span_frames_and_overflow(self):
+        profiler = self.bootprof.BootProfiler(max_checkpoints=10)
+        for i in range(12):
+            self.clock.advance_ms(1)
+            profiler.mark("phase_with_a_long_name_%02d" % i)
+        self.assertEqual(2, profiler.dropped)
+
+        def send(frame):
+            if len(self.frames) == 1 and not failed:
+                failed.append(True)
+                raise OSError(105, "ENOBUFS")
+            self.frames.append(bytes(frame))
+
+        failed = []
+        self.assertIsNotNone(profiler.report(send))
+        self.assertIsNone(profiler.report(send))
+        self.assertGreater(len(self.frames), 2)
+        profile = self.decode()
+        self.assertEqual(["phase_with_a_lo"] * 10, [name for name, _, _ in profile.checkpoints])
+        self.assertEqual([1000 * (i + 1) for i in range(10)], [us for _, us, _ in profile.checkpoints])
+        self.assertEqual(2, profile.dropped)
+
+
+class TestMachineWaveforms(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = utime.use_virtual_clock()
+
+    def tearDown(self):
+        utime.use_wall_clock()
+        machine.reset()
+
+    def _sample(self, pin, num_samples):
+        """ _sample is a typical device sampling loop: one ButtonBuffer.put() per millisecond. """
+        buf = ButtonBuffer()
+        edges = 0
+        previous = None
+        for _ in range(num_samples):
+            value = invert(pin.value())
+            buf.put(value)
+            if previous is not None and value != previous:
+                edges += 1
+            previous = value
+            utime.sleep_ms(1)
+        return buf, edges
+
+    def test_square_wave(self):
+        machine.drive("D0", machine.square(period_ms=20, duty=0.25))
+        button = machine.Pin(machine.Pin.board.D0, machine.Pin.IN, machine.Pin.PULL_UP)
+        buf, edges = self._sample(button, 1000)
+        self.assertEqual(99, edges)  # 50 periods, two edges each, minus the one before the first sample.
+        self.assertEqual(0b11111111111100000111111111111111, buf.get_uint32())  # High (0 once inverted) at 980-984 ms.
+        self.assertEqual(1000, button.reads)
+
+    def test_bounce_is_reproducible(self):
+        clean = machine.square(period_ms=100)
+        machine.drive("D0", machine.bounce(clean, bounce_ms=5, chatter_us=300, seed=7))
+        button = machine.Pin("D0", machine.Pin.IN)
+        _, bouncy_edges = self._sample(button, 1000)
+        self.assertGreater(bouncy_edges, 19)  # Chatter adds edges on top of the 19 clean ones.
+
+        self.clock.now_us = 0
+        machine.drive("D0", machine.bounce(clean, bounce_ms=5, chatter_us=300, seed=7))
+        self.assertEqual(bouncy_edges, self._sample(button, 1000)[1])
+
+    def test_adc_csv_capture(self):
+        capture_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, capture_dir)
+        path = os.path.join(capture_dir, "capture.csv")
+        with open(path, "w") as f:
+            f.write("time_ms,value\n0,100\n10,5000\n20,-3\n")
+        machine.drive_adc("D1", machine.from_csv(path, loop=True))
+        adc = machine.ADC("D1")
+        readings = []
+        for _ in range(6):
+            readings.append(adc.read())
+            utime.sleep_ms(10)
+        self.assertEqual([100, 4095, 0, 100, 4095, 0], readings)  # Clamped to 12 bits; the capture repeats.
+
+    def test_sampling_rate(self):
+        machine.drive("D0", machine.bounce(machine.square(period_ms=50), seed=1))
+        button = machine.Pin("D0", machine.Pin.IN)
+        start = utime.ticks_ms()
+        _, edges = self._sample(button, 20000)
+        self.assertEqual(20000, utime.ticks_diff(utime.ticks_ms(), start))  # 1 kHz in virtual time, however fast.
+        self.assertEqual(20000, button.reads)
+        self.assertGreaterEqual(edges, 799)  # 400 periods, two edges each, minus the one before the first sample.
+
+
+class TestVirtualClock(unittest.TestCase):
+
+    def tearDown(self):
+        utime.use_wall_clock()
+
+    def test_simulated_hour_is_instant(self):
+        utime.use_virtual_clock()
+        wall_start = time.time()
+        start = utime.ticks_ms()
+        polls = 0
+        while utime.ticks_diff(utime.ticks_ms(), start) < 3600 * 1000:
+            utime.sleep_ms(500)
+            polls += 1
+        self.assertEqual(7200, polls)
+        self.assertLess(time.time() - wall_start, 1.0)
+
+    def test_wraparound(self):
+        clock = utime.use_virtual_clock(utime.VirtualClock(start_ms=utime.TICKS_PERIOD - 10))
+        before = utime.ticks_ms()
+        self.assertEqual(utime.TICKS_PERIOD - 10, before)
+        utime.advance_ms(25)
+        after = utime.ticks_ms()
+        self.assertEqual(15, after)
+        self.assertEqual(25, utime.ticks_diff(after, before))
+        self.assertEqual(-25, utime.ticks_diff(before, after))
+        self.assertEqual(after, utime.ticks_add(before, 25))
+        self.assertEqual(after, clock.ticks_ms())
+
+
+class TestFakeXBeeLinks(unittest.TestCase):
+
+    def setUp(self):
+        utime.use_virtual_clock()
+        xbee.relay = xbee._Relay()
+        xbee.radio = xbee._Radio()
+
+    def tearDown(self):
+        utime.use_wall_clock()
+
+    def test_ideal_link(self):
+        for i in range(10000):
+            xbee.relay.inject(xbee.relay.SERIAL, b"%d" % i)
+        received = [xbee.relay.receive()["message"] for _ in range(10000)]
+        self.assertEqual([b"%d" % i for i in range(10000)], received)
+        self.assertIsNone(xbee.relay.receive())
+
+        xbee.transmit(xbee.ADDR_COORDINATOR, "hi")
+        self.assertEqual(b"hi", xbee.radio.pop_transmitted()["payload"])
+        xbee.relay.send(xbee.relay.SERIAL, "h\u00e9")  # Like transmit(), relay.send() accepts str too.
+        self.assertEqual("h\u00e9".encode(), xbee.relay.pop_sent()["data"])
+
+    def test_latency_rate_and_cap(self):
+        # 100 bytes at 1000 bytes/sec takes 100 ms to serialize, plus 50 ms of latency.
+        xbee.relay.set_link(xbee.relay.SERIAL, xbee.LinkModel(latency_ms=50, bytes_per_sec=1000, queue_cap=2))
+        xbee.relay.send(xbee.relay.SERIAL, b"x" * 100)
+        xbee.relay.send(xbee.relay.SERIAL, b"y" * 100)
+        self.assertRaises(OSError, xbee.relay.send, xbee.relay.SERIAL, b"z")
+        utime.advance_ms(149)
+        self.assertIsNone(xbee.relay.pop_sent())
+        utime.advance_ms(1)
+        self.assertEqual(b"x" * 100, xbee.relay.pop_sent()["data"])
+        self.assertIsNone(xbee.relay.pop_sent())
+        utime.advance_ms(100)
+        self.assertEqual(b"y" * 100, xbee.relay.pop_sent()["data"])
+        self.assertEqual(1, xbee.relay.stats()["outbound"][xbee.relay.SERIAL]["overflowed"])
+
+    def test_drop_probability(self):
+        xbee.radio.set_link(xbee.LinkModel(drop_probability=0.25, seed=1))
+        for i in range(1000):
+            xbee.radio.inject(b"\x00" * 8, b"%d" % i)
+        received = 0
+        while xbee.receive() is not None:
+            received += 1
+        self.assertEqual(1000 - xbee.radio.inbound.dropped, received)
+        self.assertTrue(200 < xbee.radio.inbound.dropped < 300)
+
+
+class TestSimulator(unittest.TestCase):
+
+    COORDINATOR_APP = """
+import utime
+import xbee
+received = {}
+while True:
+    msg = xbee.receive()
+    while msg is not None:
+        received[msg["sender_eui64"]] = received.get(msg["sender_eui64"], 0) + 1
+        msg = xbee.receive()
+    utime.sleep_ms(100)
+"""
+
+    SENSOR_APP = """
+import utime
+import xbee
+import counter
+
+def main():
+    while True:
+        xbee.transmit(xbee.ADDR_COORDINATOR, counter.next_payload())
+        utime.sleep_ms(1000)
+
+if __name__ == "__main__":
+    main()
+"""
+
+    COUNTER_MODULE = """
+import umachine
+count = 0
+
+def next_payload():
+    global count
+    count += 1
+    return umachine.unique_id() + bytes([count & 0xFF])
+"""
+
+    def test_mesh(self):
+        app_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, app_dir)
+        for name, source in (("coordinator.py", self.COORDINATOR_APP), ("sensor.py", self.SENSOR_APP),
+                             ("counter.py", self.COUNTER_MODULE)):
+            with open(os.path.join(app_dir, name), "w") as f:
+                f.write(source)
+
+        sim = Simulator()
+        coordinator = sim.add_node(os.path.join(app_dir, "coordinator.py"), coordinator=True)
+        sensors = [sim.add_node(os.path.join(app_dir, "sensor.py")) for _ in range(20)]
+        sim.run(60 * 1000)
+        sim.close()
+
+        self.assertIsNone(coordinator.error)
+        self.assertEqual({s.eui64: 61 for s in sensors}, coordinator.app.received)
+        self.assertEqual(61, sensors[0].modules["counter"].count)
+        self.assertIsNot(sensors[0].modules["counter"], sensors[1].modules["counter"])
+        self.assertNotIn("counter", sys.modules)
+        self.assertEqual(20 * 61, sim.stats()["routed"])
+        self.assertTrue(all(node.finished for node in sim.nodes))
+
+    def test_bundle_restarts_the_app(self):
+        app_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, app_dir)
+        with open(os.path.join(app_dir, "main.py"), "w") as f:
+            f.write("import uos\nimport utime\nif not uos.bundle():\n    uos.bundle('main.mpy')\nutime.sleep_ms(10)\n")
+        sim = Simulator()
+        node = sim.add_node(os.path.join(app_dir, "main.py"))
+        node.modules["uos"].flash.files["/flash/main.mpy"] = b"bytecode"
+        sim.run(1000)
+        sim.close()
+        self.assertIsNone(node.error)
+        self.assertEqual(1, node.restarts)
+        self.assertEqual(["main"], node.modules["uos"].bundle())
+
+
+UPYTHON_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "upython")
+
+
+def _import_device_module(name: str):
+    """ _import_device_module imports an upython module the way the device does, with its siblings on the path. """
+    saved_path, saved_core = sys.path[:], sys.modules.pop("core", None)
+    sys.path.insert(0, UPYTHON_DIR)
+    try:
+        return importlib.import_module(name)
+    finally:
+        sys.path[:] = saved_path
+        for module_name in (name, "core"):
+            sys.modules.pop(module_name, None)
+        if saved_core is not None:
+            sys.modules["core"] = saved_core
+
+
+class TestTransport(unittest.TestCase):
+
+    SENDER_APP = """
+import utime
+import xbee
+import transport
+
+t = transport.Transport()
+blobs = [bytes([i]) * (500 + 700 * i) for i in range(4)]
+for blob in blobs:
+    t.send(xbee.ADDR_COORDINATOR, blob)
+while True:
+    msg = xbee.receive()
+    while msg is not None:
+        t.handle(msg["sender_eui64"], msg["payload"])
+        msg = xbee.receive()
+    t.poll()
+    utime.sleep_ms(10)
+"""
+
+    RECEIVER_APP = """
+import utime
+import xbee
+import transport
+
+received = []
+t = transport.Transport(on_message=lambda sender, payload: received.append(payload))
+while True:
+    msg = xbee.receive()
+    while msg is not None:
+        t.handle(msg["sender_eui64"], msg["payload"])
+        msg = xbee.receive()
+    t.poll()
+    utime.sleep_ms(10)
+"""
+
+    def test_device_to_device_over_lossy_links(self):
+        app_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, app_dir)
+        for name in ("core.py", "transport.py"):
+            shutil.copy(os.path.join(UPYTHON_DIR, name), app_dir)
+        for name, source in (("sender.py", self.SENDER_APP), ("receiver.py", self.RECEIVER_APP)):
+            with open(os.path.join(app_dir, name), "w") as f:
+                f.write(source)
+        sim = Simulator()
+        receiver = sim.add_node(os.path.join(app_dir, "receiver.py"), coordinator=True,
+                                link=xbee.LinkModel(latency_ms=20, drop_probability=0.2, seed=1))
+        sender = sim.add_node(os.path.join(app_dir, "sender.py"),
+                              link=xbee.LinkModel(latency_ms=20, drop_probability=0.2, seed=2))
+        sim.run(60 * 1000)
+        sim.close()
+        self.assertIsNone(sender.error)
+        self.assertIsNone(receiver.error)
+        self.assertEqual(sender.app.blobs, receiver.app.received)
+        stats = sender.app.t.stats
+        self.assertTrue(sender.app.t.idle())
+        self.assertGreater(stats["retransmitted"], 0)
+        self.assertEqual(0, stats["failed"])
+
+    def test_host_and_device_interoperate(self):
+        device_transport = _import_device_module("transport")
+        clock = utime.use_virtual_clock()
+        try:
+            rng = random.Random(3)
+            wire = []  # (deliver_at_ms, to_host, sender, payload)
+            host_address, device_address = b"\x00\x13\xa2\x00\x00\x00\x00\x01", b"\x00\x13\xa2\x00\x00\x00\x00\x02"
+
+            def link(to_host, sender):
+                def transmit(dest, payload):
+                    if rng.random() > 0.15:  # 15% loss, plus jitter that reorders packets.
+                        wire.append((clock.now_us // 1000 + rng.randint(5, 40), to_host, sender, bytes(payload)))
+                return transmit
+
+            host_received, device_received = [], []
+            host = HostTransport(link(False, host_address), on_message=lambda s, p: host_received.append(p),
+                                 clock=lambda: clock.now_us / 1000000.0)
+            device = device_transport.Transport(link(True, device_address), window=8,
+                                                on_message=lambda s, p: device_received.append(p))
+            config = bytes(range(256)) * 8
+            logs = [("log line %d " % i).encode() * (i + 1) for i in range(20)]
+            self.assertTrue(host.send(device_address, config))
+            for log in logs[:4]:
+                self.assertTrue(device.send(host_address, log))
+            pending_logs = logs[4:]
+            for _ in range(3000):
+                clock.advance_ms(5)
+                now_ms = clock.now_us // 1000
+                ready = [packet for packet in wire if packet[0] <= now_ms]
+                wire[:] = [packet for packet in wire if packet[0] > now_ms]
+                for _, to_host, sender, payload in ready:
+                    (host if to_host else device).handle(sender, payload)
+                while pending_logs and device.send(host_address, pending_logs[0]):
+                    pending_logs.pop(0)
+                host.poll()
+                device.poll()
+            self.assertEqual([config], device_received)
+            self.assertEqual(logs, host_received)
+            self.assertTrue(host.idle() and device.idle())
+            self.assertGreater(device.stats["retransmitted"], 0)
+        finally:
+            utime.use_wall_clock()
+
+
+class TestCoalescingQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.coalesce = _import_device_module("coalesce")
+        self.clock = utime.use_virtual_clock()
+        self.sent = []
+
+    def tearDown(self):
+        utime.use_wall_clock()
+
+    def transmit(self, dest, payload):
+        self.sent.append((dest, bytes(payload)))
+
+    def test_packs_messages_until_full_or_deadline(self):
+        queue = self.coalesce.CoalescingQueue(self.transmit, max_delay_ms=50)
+        coordinator, other = xbee.ADDR_COORDINATOR, b"\x00\x13\xa2\x00\x00\x00\x00\x07"
+        lines = [("line %02d" % i).encode() for i in range(30)]  # 7 bytes each, so 10 fit in a frame.
+        for line in lines:
+            self.assertTrue(queue.add(coordinator, line))
+        self.assertTrue(queue.add(other, b"hello"))
+        self.assertEqual(2, len(self.sent))  # Two full frames; the rest wait for their deadline.
+        self.assertTrue(all(len(payload) == 81 for _, payload in self.sent))
+        self.clock.advance_ms(49)
+        queue.poll()
+        self.assertEqual(2, len(self.sent))
+        self.clock.advance_ms(1)
+        queue.poll()
+        self.assertEqual(4, len(self.sent))
+        self.assertEqual(0, queue.pending())
+
+        received = []
+        for dest, payload in self.sent:
+            messages, err = split_frame(payload)
+            self.assertIsNone(err)
+            if dest == coordinator:
+                received.extend(messages)
+            else:
+                self.assertEqual([b"hello"], messages)
+        self.assertEqual(lines, received)
+        self.assertEqual({"messages": 31, "frames": 4, "transmit_errors": 0, "rejected": 0, "dropped_frames": 0},
+                         queue.stats)
+        self.assertFalse(queue.add(coordinator, bytes(83)))
+
+    def test_transmit_errors_keep_the_frame(self):
+        failures = [True]
+
+        def transmit(dest, payload):
+            if failures[0]:
+                raise OSError(105, "ENOBUFS")
+            self.transmit(dest, payload)
+
+        queue = self.coalesce.CoalescingQueue(transmit, max_delay_ms=10)
+        self.assertTrue(queue.add(xbee.ADDR_COORDINATOR, bytes(81)))
+        self.assertFalse(queue.add(xbee.ADDR_COORDINATOR, b"x"))  # Full, and the radio's buffers are too.
+        failures[0] = False
+        self.clock.advance_ms(10)
+        queue.poll()
+        self.assertEqual(1, len(self.sent))
+
+        messages, err = split_frame(b"\x12\x02ab\x05abc")
+        self.assertEqual([b"ab"], messages)
+        self.assertIsNotNone(err)
+
+
+class TestLogger(unittest.TestCase):
+
+    def setUp(self):
+        self.logger = _import_device_module("logger")
+        self.clock = utime.use_virtual_clock()
+        self.sent = []
+
+    def tearDown(self):
+        utime.use_wall_clock()
+
+    def send(self, packet):
+        self.assertLessEqual(len(packet), MAX_PACKET_SIZE)
+        self.assertEqual(self.logger.PACKET_TYPE_LOG, packet[0])
+        self.sent.append(bytes(packet[1:]))
+
+    def received_lines(self):
+        return b"".join(self.sent).decode().splitlines()
+
+    def test_batches_and_rate_limits(self):
+        log = self.logger.Logger(send=self.send, level=self.logger.INFO, rate_per_sec=2, burst=2)
+
+        class Unformattable:
+            def __str__(self):
+                raise AssertionError("filtered messages must not be formatted")
+
+        log.debug("value %s", Unformattable())
+        log.info("boot %d", 3)
+        log.warning("x" * 200)  # Spans three packets.
+        for i in range(20):
+            log.error("err %02d", i)
+        log.poll()
+        self.assertEqual(2, len(self.sent))  # The burst.
+        log.poll()
+        self.assertEqual(2, len(self.sent))
+        self.clock.advance_ms(499)
+        log.poll()
+        self.assertEqual(2, len(self.sent))
+        self.clock.advance_ms(1)
+        log.poll()
+        self.assertEqual(3, len(self.sent))
+        self.clock.advance_ms(10000)
+        log.poll()
+        self.assertEqual(0, log.pending())
+        self.assertEqual(["I boot 3", "W " + "x" * 200] + ["E err %02d" % i for i in range(20)], self.received_lines())
+        self.assertEqual({"logged": 22, "filtered": 1, "dropped": 0, "packets": len(self.sent), "send_errors": 0},
+                         log.stats)
+        self.assertEqual(5, len(self.sent))  # 22 lines in 5 packets rather than 22 (or more) transmits.
+
+    def test_drops_oldest_and_reports_it(self):
+        failures = [True]
+
+        def send(packet):
+            if failures[0]:
+                raise OSError(105, "ENOBUFS")
+            self.send(packet)
+
+        log = self.logger.Logger(send=send, capacity=256)
+        for i in range(100):
+            log.info("line %03d", i)  # 11 bytes per record in the ring, so only the last 23 fit.
+            log.poll()
+        self.assertEqual(100, log.stats["send_errors"])
+        self.assertEqual(77, log.stats["dropped"])
+        self.assertLessEqual(log.pending(), 256)
+        failures[0] = False
+        log.flush()
+        self.assertEqual(["W 77 log lines dropped"] + ["I line %03d" % i for i in range(77, 100)],
+                         self.received_lines())
+
+        del self.sent[:]
+        log = self.logger.Logger(send=self.send, capacity=256, burst=1)
+        log.info("y" * 100)
+        log.poll()  # Sends the first part of the line...
+        for i in range(30):
+            log.info("z%02d", i)  # ...and then it's pushed out of the buffer before the rest is sent.
+        log.flush()
+        lines = self.received_lines()
+        self.assertTrue(lines[0].startswith("I yyy"))
+        self.assertRegex(lines[1], r"^W \d+ log lines dropped$")
+        self.assertEqual("I z29", lines[-1])
+
+    def test_default_destination_is_the_coordinator(self):
+        sent = []
+        original = xbee.transmit
+        xbee.transmit = lambda dest, payload: sent.append((dest, bytes(payload)))
+        try:
+            log = self.logger.Logger()
+            log.info("hello")
+            log.poll()
+        finally:
+            xbee.transmit = original
+        self.assertEqual([(xbee.ADDR_COORDINATOR, b"\x00I hello\n")], sent)
+
+
+class TestRelayLogging(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = utime.use_virtual_clock()
+        self.relay = bundle_demo.relay
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "xbee_log.txt")
+
+    def tearDown(self):
+        self.relay.set_link(self.relay.SERIAL, xbee.LinkModel())
+        utime.use_wall_clock()
+        shutil.rmtree(self.dir)
+
+    def read_lines(self, path=None):
+        with open(path or self.path, "rb") as f:
+            return [line.split(b": ", 1)[1].decode() for line in f.read().splitlines()]
+
+    def test_buffered_logger_batches_and_drops_under_backpressure(self):
+        self.relay.set_link(self.relay.SERIAL, xbee.LinkModel(latency_ms=10, queue_cap=2))
+        logger = bundle_demo.DualSinkLogger(bundle_demo.BufferedUserDataRelayLogger(capacity=512), echo=False)
+        messages = ["message %03d: %s" % (i, "x" * (i % 50)) for i in range(40)]
+        for msg in messages:
+            logger.print(msg)  # Never calls relay.send().
+        self.assertIsNone(self.relay.pop_sent())
+        stats = logger.logger.stats
+        dropped = stats["dropped"]
+        self.assertGreater(dropped, 0)
+        self.assertEqual(40, stats["messages"] + dropped)
+
+        logger.poll()
+        self.assertEqual({"frames": 2, "send_errors": 1}, {k: stats[k] for k in ("frames", "send_errors")})
+        collector = LogCollector(RotatingFile(self.path))
+        for i in range(20):
+            if i == 10:
+                logger.print("after the storm")
+            self.clock.advance_ms(10)
+            sent = self.relay.pop_sent()
+            while sent is not None:
+                self.assertLessEqual(len(sent["data"]), 84)
+                self.assertTrue(collector.handle(sent["data"]))
+                sent = self.relay.pop_sent()
+            logger.poll()
+        collector.close()
+        self.assertEqual(0, logger.logger.pending())
+        self.assertEqual(messages[:40 - dropped] + ["%d log messages dropped" % dropped, "after the storm"],
+                         self.read_lines())
+
+    def test_collector_rotates_files(self):
+        collector = LogCollector(RotatingFile(self.path, max_bytes=1000, backup_count=2))
+        self.assertFalse(collector.handle(b"\x10not a log frame"))
+        for i in range(100):
+            collector.handle(b"\x14line %03d\nsplit " % i)
+            collector.handle(b"\x14line\n")
+        collector.handle(b"\x00one message\nof two lines")  # UserDataRelayLogger: one message per frame.
+        collector.close()
+        stats = collector.stats()
+        self.assertEqual(202, stats["lines"])
+        self.assertEqual(1, stats["other_frames"])
+        self.assertGreater(stats["rotations"], 2)
+        self.assertEqual(["xbee_log.txt", "xbee_log.txt.1", "xbee_log.txt.2"], sorted(os.listdir(self.dir)))
+        self.assertEqual(["split line", "one message", "of two lines"], self.read_lines()[-3:])
+        self.assertTrue(all(os.path.getsize(os.path.join(self.dir, f)) <= 1000 for f in os.listdir(self.dir)))
+
+    def test_collector_keeps_up_with_a_local_xbee(self):
+        emulator = XBeeEmulator(registers={"AP": b"\x01"})
+        device = XBeeDevice(emulator.start(), 115200)
+        try:
+            device.open()
+            collector = LogCollector(RotatingFile(self.path), flush_interval_sec=0.05)
+            collector.start(device)
+            for i in range(2000):
+                emulator.inject_relay(xbee.relay.MICROPYTHON, b"\x14frame %04d\n" % i)
+            deadline = time.monotonic() + 30
+            while collector.stats()["lines"] + collector.stats()["queued"] < 2000 and time.monotonic() < deadline:
+                time.sleep(0.01)
+            collector.close()
+        finally:
+            device.close()
+            emulator.stop()
+        self.assertEqual(["frame %04d" % i for i in range(2000)], self.read_lines())
+
+
+class TestLazyModule(HeapTestCase):
+
+    HEAP_SIZE = 256 * 1024
+
+    def setUp(self):
+        self.lazy = _import_device_module("lazy")
+        self.dir = tempfile.mkdtemp()
+        with open(os.path.join(self.dir, "lazy_victim.py"), "w") as f:
+            f.write("TABLE = bytearray(50000)\n\ndef size():\n    return len(TABLE)\n")
+        sys.path.insert(0, self.dir)
+        super().setUp()
+
+    def tearDown(self):
+        super().tearDown()
+        sys.path.remove(self.dir)
+        sys.modules.pop("lazy_victim", None)
+        shutil.rmtree(self.dir)
+
+    def test_loads_on_first_use_and_unloads(self):
+        victim = self.lazy.LazyModule("lazy_victim")
+        self.assertNotIn("lazy_victim", sys.modules)
+        self.assertFalse(self.lazy.loaded(victim))
+        idle = ugc.mem_alloc()
+
+        self.assertEqual(50000, victim.size())
+        self.assertEqual(50000, len(victim.TABLE))
+        self.assertEqual(1, victim._lazy_loads)
+        in_use = ugc.mem_alloc()
+        self.assertGreater(in_use - idle, 50000)
+        self.assertRaises(AttributeError, getattr, victim, "missing")
+
+        self.lazy.unload(victim)
+        self.assertNotIn("lazy_victim", sys.modules)
+        # The module's globals were freed. (CPython's import caches keep a little, unlike the device.)
+        self.assertLess(ugc.mem_alloc(), in_use - 50000)
+        self.assertEqual(50000, victim.size())  # Reimported on demand.
+        self.assertEqual(2, victim._lazy_loads)
+        self.assertIn("loaded", repr(victim))
+
+        package = self.lazy.LazyModule("xbf.cpython.coalesce")
+        self.assertIs(split_frame, package.split_frame)
+
+
+class TestLazyModuleCheck(unittest.TestCase):
+
+    def setUp(self):
+        self.src = tempfile.mkdtemp()
+        self.build = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.src)
+        shutil.rmtree(self.build)
+
+    def write(self, directory, name, text=""):
+        with open(os.path.join(directory, name), "w") as f:
+            f.write(text)
+
+    def test_check(self):
+        self.write(self.src, "main.py", "import lazy\ndesired_bundle = ['components', 'reports']\n")
+        self.write(self.src, "components.py", "import lazy\nreports = lazy.LazyModule('reports')\n"
+                                              "ota = lazy.LazyModule('ota')\n")
+        self.write(self.src, "reports.py")
+        self.write(self.src, "ota.py")
+        for name in ("main", "components", "reports", "ota"):
+            self.write(self.build, name + ".mpy")
+        self.assertEqual(Success, check_lazy_modules([self.src], self.build))
+
+        os.remove(os.path.join(self.src, "ota.py"))
+        self.assertIn("loads unknown module ota lazily", check_lazy_modules([self.src], self.build))
+
+        self.write(self.src, "ota.py")
+        os.remove(os.path.join(self.build, "ota.mpy"))
+        self.assertIn("lazy module ota was not built", check_lazy_modules([self.src], self.build))
+
+    def test_expected_bundle_hashes(self):
+        self.write(self.src, "main.py", "desired_bundle = ['reports', 'components']\n")
+        self.write(self.build, "components.mpy", "c")
+        self.write(self.build, "reports.mpy", "r")
+        hashes, err = expected_bundle_hashes([self.src], self.build)
+        self.assertEqual(Success, err)
+        paths = [os.path.join(self.build, name) for name in ("reports.mpy", "components.mpy")]  # In bundle order.
+        self.assertEqual([bundlehash.bundle_hash(paths, "crc32"), bundlehash.bundle_hash(paths, "djb2")], hashes)
+
+        os.remove(paths[0])
+        self.assertIsNotNone(expected_bundle_hashes([self.src], self.build)[1])
+        self.write(self.src, "main.py")
+        self.assertEqual(([], Success), expected_bundle_hashes([self.src], self.build))
+
+
+class _FakeOpenedXBee:
+    """ _FakeOpenedXBee stands in for an opened digi.xbee.devices.XBeeDevice in the broker tests. """
+
+    class _Addr:
+        address = bytearray(b"\x00\x13\xa2\x00\x41\x00\x00\x01")
+
+    class _Msg:
+        def __init__(self, data):
+            self.data = bytearray(data)
+            self.remote_device = self
+            self.is_broadcast = False
+
+        def get_64bit_addr(self):
+            return _FakeOpenedXBee._Addr()
+
+    comm_iface = "fake"  # RemoteXBeeDevice (created by the broker for each send) requires this of the local device.
+
+    def __init__(self):
+        self.params = {"PS": bytearray(b"\x01")}
+        self.sent = []
+        self.callbacks = []
+
+    def get_64bit_addr(self):
+        return self._Addr()
+
+    def get_protocol(self):
+        return None
+
+    def get_node_id(self):
+        return "fake"
+
+    def get_parameter(self, param):
+        return self.params[param]
+
+    def set_parameter(self, param, value):
+        self.params[param] = value
+
+    def send_data_async(self, remote, data):
+        self.sent.append((bytes(remote.get_64bit_addr().address), bytes(data)))
+
+    def add_data_received_callback(self, callback):
+        self.callbacks.append(callback)
+
+    def del_data_received_callback(self, callback):
+        self.callbacks.remove(callback)
+
+    def inject(self, data):
+        for callback in self.callbacks:
+            callback(self._Msg(data))
+
+
+class TestBroker(unittest.TestCase):
+
+    def _socket_path(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        return os.path.join(directory, "broker.sock")
+
+    def test_multiplexing(self):
+        device = _FakeOpenedXBee()
+        socket_path = self._socket_path()
+        broker = Broker(device, socket_path)
+        thread = threading.Thread(target=broker.serve_forever, daemon=True)
+        thread.start()
+        while not os.path.exists(socket_path) or not device.callbacks:
+            time.sleep(0.01)
+
+        received = {"a": [], "b": []}
+        got_both = threading.Event()
+
+        def receiver(name):
+            def callback(msg):
+                received[name].append((bytes(msg.data), bytes(msg.remote_device.get_64bit_addr().address)))
+                if received["a"] and received["b"]:
+                    got_both.set()
+            return callback
+
+        a, b = BrokerClient(socket_path), BrokerClient(socket_path)
+        a.open()
+        b.open()
+        a.add_data_received_callback(receiver("a"))
+        b.add_data_received_callback(receiver("b"))
+
+        self.assertEqual(b"\x01", a.get_parameter("PS"))
+        b.set_parameter("PS", b"\x00")
+        self.assertEqual(b"\x00", a.get_parameter("PS"))
+        self.assertEqual("fake", b.get_node_id())
+        self.assertRaises(IOError, a.get_parameter, "XX")
+
+        a.send_data_broadcast(b"hello")
+        self.assertEqual([(b"\x00\x00\x00\x00\x00\x00\xff\xff", b"hello")], device.sent)
+
+        device.inject(b"rx!")
+        self.assertTrue(got_both.wait(5.0))
+        self.assertEqual([(b"rx!", bytes(_FakeOpenedXBee._Addr.address))], received["a"])
+        self.assertEqual(received["a"], received["b"])
+
+        a.close()
+        b.close()
+        broker.stop()
+        thread.join()
+        self.assertFalse(os.path.exists(socket_path))
+
+    def test_event_overflow_keeps_replies(self):
+        device = _FakeOpenedXBee()
+        broker = Broker(device, self._socket_path())
+        ours, theirs = socket.socketpair()
+        self.addCleanup(ours.close)
+        self.addCleanup(theirs.close)
+        client = broker_client_state(ours)
+        broker._post(client, {"id": 1})
+        for i in range(MAX_PENDING_EVENTS + 5):
+            broker._post(client, {"event": "rx", "n": i}, is_event=True)
+        self.assertEqual(5, client.dropped_events)
+        self.assertEqual([encode_message({"id": 1})], list(client.outgoing))
+        self.assertEqual(encode_message({"event": "rx", "n": 5}), client.outgoing_events[0])
+
+    def test_concurrent_requests(self):
+        device = _FakeOpenedXBee()
+        socket_path = self._socket_path()
+        broker = Broker(device, socket_path)
+        thread = threading.Thread(target=broker.serve_forever, daemon=True)
+        thread.start()
+        while not os.path.exists(socket_path) or not device.callbacks:
+            time.sleep(0.01)
+
+        client = BrokerClient(socket_path)
+        client.open()
+        payloads = [bytes([i]) * 30000 for i in range(16)]  # Together, more than the socket buffer holds.
+        errors = []
+
+        def send(payload):
+            try:
+                client.send_data_broadcast(payload)
+            except Exception as ex:
+                errors.append(ex)
+
+        senders = [threading.Thread(target=send, args=(p,)) for p in payloads]
+        for sender in senders:
+            sender.start()
+        for sender in senders:
+            sender.join()
+        self.assertEqual([], errors)
+        self.assertTrue(sorted(payloads) == sorted(data for _, data in device.sent))
+
+        client.close()
+        broker.stop()
+        thread.join()
+
+    def test_cleans_up_when_discovery_fails(self):
+        device = _FakeOpenedXBee()
+        device.get_64bit_addr = lambda: (_ for _ in ()).throw(IOError("no response"))
+        socket_path = self._socket_path()
+        self.assertRaises(IOError, Broker(device, socket_path).serve_forever)
+        self.assertFalse(os.path.exists(socket_path))
+        self.assertEqual([], device.callbacks)
+
+    def test_stale_socket_falls_back_to_serial_port(self):
+        socket_path = self._socket_path()
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stale.bind(socket_path)
+        stale.close()  # Leaves the socket file behind with nobody listening, like a crashed broker.
+        self.assertFalse(broker_is_listening(socket_path))
+
+        class Device:
+            serial_port = None
+            opened = False
+
+            def open(self):
+                self.opened = True
+
+            def is_open(self):
+                return self.opened
+
+            def close(self):
+                self.opened = False
+
+        opener = OpenXBeeDevice(Device(), broker=socket_path)
+        opener.log = lambda msg: None
+        with opener as xbee:
+            self.assertIsInstance(xbee, Device)
+            self.assertTrue(xbee.opened)
+
+
+class TestEmulator(unittest.TestCase):
+
+    def setUp(self):
+        self.emulator = XBeeEmulator(timing=Timing(guard_time_ms=50, restart_ms=50), registers={"AP": b"\x04"})
+        self.port = self.emulator.start()
+
+    def tearDown(self):
+        self.emulator.stop()
+
+    def _read_frame(self, ser, escaped=False):
+        raw = bytearray()
+        while len(raw) < 3 or len(raw) < 4 + ((raw[1] << 8) | raw[2]):
+            byte = ser.read(1)
+            self.assertEqual(1, len(byte), "Timed out waiting for an API frame")
+            if escaped and byte == b"\x7D":
+                byte = bytes([ser.read(1)[0] ^ 0x20])
+            raw += byte
+        return bytes(raw[3:-1])
+
+    def test_mode_switching(self):
+        original_mode, err = ensure_api_mode(self.port, 115200)
+        self.assertEqual(Success, err)
+        self.assertEqual(4, original_mode)
+        self.assertEqual(b"\x01", self.emulator.registers["AP"])
+
+        self.assertEqual(Success, restore_mode(self.port, 115200, original_mode))
+        self.assertEqual(b"\x04", self.emulator.registers["AP"])
+
+    def test_deploy_end_to_end(self):
+        self.emulator.registers["GT"] = self.emulator.persisted["GT"] = b"\x00\x32"  # Matches guard_time_ms.
+        self.emulator.timing.ymodem_poll_ms = 50
+        build_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, build_dir)
+        for name, data in (("main.mpy", b"M\x05main"), ("frame.mpy", bytes(range(256)) * 4)):  # 0x7E in the data.
+            with open(os.path.join(build_dir, name), "wb") as f:
+                f.write(data)
+        self.emulator.files["/flash/main.py"] = b"print('stale')"
+
+        original_mode, err = ensure_api_mode(self.port, 115200)
+        self.assertEqual(Success, err)
+        opener = OpenXBeeDevice(Raw802Device(self.port, 115200), broker=False)
+        opener.log = lambda msg: None
+        with opener as device:
+            self.assertEqual(Success, ensure_running_latest_micropython_app(build_dir, device))
+        self.assertEqual(1, self.emulator.restarts)
+
+        # The files are up to date now, but ATKP says the bundle isn't, so the device must restart (and rebundle).
+        with opener as device:
+            self.assertEqual(Success, ensure_running_latest_micropython_app(build_dir, device, ["CRC32: 0x1234ABCD"]))
+        self.assertEqual(2, self.emulator.restarts)
+        self.assertEqual(Success, restore_mode(self.port, 115200, original_mode))
+
+        self.assertEqual(b"M\x05main", self.emulator.files["/flash/main.mpy"])
+        self.assertEqual(bytes(range(256)) * 4, self.emulator.files["/flash/frame.mpy"])
+        self.assertNotIn("/flash/main.py", self.emulator.files)
+        self.assertEqual(b"\x01", self.emulator.persisted["PS"])
+        self.assertEqual(b"\x04", self.emulator.registers["AP"])
+
+    def test_restart_forgets_unwritten_settings(self):
+        self.emulator.registers["AP"] = self.emulator.persisted["AP"] = b"\x01"
+        with serial.Serial(self.port, 115200, timeout=1.0) as ser:
+            ser.write(api_frame(b"\x08\x01NIxyz"))
+            self.assertEqual(b"\x88\x01NI\x00", self._read_frame(ser))
+            ser.write(api_frame(b"\x08\x02FR"))
+            self.assertEqual(b"\x88\x02FR\x00", self._read_frame(ser))
+            self.assertEqual(b"\x8A\x00", self._read_frame(ser))  # Modem status after the restart.
+        self.assertEqual(b" ", self.emulator.registers["NI"])
+        self.assertEqual(1, self.emulator.restarts)
+
+    def test_commands_right_after_a_restart_survive_it(self):
+        self.emulator.registers["AP"] = self.emulator.persisted["AP"] = b"\x01"
+        with serial.Serial(self.port, 115200, timeout=0.005) as ser:
+            for i in range(5):
+                ser.write(api_frame(b"\x08\x02FR"))
+                # Keep sending until the device answers: the first answered command is the first one after the
+                # restart, so it must not be undone by the restart's restoring of the persisted settings.
+                name, rx = b"node%d" % i, bytearray()
+                while b"\x88\x03NI\x00" not in rx:
+                    ser.write(api_frame(b"\x08\x03NI" + name))
+                    rx += ser.read(64)
+                time.sleep(0.1)
+                self.assertEqual(name, self.emulator.registers["NI"])
+        self.assertEqual(5, self.emulator.restarts)
+
+    def test_unescaped_frames_may_contain_start_delimiter(self):
+        self.emulator.registers["AP"] = b"\x01"
+        with serial.Serial(self.port, 115200, timeout=1.0) as ser:
+            ser.write(api_frame(b"\x08\x7ENI"))  # Frame ID 126 is the start delimiter, unescaped in ATAP1.
+            self.assertEqual(b"\x88\x7ENI\x00 ", self._read_frame(ser))
+
+    def test_escaped_transmit_and_receive(self):
+        self.emulator.registers["AP"] = b"\x02"
+        dest = b"\x00\x13\xA2\x00\x41\x7E\x11\x13"
+        with serial.Serial(self.port, 115200, timeout=1.0) as ser:
+            ser.write(api_frame(b"\x10\x05" + dest + b"\xFF\xFE\x00\x00" + b"~}", escaped=True))
+            self.assertEqual(b"\x8B\x05\xFF\xFE\x00\x00\x00", self._read_frame(ser, escaped=True))
+            self.emulator.inject_receive(dest, b"\x7E\x7D")
+            self.assertEqual(b"\x90" + dest + b"\xFF\xFE\x01\x7E\x7D", self._read_frame(ser, escaped=True))
+        self.assertEqual([(dest, b"~}")], list(self.emulator.transmitted))
+
+
+class TestXBeeAdapter(unittest.TestCase):
+
+    def setUp(self):
+        self.emulator = XBeeEmulator(registers={"AP": b"\x01"})
+        self.device = XBeeDevice(self.emulator.start(), 115200)
+        self.device.open()
+        self.adapter = xbee_adapter.attach(self.device, max_pending=16)
+
+    def tearDown(self):
+        xbee_adapter.detach()
+        self.device.close()
+        self.emulator.stop()
+
+    def test_transmit_queue(self):
+        for i in range(300):  # More than 255, so frame IDs wrap around (and include 0x7E).
+            while True:
+                try:
+                    xbee_adapter.transmit(xbee_adapter.ADDR_COORDINATOR, b"msg%d" % i)
+                    break
+                except OSError:
+                    time.sleep(0.001)  # Queue full: back off, as device code must.
+        self.assertTrue(self.adapter.flush())
+        self.assertEqual([b"msg%d" % i for i in range(300)], [p for _, p in self.emulator.transmitted])
+        stats = self.adapter.stats()
+        self.assertEqual(300, stats["delivered"])
+        self.assertEqual(0, stats["in_flight"])
+
+    def test_transmit_options(self):
+        self.assertRaises(ValueError, xbee_adapter.transmit, xbee_adapter.ADDR_COORDINATOR, b"x", dest_ep=0xE6)
+        self.assertRaises(ValueError, xbee_adapter.transmit, xbee_adapter.ADDR_COORDINATOR, b"x", bcast_radius=1)
+        xbee_adapter.transmit(xbee_adapter.ADDR_COORDINATOR, b"no ack", tx_options=0x01)
+        self.assertTrue(self.adapter.flush())
+        self.assertEqual([b"no ack"], [p for _, p in self.emulator.transmitted])
+
+        self.adapter.raw_802 = False  # As on Zigbee/DigiMesh firmware, which the emulator doesn't emulate.
+        options = (True, 0xE8, 0xE6, 0x12, 0xC105, 2, 0x01)
+        packet = self.adapter._build_packet(7, xbee_adapter.ADDR_COORDINATOR, b"x", options)
+        frame = bytes(packet.output())  # Start delimiter, length, then type, ID, 64- and 16-bit addresses, ...
+        self.assertEqual(b"\x11\x07", frame[3:5])
+        self.assertEqual(b"\xE8\xE6\x00\x12\xC1\x05\x02\x01x", frame[15:-1])
+        options = (False, 0xE8, 0xE8, 0x11, 0xC105, 0, 0x01)
+        packet = self.adapter._build_packet(8, xbee_adapter.ADDR_COORDINATOR, b"x", options)
+        self.assertEqual((0x10, 0x01), (packet.get_frame_type().code, packet.transmit_options))
+
+    def test_receive_relay_and_atcmd(self):
+        sender = b"\x00\x13\xA2\x00\x01\x02\x03\x04"
+        self.emulator.inject_receive(sender, b"hello")
+        self.emulator.inject_relay(xbee_adapter.relay.BLUETOOTH, b"ble")
+        xbee_adapter.relay.send(xbee_adapter.relay.SERIAL, b"out")
+        deadline = time.monotonic() + 5.0
+        while (not self.adapter.received or not self.adapter.relayed) and time.monotonic() < deadline:
+            time.sleep(0.01)
+        message = xbee_adapter.receive()
+        self.assertEqual((sender, b"hello"), (message["sender_eui64"], message["payload"]))
+        self.assertIsNone(xbee_adapter.receive())
+        self.assertEqual({"sender": 1, "message": b"ble"}, xbee_adapter.relay.receive())
+
+        self.assertEqual(0x0013A200, xbee_adapter.atcmd("SH"))
+        self.assertEqual(0x0013A200, xbee_adapter.atcmd("SH"))
+        xbee_adapter.atcmd("NI", "node1")
+        self.assertEqual("node1", xbee_adapter.atcmd("NI"))
+        self.assertEqual(1, self.adapter.stats()["atcmd_cached"])
+        self.assertEqual([(0, b"out")], list(self.emulator.relayed))
+
 
 if __name__ == "__main__":
-    exit_status = unittest.main(verbosity=2)
-    sys.exit(exit_status)
+    result = unittest.main(verbosity=2, exit=False).result
+    ugc.print_peaks()
+    sys.exit(0 if result.wasSuccessful() else 1)
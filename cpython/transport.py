@@ -0,0 +1,323 @@
+"""
+transport.py is the host counterpart of upython/transport.py: reliable, in-order delivery of payloads of any size
+between this PC (via its locally attached XBee) and the devices' MicroPython apps. See upython/transport.py for the
+design and the wire format.
+
+Example usage, on top of the xbee adapter (see adapters/xbee.py):
+    with OpenXBeeDevice(XBeeDevice(port, baud)) as device:
+        adapter = xbee_adapter.attach(device)
+        transport = Transport(adapter.transmit, on_message=save_log)
+        transport.start(adapter.receive)
+        transport.send(device_address, config_blob)
+        transport.flush()
+        ...
+        transport.close()
+
+Unlike the device version, this one is thread-safe. start() runs a background thread that feeds received packets
+to handle() and calls poll() every interval_ms. on_message is called on whichever thread calls handle().
+"""
+
+import os
+import threading
+import time
+from typing import Callable, Optional
+
+from xbf.upython.core import MAX_PACKET_SIZE, MAX_SEQUENCE_NUMBER, sequence_more_recent
+
+# Caution: Ensure that these definitions match the redundant definitions in upython/transport.py.
+PACKET_TYPE_DATA = 0x10
+PACKET_TYPE_ACK = 0x11
+FLAG_LAST = 0x01
+FLAG_SYN = 0x02
+HEADER_SIZE = 4
+ACK_SIZE = 7
+FRAGMENT_SIZE = MAX_PACKET_SIZE - HEADER_SIZE
+SACK_BITS = 32
+MAX_WINDOW = 30
+
+
+def _random_sequence_number(avoid: Optional[int] = None) -> int:
+    """ _random_sequence_number returns a random starting sequence number that's far from `avoid`, if given. """
+    while True:
+        seq = int.from_bytes(os.urandom(2), "big")
+        distance = (seq - avoid) & MAX_SEQUENCE_NUMBER if avoid is not None else MAX_SEQUENCE_NUMBER // 2
+        if 2 * SACK_BITS <= distance <= MAX_SEQUENCE_NUMBER - 2 * SACK_BITS:
+            return seq
+
+
+class _Fragment:
+
+    __slots__ = ("seq", "flags", "data", "sent_at", "retries")
+
+    def __init__(self, seq: int, flags: int, data: bytes, sent_at: float):
+        self.seq = seq
+        self.flags = flags
+        self.data = data
+        self.sent_at = sent_at
+        self.retries = 0
+
+
+class _Peer:
+    """ _Peer holds both directions of the transport's state for one remote address. """
+
+    def __init__(self, rto_ms: int):
+        # Sending.
+        self.queue = []  # Payloads waiting to be fragmented.
+        self.offset = 0  # Bytes of queue[0] already fragmented.
+        self.next_seq = _random_sequence_number()
+        self.in_flight = []  # Fragments sent but not acknowledged, oldest first.
+        self.syn = True  # Until the first fragment (the FLAG_SYN one) is acknowledged.
+        self.rto_ms = rto_ms
+        self.srtt_ms = 0.0  # Smoothed round trip time, or 0 before the first sample.
+        # Receiving.
+        self.expected = None  # Next sequence number to deliver, or None before the first fragment.
+        self.held = {}  # Sequence number -> (flags, fragment) for fragments that arrived out of order.
+        self.parts = []  # Fragments of the payload being reassembled.
+
+
+class Transport:
+    """
+    Transport is the reliable transport for every peer of the host's XBee. transmit(dest, payload) sends one packet
+    (e.g., XBeeAdapter.transmit); each complete payload is passed to on_message(sender, payload).
+    """
+
+    def __init__(self, transmit: Callable, on_message: Optional[Callable] = None, window: int = MAX_WINDOW,
+                 rto_ms: int = 1000, min_rto_ms: int = 50, max_rto_ms: int = 8000, max_retries: int = 8,
+                 max_queued: int = 64, clock: Callable[[], float] = time.monotonic):
+        self.transmit = transmit
+        self.on_message = on_message
+        self.window = min(window, MAX_WINDOW)
+        self.initial_rto_ms = rto_ms
+        self.min_rto_ms = min_rto_ms
+        self.max_rto_ms = max_rto_ms
+        self.max_retries = max_retries
+        self.max_queued = max_queued
+        self.clock = clock
+        self.peers = {}  # Address (bytes) -> _Peer
+        self._lock = threading.RLock()
+        self._thread = None
+        self._stopping = threading.Event()
+        self._stats = {"sent": 0, "retransmitted": 0, "acked": 0, "failed": 0, "transmit_errors": 0,
+                       "received": 0, "duplicates": 0, "delivered": 0}
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self._stats)
+
+    def send(self, dest: bytes, payload: bytes) -> bool:
+        """ send queues a payload for reliable delivery. Returns False if too many payloads are already queued. """
+        with self._lock:
+            peer = self._peer(dest)
+            if len(peer.queue) >= self.max_queued:
+                return False
+            peer.queue.append(bytes(payload))
+            return True
+
+    def idle(self) -> bool:
+        """ idle returns True once every queued payload has been acknowledged (or given up on). """
+        with self._lock:
+            return all(not peer.queue and not peer.in_flight for peer in self.peers.values())
+
+    def flush(self, timeout_sec: float = 30.0) -> bool:
+        """ flush waits (polling, if no background thread is running) until idle(). Returns False on timeout. """
+        deadline = time.monotonic() + timeout_sec
+        while not self.idle():
+            if time.monotonic() > deadline:
+                return False
+            if self._thread is None:
+                self.poll()
+            time.sleep(0.005)
+        return True
+
+    def start(self, receive: Callable[[], Optional[dict]], interval_ms: int = 10,
+              on_other_packet: Optional[Callable[[dict], None]] = None) -> None:
+        """
+        start runs a background thread that passes each packet from receive() (e.g., XBeeAdapter.receive, which
+        returns xbee.receive()-style dicts or None) to handle(), and calls poll() every interval_ms.
+        Packets that aren't transport packets go to on_other_packet.
+        """
+        def run():
+            while not self._stopping.is_set():
+                msg = receive()
+                while msg is not None:
+                    if not self.handle(msg["sender_eui64"], msg["payload"]) and on_other_packet is not None:
+                        on_other_packet(msg)
+                    msg = receive()
+                self.poll()
+                self._stopping.wait(interval_ms / 1000.0)
+
+        self._stopping.clear()
+        self._thread = threading.Thread(target=run, name="transport", daemon=True)
+        self._thread.start()
+
+    def close(self) -> None:
+        if self._thread is not None:
+            self._stopping.set()
+            self._thread.join()
+            self._thread = None
+
+    def poll(self) -> None:
+        with self._lock:
+            now = self._now_ms()
+            for address, peer in self.peers.items():
+                timed_out = False
+                for fragment in peer.in_flight:
+                    if now - fragment.sent_at >= peer.rto_ms:
+                        if fragment.retries >= self.max_retries:
+                            self._give_up(peer)
+                            timed_out = False
+                            break
+                        self._retransmit(address, fragment, now)
+                        timed_out = True
+                if timed_out:
+                    peer.rto_ms = min(peer.rto_ms * 2, self.max_rto_ms)  # Back off while the link is struggling.
+                while peer.queue and len(peer.in_flight) < (1 if peer.syn else self.window):
+                    self._send_next_fragment(address, peer, now)
+
+    def handle(self, sender: bytes, payload: bytes) -> bool:
+        """ handle processes a received packet. Returns False if it isn't a transport packet. """
+        if len(payload) < 1:
+            return False
+        with self._lock:
+            if payload[0] == PACKET_TYPE_DATA and len(payload) >= HEADER_SIZE:
+                self._handle_data(bytes(sender), payload)
+                return True
+            if payload[0] == PACKET_TYPE_ACK and len(payload) >= ACK_SIZE:
+                self._handle_ack(bytes(sender), payload)
+                return True
+        return False
+
+    # ---- Internals (called with self._lock held) ----
+
+    def _now_ms(self) -> float:
+        return self.clock() * 1000.0
+
+    def _peer(self, address: bytes) -> _Peer:
+        address = bytes(address)
+        peer = self.peers.get(address)
+        if peer is None:
+            peer = self.peers[address] = _Peer(self.initial_rto_ms)
+        return peer
+
+    def _send_next_fragment(self, address: bytes, peer: _Peer, now: float) -> None:
+        data = peer.queue[0]
+        end = min(peer.offset + FRAGMENT_SIZE, len(data))
+        flags = FLAG_SYN if peer.syn else 0
+        fragment = _Fragment(peer.next_seq, flags, data[peer.offset:end], now)
+        if end >= len(data):
+            fragment.flags |= FLAG_LAST
+            peer.queue.pop(0)
+            peer.offset = 0
+        else:
+            peer.offset = end
+        peer.next_seq = (peer.next_seq + 1) & MAX_SEQUENCE_NUMBER
+        peer.in_flight.append(fragment)
+        self._transmit_fragment(address, fragment)
+        self._stats["sent"] += 1
+
+    def _retransmit(self, address: bytes, fragment: _Fragment, now: float) -> None:
+        fragment.sent_at = now
+        fragment.retries += 1
+        self._transmit_fragment(address, fragment)
+        self._stats["retransmitted"] += 1
+
+    def _transmit_fragment(self, address: bytes, fragment: _Fragment) -> None:
+        packet = bytes([PACKET_TYPE_DATA]) + fragment.seq.to_bytes(2, "big") + bytes([fragment.flags]) + fragment.data
+        self._transmit(address, packet)
+
+    def _transmit(self, address: bytes, packet: bytes) -> None:
+        try:
+            self.transmit(address, packet)
+        except OSError:
+            self._stats["transmit_errors"] += 1  # E.g., ENOBUFS. The retransmission timer will try again.
+
+    def _give_up(self, peer: _Peer) -> None:
+        self._stats["failed"] += len(peer.queue) + sum(1 for f in peer.in_flight if f.flags & FLAG_LAST)
+        peer.queue = []
+        peer.offset = 0
+        peer.in_flight = []
+        peer.syn = True
+        peer.rto_ms = self.initial_rto_ms
+        peer.next_seq = _random_sequence_number(avoid=peer.next_seq)
+
+    def _handle_ack(self, sender: bytes, payload: bytes) -> None:
+        expected = int.from_bytes(payload[1:3], "big")
+        sack = int.from_bytes(payload[3:7], "big")
+        peer = self.peers.get(sender)
+        if peer is None or not self._acks(peer, expected):
+            return  # E.g., a late ACK from before this peer was given up on.
+        now = self._now_ms()
+        remaining = []
+        for fragment in peer.in_flight:
+            offset = (fragment.seq - expected - 1) & MAX_SEQUENCE_NUMBER
+            if sequence_more_recent(expected, fragment.seq) or (offset < SACK_BITS and (sack >> offset) & 1):
+                self._stats["acked"] += 1
+                if fragment.retries == 0:
+                    self._sample_rtt(peer, now - fragment.sent_at)
+            else:
+                remaining.append(fragment)
+        if len(remaining) < len(peer.in_flight):
+            peer.syn = False
+        peer.in_flight = remaining
+        # Fragments after a hole arrived, so the hole was probably lost: resend it without waiting for the timer,
+        # but at most once per round trip.
+        if sack and remaining and remaining[0].seq == expected and now - remaining[0].sent_at >= peer.srtt_ms:
+            self._retransmit(sender, remaining[0], now)
+
+    @staticmethod
+    def _acks(peer: _Peer, expected: int) -> bool:
+        """ _acks returns True if an ACK's next expected sequence number is about the peer's fragments in flight. """
+        if not peer.in_flight:
+            return False
+        oldest = peer.in_flight[0].seq
+        return (expected - oldest) & MAX_SEQUENCE_NUMBER <= (peer.next_seq - oldest) & MAX_SEQUENCE_NUMBER
+
+    def _sample_rtt(self, peer: _Peer, rtt_ms: float) -> None:
+        peer.srtt_ms = rtt_ms if peer.srtt_ms == 0 else (7 * peer.srtt_ms + rtt_ms) / 8
+        peer.rto_ms = max(self.min_rto_ms, min(2 * peer.srtt_ms, self.max_rto_ms))
+
+    def _handle_data(self, sender: bytes, payload: bytes) -> None:
+        peer = self._peer(sender)
+        seq = int.from_bytes(payload[1:3], "big")
+        flags = payload[3]
+        self._stats["received"] += 1
+        if flags & FLAG_SYN and (peer.expected is None or not self._recognized(peer, seq)):
+            peer.expected = seq
+            peer.held = {}
+            peer.parts = []
+        elif peer.expected is None:
+            return  # We lost our state (e.g., restarted) and can't place this. The sender will give up and resync.
+        ahead = (seq - peer.expected) & MAX_SEQUENCE_NUMBER
+        if ahead == 0:
+            self._accept(sender, peer, flags, bytes(payload[HEADER_SIZE:]))
+            while peer.expected in peer.held:
+                held_flags, fragment = peer.held.pop(peer.expected)
+                self._accept(sender, peer, held_flags, fragment)
+        elif ahead <= SACK_BITS and seq not in peer.held:
+            peer.held[seq] = (flags, bytes(payload[HEADER_SIZE:]))
+        else:
+            self._stats["duplicates"] += 1  # Already delivered (its ACK was lost), or too far ahead to hold.
+        self._send_ack(sender, peer)
+
+    @staticmethod
+    def _recognized(peer: _Peer, seq: int) -> bool:
+        """ _recognized returns True if seq is near the receive window, i.e., not from a restarted sender. """
+        distance = (seq - peer.expected) & MAX_SEQUENCE_NUMBER
+        return distance <= SACK_BITS or distance >= MAX_SEQUENCE_NUMBER + 1 - 2 * SACK_BITS
+
+    def _accept(self, sender: bytes, peer: _Peer, flags: int, fragment: bytes) -> None:
+        peer.expected = (peer.expected + 1) & MAX_SEQUENCE_NUMBER
+        peer.parts.append(fragment)
+        if flags & FLAG_LAST:
+            message = b"".join(peer.parts)
+            peer.parts = []
+            self._stats["delivered"] += 1
+            if self.on_message is not None:
+                self.on_message(sender, message)
+
+    def _send_ack(self, sender: bytes, peer: _Peer) -> None:
+        sack = 0
+        for seq in peer.held:
+            sack |= 1 << ((seq - peer.expected - 1) & MAX_SEQUENCE_NUMBER)
+        packet = bytes([PACKET_TYPE_ACK]) + peer.expected.to_bytes(2, "big") + sack.to_bytes(4, "big")
+        self._transmit(sender, packet)
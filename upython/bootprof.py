@@ -0,0 +1,132 @@
+"""
+bootprof.py records how long each phase of booting takes (and how much heap is left after it), then sends the
+timeline to the host once, out the User Data Relay (relay.SERIAL). cpython/bootprofile.py decodes and prints it.
+
+    boot_marks = EarlyBootMarks()       # As early as possible in main.py (see bundle_demo.py).
+    bootstrap(logger, boot_marks)       # Deletes .py files and rebundles, marking the end of each phase.
+    import bootprof                     # Only now: this is a user module.
+    bootprof.start(boot_marks)          # Takes over the checkpoints recorded so far.
+    ...import modules, initialize the app...
+    bootprof.mark("app_init")           # Marks the end of a phase.
+    bootprof.report()                   # Once the app is ready. Later calls do nothing.
+
+Checkpoints go into a fixed-size preallocated array, so profiling doesn't disturb the heap figures it records;
+marks beyond MAX_CHECKPOINTS are counted but not stored. Phase names should be string literals (no allocation),
+and only their first MAX_NAME_SIZE bytes are sent.
+
+main.py can't import this module before rebundling, so bundle_demo.py's EarlyBootMarks records the checkpoints
+up to then in the same record format, and start() copies them over.
+
+Frame format (all integers Big Endian): PACKET_TYPE_BOOT_PROFILE, boot ticks_ms (u32) when start() was called,
+index of the frame's first checkpoint (u8), total number of checkpoints (u8), dropped marks (u8), then for each
+checkpoint: microseconds since start() (u32), mem_free (u32), name length (u8), name. The timeline is split across
+as many frames as needed; the host reassembles them by start ticks and index.
+
+Caution: Ensure that these definitions match the redundant definitions in cpython/bootprofile.py.
+"""
+
+import ustruct
+import utime
+from xbee import relay
+
+try:
+    from gc import mem_free  # MicroPython.
+except ImportError:
+    from ugc import mem_free  # The CPython fakes.
+
+PACKET_TYPE_BOOT_PROFILE = 0x13
+MAX_CHECKPOINTS = 16
+MAX_NAME_SIZE = 15
+FRAME_SIZE = 84
+_HEADER = ">BIBBB"
+_HEADER_SIZE = 8
+_RECORD = ">II"
+_RECORD_SIZE = 8
+
+
+class BootProfiler:
+    """ BootProfiler holds one boot's checkpoints. Most code uses the module-level functions instead. """
+
+    def __init__(self, max_checkpoints: int = MAX_CHECKPOINTS):
+        self.start_ms = utime.ticks_ms()
+        self._start_us = utime.ticks_us()
+        self._records = bytearray(_RECORD_SIZE * max_checkpoints)  # (elapsed_us, mem_free) per checkpoint.
+        self._names = [None] * max_checkpoints
+        self.count = 0
+        self.dropped = 0
+        self.reported = False
+
+    def take_over(self, early) -> None:
+        """ take_over replaces this profiler's checkpoints with those of main.py's EarlyBootMarks. """
+        self.start_ms = early.start_ms
+        self._start_us = early.start_us
+        count = min(early.count, len(self._names))
+        self._records[:count * _RECORD_SIZE] = early.records[:count * _RECORD_SIZE]
+        self._names[:count] = early.names[:count]
+        self.count = count
+        self.dropped = early.dropped + early.count - count
+
+    def mark(self, name: str) -> None:
+        elapsed_us = utime.ticks_diff(utime.ticks_us(), self._start_us)
+        free = mem_free()
+        if self.count == len(self._names):
+            self.dropped += 1
+            return
+        ustruct.pack_into(_RECORD, self._records, self.count * _RECORD_SIZE, elapsed_us, free)
+        self._names[self.count] = name
+        self.count += 1
+
+    def report(self, send=None):
+        """ report sends the timeline out the relay (or to send(frame)) unless it was already sent. Returns Error. """
+        if self.reported:
+            return None
+        send = send if send is not None else lambda frame: relay.send(relay.SERIAL, frame)
+        frame = bytearray(FRAME_SIZE)
+        index = 0
+        while True:
+            ustruct.pack_into(_HEADER, frame, 0, PACKET_TYPE_BOOT_PROFILE, self.start_ms, index, self.count,
+                              min(self.dropped, 255))
+            first = index
+            length = _HEADER_SIZE
+            while index < self.count:
+                name = self._names[index].encode()[:MAX_NAME_SIZE]
+                if length + _RECORD_SIZE + 1 + len(name) > FRAME_SIZE:
+                    break
+                frame[length:length + _RECORD_SIZE] = self._records[index * _RECORD_SIZE:(index + 1) * _RECORD_SIZE]
+                frame[length + _RECORD_SIZE] = len(name)
+                frame[length + _RECORD_SIZE + 1:length + _RECORD_SIZE + 1 + len(name)] = name
+                length += _RECORD_SIZE + 1 + len(name)
+                index += 1
+            try:
+                send(frame[:length])
+            except OSError as ex:
+                return "bootprof.report: Failed to send checkpoint %d. Details: %s" % (first, ex)
+            if index >= self.count:
+                break
+        self.reported = True
+        return None
+
+
+profiler = None  # The BootProfiler that the module-level functions use.
+
+
+def start(early=None) -> BootProfiler:
+    """ start begins profiling this boot, continuing from main.py's EarlyBootMarks if given. """
+    global profiler
+    profiler = BootProfiler()
+    if early is not None:
+        profiler.take_over(early)
+    return profiler
+
+
+def mark(name: str) -> None:
+    """ mark records the end of a phase. Does nothing if start() wasn't called. """
+    if profiler is not None:
+        profiler.mark(name)
+
+
+def report(send=None):
+    """ report sends the timeline once (see BootProfiler.report). Returns Error. """
+    if profiler is None:
+        return "bootprof.report: start() wasn't called"
+    return profiler.report(send)
@@ -0,0 +1,109 @@
+"""
+coalesce.py packs small messages (log lines, button frames, telemetry) bound for the same destination into one
+full-size frame, so that a burst of them costs one xbee.transmit() and one frame's radio overhead instead of many.
+
+    queue = CoalescingQueue(max_delay_ms=50)
+    while True:
+        queue.add(xbee.ADDR_COORDINATOR, telemetry)   # Transmits right away only if the frame is full.
+        queue.poll()                                  # Transmits frames whose deadline has passed.
+        utime.sleep_ms(10)
+
+A frame is sent as soon as the next message wouldn't fit (or it reaches flush_size bytes), or max_delay_ms after
+its first message was added, whichever comes first. The host splits frames with cpython/coalesce.py.
+
+Frame format: PACKET_TYPE_BATCH (1 byte), then for each message its length (1 byte) followed by the message.
+
+Caution: Ensure that these definitions match the redundant definitions in cpython/coalesce.py.
+"""
+
+import utime
+import xbee
+
+from core import MAX_PACKET_SIZE, PacketBuilder
+
+PACKET_TYPE_BATCH = 0x12
+MAX_MESSAGE_SIZE = MAX_PACKET_SIZE - 2  # Room for the packet type and the message's length prefix.
+
+
+class CoalescingQueue:
+    """
+    CoalescingQueue holds one preallocated frame per destination (up to max_destinations; adding a message for
+    another destination sends the oldest pending frame to make room). If xbee.transmit() fails (e.g., ENOBUFS),
+    the frame is kept and retried by the next poll(); meanwhile add() returns False once the frame is full.
+    """
+
+    def __init__(self, transmit=None, max_delay_ms: int = 50, flush_size: int = MAX_PACKET_SIZE,
+                 max_destinations: int = 4):
+        self.transmit = transmit if transmit is not None else xbee.transmit
+        self.max_delay_ms = max_delay_ms
+        self.flush_size = min(flush_size, MAX_PACKET_SIZE)
+        self.max_destinations = max_destinations
+        self._frames = {}  # Destination (bytes) -> [PacketBuilder, ticks_ms of its first message]
+        self._spare = []  # Builders of flushed destinations, reused so that frames are allocated only once.
+        self.stats = {"messages": 0, "frames": 0, "transmit_errors": 0, "rejected": 0, "dropped_frames": 0}
+
+    def add(self, dest, message) -> bool:
+        """ add queues a message of up to MAX_MESSAGE_SIZE bytes. Returns False if it can't be queued right now. """
+        if len(message) > MAX_MESSAGE_SIZE:
+            self.stats["rejected"] += 1
+            return False
+        dest = bytes(dest)
+        frame = self._frames.get(dest)
+        if frame is not None and frame[0].length + 1 + len(message) > MAX_PACKET_SIZE:
+            if not self._flush(dest, frame):
+                self.stats["rejected"] += 1
+                return False
+            frame = None
+        if frame is None:
+            frame = self._open(dest)
+        builder = frame[0]
+        builder.put_u8(len(message))
+        builder.put_bytes(message)
+        self.stats["messages"] += 1
+        if builder.length >= self.flush_size:
+            self._flush(dest, frame)
+        return True
+
+    def poll(self) -> None:
+        """ poll sends every frame whose deadline has passed (and retries frames whose transmit failed). """
+        now = utime.ticks_ms()
+        for dest in list(self._frames):
+            frame = self._frames[dest]
+            if utime.ticks_diff(now, frame[1]) >= self.max_delay_ms:
+                self._flush(dest, frame)
+
+    def flush(self) -> None:
+        """ flush sends every pending frame now, e.g., before going to sleep. """
+        for dest in list(self._frames):
+            self._flush(dest, self._frames[dest])
+
+    def pending(self) -> int:
+        """ pending returns the number of frames waiting to be sent. """
+        return len(self._frames)
+
+    def _open(self, dest: bytes):
+        """ _open starts a new frame for dest, returning its [builder, first_ticks] entry. """
+        if len(self._frames) >= self.max_destinations:
+            oldest = None
+            for d in self._frames:
+                if oldest is None or utime.ticks_diff(self._frames[oldest][1], self._frames[d][1]) > 0:
+                    oldest = d
+            if not self._flush(oldest, self._frames[oldest]):
+                self._spare.append(self._frames.pop(oldest)[0])  # There's no room to keep it, so it's lost.
+                self.stats["dropped_frames"] += 1
+        builder = self._spare.pop() if self._spare else PacketBuilder(MAX_PACKET_SIZE)
+        builder.reset()
+        builder.put_u8(PACKET_TYPE_BATCH)
+        frame = self._frames[dest] = [builder, utime.ticks_ms()]
+        return frame
+
+    def _flush(self, dest: bytes, frame) -> bool:
+        """ _flush transmits a frame. Returns False (keeping the frame) if the transmit failed. """
+        try:
+            self.transmit(dest, frame[0].packet())
+        except OSError:
+            self.stats["transmit_errors"] += 1
+            return False
+        self.stats["frames"] += 1
+        self._spare.append(self._frames.pop(dest)[0])
+        return True
@@ -1,11 +1,17 @@
 import io
 import sys
 
+try:
+    import ustruct as struct
+except ImportError:
+    import struct
+
 
 Error = str
 Success = None
 
 MAX_SEQUENCE_NUMBER = 2**16 - 1  # 16-bit sequence number.
+MAX_PACKET_SIZE = 84  # Largest unfragmented Zigbee payload without APS encryption (ATNP reports the exact value).
 
 
 def exception_details(ex):
@@ -73,20 +79,222 @@ def invert(value: int):
     return 1 if value == 0 else 0
 
 
+class SequenceWindow:
+    """
+    SequenceWindow tracks the sequence numbers received from each sender: it rejects duplicates, detects gaps,
+    counts lost frames and, optionally, puts out-of-order frames back in order.
+
+    Each sender costs one small list: the most recent sequence number, a bitmap of which of the `window` frames
+    up to it have arrived, and counters. accept() is O(1). The default window of 30 frames keeps the bitmap a
+    small int on MicroPython, so tracking doesn't allocate per frame; the host can afford wider windows.
+
+        window = SequenceWindow(reorder_size=4, deliver=handle_payload)
+        while True:
+            msg = xbee.receive()
+            if msg:
+                window.push(msg["sender_eui64"], sequence_number_of(msg), msg["payload"])
+
+    Frames are "lost" once a newer frame shows they were skipped; if one arrives late after all, it's counted as
+    late instead. Frames older than the window can't be told apart from duplicates and are rejected as stale.
+    """
+
+    NEW = 0  # The next frame in sequence, or the first from this sender.
+    GAP = 1  # A newer frame than expected: the frames in between are missing.
+    LATE = 2  # An older frame that fills a gap.
+    DUPLICATE = 3
+    STALE = 4  # Older than the window, so it can't be checked.
+
+    _HIGHEST = 0  # Indexes into each sender's state list.
+    _BITMAP = 1  # Bit d is set if the frame d before _HIGHEST has arrived.
+    _RECEIVED = 2
+    _DUPLICATES = 3
+    _LOST = 4
+    _LATE = 5
+    _STALE = 6
+    _NEXT = 7  # Next sequence number to deliver, when reordering.
+    _FIRST = 8  # Oldest sequence number seen, or None once the window has moved past it (see accept()).
+
+    def __init__(self, window: int = 30, max_sequence_number: int = MAX_SEQUENCE_NUMBER, reorder_size: int = 0,
+                 deliver=None):
+        self.window = window
+        self.max_sequence_number = max_sequence_number
+        self.reorder_size = reorder_size
+        self.deliver = deliver  # deliver(sender, sequence_number, payload) receives push()ed frames, in order.
+        self._mask = (1 << window) - 1
+        self._senders = {}  # Sender -> state list.
+        self._held = {}  # Sender -> {sequence number: payload} of frames waiting for earlier ones.
+
+    def __len__(self):
+        return len(self._senders)
+
+    def forget(self, sender) -> None:
+        self._senders.pop(sender, None)
+        self._held.pop(sender, None)
+
+    def accept(self, sender, sequence_number: int) -> int:
+        """ accept records a frame's sequence number and classifies it as NEW, GAP, LATE, DUPLICATE or STALE. """
+        state = self._senders.get(sender)
+        if state is None:
+            self._senders[sender] = [sequence_number, 1, 1, 0, 0, 0, 0, sequence_number, sequence_number]
+            return self.NEW
+        highest = state[self._HIGHEST]
+        modulus = self.max_sequence_number + 1
+        if sequence_more_recent(sequence_number, highest, self.max_sequence_number):
+            distance = (sequence_number - highest) % modulus
+            if distance < self.window:
+                state[self._BITMAP] = ((state[self._BITMAP] << distance) & self._mask) | 1
+            else:
+                state[self._BITMAP] = 1
+            state[self._HIGHEST] = sequence_number
+            state[self._RECEIVED] += 1
+            first = state[self._FIRST]
+            if first is not None and (sequence_number - first) % modulus >= self.window:
+                # No late frame can be older than the first one any more. Forget it before wraparound could
+                # make it look more recent than the frames around it.
+                state[self._FIRST] = None
+            if distance > 1:
+                state[self._LOST] += distance - 1
+                return self.GAP
+            return self.NEW
+        distance = (highest - sequence_number) % modulus
+        if distance >= self.window:
+            state[self._STALE] += 1
+            return self.STALE
+        bit = 1 << distance
+        if distance == 0 or state[self._BITMAP] & bit:
+            state[self._DUPLICATES] += 1
+            return self.DUPLICATE
+        state[self._BITMAP] |= bit
+        state[self._RECEIVED] += 1
+        state[self._LATE] += 1
+        first = state[self._FIRST]
+        if first is not None and sequence_more_recent(first, sequence_number, self.max_sequence_number):
+            # Older than the first frame seen (reordered at start-up): frames before the first one were never
+            # expected, so only the frames in between are now missing.
+            state[self._LOST] += (first - sequence_number) % modulus - 1
+            state[self._FIRST] = sequence_number
+        else:
+            state[self._LOST] -= 1
+        return self.LATE
+
+    def push(self, sender, sequence_number: int, payload) -> int:
+        """
+        push accept()s a frame and passes it to deliver() unless it's a duplicate or stale. With a reorder_size,
+        frames that arrive ahead of a gap are held (up to reorder_size per sender) until the gap is filled;
+        once too many are held, the gap is given up on and delivery skips ahead. A frame that arrives after
+        its gap was given up on is dropped rather than delivered out of order. Returns accept()'s result.
+        """
+        result = self.accept(sender, sequence_number)
+        if result >= self.DUPLICATE:
+            return result
+        if self.reorder_size <= 0:
+            self.deliver(sender, sequence_number, payload)
+            return result
+        state = self._senders[sender]
+        modulus = self.max_sequence_number + 1
+        next_sequence_number = state[self._NEXT]
+        if sequence_number == next_sequence_number:
+            self.deliver(sender, sequence_number, payload)
+            state[self._NEXT] = (sequence_number + 1) % modulus
+            self._release(sender, state)
+        elif sequence_more_recent(sequence_number, next_sequence_number, self.max_sequence_number):
+            held = self._held.get(sender)
+            if held is None:
+                held = self._held[sender] = {}
+            held[sequence_number] = payload
+            if len(held) > self.reorder_size:
+                self._skip_gap(sender, state, held)
+        return result
+
+    def flush(self, sender=None) -> None:
+        """ flush delivers every held frame (of one sender, or all), giving up on the gaps before them. """
+        for s in ([sender] if sender is not None else list(self._held)):
+            held = self._held.get(s)
+            state = self._senders.get(s)
+            while held and state:
+                self._skip_gap(s, state, held)
+
+    def _skip_gap(self, sender, state, held) -> None:
+        modulus = self.max_sequence_number + 1
+        next_sequence_number = state[self._NEXT]
+        oldest = None
+        for sequence_number in held:
+            if oldest is None or (sequence_number - next_sequence_number) % modulus < \
+                    (oldest - next_sequence_number) % modulus:
+                oldest = sequence_number
+        state[self._NEXT] = oldest
+        self._release(sender, state)
+
+    def _release(self, sender, state) -> None:
+        """ _release delivers the held frames that are now next in sequence. """
+        held = self._held.get(sender)
+        modulus = self.max_sequence_number + 1
+        while held and state[self._NEXT] in held:
+            sequence_number = state[self._NEXT]
+            self.deliver(sender, sequence_number, held.pop(sequence_number))
+            state[self._NEXT] = (sequence_number + 1) % modulus
+
+    def stats(self, sender=None) -> dict:
+        """
+        stats returns the counters for one sender, or the totals over all senders:
+        received, duplicates, lost, late, stale, held (frames waiting for reordering) and loss_rate.
+        """
+        states = [self._senders[sender]] if sender is not None else self._senders.values()
+        result = {"received": 0, "duplicates": 0, "lost": 0, "late": 0, "stale": 0, "held": 0}
+        for state in states:
+            result["received"] += state[self._RECEIVED]
+            result["duplicates"] += state[self._DUPLICATES]
+            result["lost"] += state[self._LOST]
+            result["late"] += state[self._LATE]
+            result["stale"] += state[self._STALE]
+        for s, held in self._held.items():
+            if sender is None or s == sender:
+                result["held"] += len(held)
+        expected = result["received"] + result["lost"]
+        result["loss_rate"] = result["lost"] / expected if expected else 0.0
+        return result
+
+
 class ButtonBuffer:
     """
     ButtonBuffer stores a sequence of Boolean GPIO input values.
     This allows the push button inputs to be sent redundantly across the network, for reliability.
+
+    The window holds the last 8, 16, 32 (the default), 64 or 128 values, so the redundancy depth (and payload
+    size) can be tuned to the link quality. encode_transitions() offers a compact alternative to serialize()
+    that only covers the frames the receiver hasn't acknowledged yet.
     """
 
-    def __init__(self, data: int = 0):
-        self._data = data
+    WINDOW_SIZES = (8, 16, 32, 64, 128)
+
+    # The history is kept in 16-bit words, most significant (oldest) first, because MicroPython's small ints stop
+    # at 2**30: a single int holding a 32-bit or wider window would be a heap-allocated big int after every put().
+    # Only get_uint32() and repr() build the combined int.
+    _WORD_BITS = 16
+
+    def __init__(self, data: int = 0, bits: int = 32):
+        if bits not in self.WINDOW_SIZES:
+            raise ValueError("ButtonBuffer window must be one of %s bits" % (self.WINDOW_SIZES,))
+        self.bits = bits
+        self.serialized_size = bits // 8
+        self._words = [0] * ((bits + self._WORD_BITS - 1) // self._WORD_BITS)
+        self._top_mask = (1 << (bits - self._WORD_BITS * (len(self._words) - 1))) - 1
+        last = len(self._words) - 1
+        for i in range(len(self._words)):
+            self._words[last - i] = (data >> (self._WORD_BITS * i)) & 0xFFFF
+        self._words[0] &= self._top_mask
 
     def __repr__(self):
-        return "ButtonBuffer(uint32=0x%08x)" % self._data
+        return "ButtonBuffer(uint%d=0x%0*x)" % (self.bits, self.bits // 4, self.get_uint32())
 
     def put(self, input_value: int) -> None:
-        self._data = ((self._data << 1) & 0xFFFFFFFF) | (input_value & 0x01)
+        words = self._words
+        carry = input_value & 0x01
+        for i in range(len(words) - 1, -1, -1):
+            word = words[i]
+            words[i] = ((word << 1) & 0xFFFF) | carry
+            carry = word >> 15
+        words[0] &= self._top_mask
 
     def get(self, delay: int = 0):
         """
@@ -95,28 +303,248 @@ class ButtonBuffer:
         get(1) gives the value from the previous frame.
         And so on.
         """
-        if delay < 0 or delay > 31:
+        if delay < 0 or delay >= self.bits:
             return 0
-        return (self._data >> delay) & 0x01
+        return (self._words[len(self._words) - 1 - delay // self._WORD_BITS] >> (delay % self._WORD_BITS)) & 0x01
 
     def get_uint32(self) -> int:
         """
-        get_int returns the data as an integer.
+        get_int returns the data as an integer (which, despite the name, has as many bits as the window).
+        On MicroPython this allocates for windows of more than 30 bits; put(), get() and serialize_into() don't.
         """
-        return self._data
+        data = 0
+        for word in self._words:
+            data = (data << self._WORD_BITS) | word
+        return data
 
     def serialize(self) -> bytearray:
-        """ serialize returns a binary representation of the data. """
-        d = bytearray(4)
-        d[0] = (self._data >> 24) & 0xFF  # Transmit in Big Endian format.
-        d[1] = (self._data >> 16) & 0xFF
-        d[2] = (self._data >> 8) & 0xFF
-        d[3] = self._data & 0xFF
+        """ serialize returns a binary representation of the data: bits // 8 bytes, in Big Endian format. """
+        d = bytearray(self.serialized_size)
+        self.serialize_into(d)
         return d
 
     def deserialize(self, d: bytearray) -> Error:
         """ deserialize unpacks and validates the binary data. Updates the data members upon success."""
-        if len(d) != 4:
-            return Error("Expected data to be 4 bytes long but got %d bytes" % len(d))
-        self._data = (d[0] << 24) | (d[1] << 16) | (d[2] << 8) | d[3]
+        if len(d) != self.serialized_size:
+            return Error("Expected data to be %d bytes long but got %d bytes" % (self.serialized_size, len(d)))
+        return self.deserialize_from(d)
+
+    def serialize_into(self, buf, offset: int = 0) -> int:
+        """
+        serialize_into writes the same bytes as serialize() into buf at the given offset, without allocating.
+        Returns the offset just past the data, so that calls can be chained while assembling a packet.
+        """
+        if self.bits == 8:
+            buf[offset] = self._words[0]
+            return offset + 1
+        for word in self._words:
+            buf[offset] = word >> 8
+            buf[offset + 1] = word & 0xFF
+            offset += 2
+        return offset
+
+    def deserialize_from(self, buf, offset: int = 0) -> Error:
+        """ deserialize_from is like deserialize() but reads the data at the given offset of a larger buffer. """
+        if offset < 0 or len(buf) - offset < self.serialized_size:
+            return Error("Expected %d bytes at offset %d but the buffer is %d bytes long" %
+                         (self.serialized_size, offset, len(buf)))
+        if self.bits == 8:
+            self._words[0] = buf[offset]
+        else:
+            for i in range(len(self._words)):
+                self._words[i] = (buf[offset + 2 * i] << 8) | buf[offset + 2 * i + 1]
         return Success
+
+    def encode_transitions(self, sequence_number: int, since_sequence_number: int,
+                           max_sequence_number: int = MAX_SEQUENCE_NUMBER) -> bytearray:
+        """
+        encode_transitions encodes only the values of the frames after since_sequence_number (e.g., the last one
+        the receiver acknowledged) up to sequence_number, the frame of the current value, as run lengths.
+        At least the current frame is encoded, and at most the whole window.
+
+        Byte 0 holds the oldest encoded value (bit 7) and the number of encoded frames minus one (bits 0-6).
+        Each following byte is the length of a run of equal values, oldest first, with the value toggling at
+        the end of each run. The last run is implied by the frame count, so an input that hasn't changed
+        costs a single byte no matter how deep the window is.
+        """
+        count = (sequence_number - since_sequence_number) % (max_sequence_number + 1)
+        count = max(1, min(count, self.bits))
+        value = self.get(count - 1)
+        d = bytearray(1)
+        d[0] = (value << 7) | (count - 1)
+        run = 1
+        for delay in range(count - 2, -1, -1):
+            if self.get(delay) == value:
+                run += 1
+            else:
+                d.append(run)
+                value ^= 1
+                run = 1
+        return d
+
+    def put_transitions(self, d) -> Error:
+        """
+        put_transitions decodes the output of encode_transitions() and put()s each encoded frame, oldest first.
+        Validates the data before changing anything.
+        """
+        if len(d) < 1:
+            return Error("Expected at least 1 byte of transitions but got 0 bytes")
+        count = (d[0] & 0x7F) + 1
+        total = 0
+        for i in range(1, len(d)):
+            if d[i] == 0:
+                return Error("Invalid zero-length run at byte %d" % i)
+            total += d[i]
+        if total >= count:
+            return Error("Runs cover %d frames but only %d frames were encoded" % (total, count))
+        value = d[0] >> 7
+        for i in range(1, len(d)):
+            for _ in range(d[i]):
+                self.put(value)
+            value ^= 1
+        for _ in range(count - total):
+            self.put(value)
+        return Success
+
+
+class MultiButtonBuffer:
+    """
+    MultiButtonBuffer stores the last 32 values of many GPIO inputs in one bytearray, so that a frame's inputs
+    are recorded with a single put_all() call and sent as a single contiguous payload.
+
+    The buffer is a ring of 32 time slices, each (channels + 7) // 8 bytes wide; bit c of a slice is channel c.
+    put_all() therefore overwrites one slice in place instead of shifting every channel's history, and never
+    builds the large ints that shifting a 32-bit value creates on MicroPython.
+    The serialized form lists the slices from oldest to newest (just as ButtonBuffer sends its oldest bit first),
+    and each slice is little endian: byte 0 holds channels 0-7, byte 1 channels 8-15, and so on.
+    """
+
+    HISTORY = 32
+
+    def __init__(self, channels: int = 8):
+        self.channels = channels
+        self._width = (channels + 7) // 8
+        self._last_mask = 0xFF >> (8 * self._width - channels)  # Ignore bits above the last channel.
+        self._data = bytearray(self.HISTORY * self._width)
+        self._next = 0  # Slice that the next put_all() overwrites, which is also the oldest slice.
+        self.serialized_size = len(self._data)
+
+    def __repr__(self):
+        return "MultiButtonBuffer(channels=%d)" % self.channels
+
+    def put_all(self, bits: int) -> None:
+        """ put_all records one frame: bit c of bits is the current value of channel c. """
+        offset = self._next * self._width
+        last = self._width - 1
+        for i in range(last):
+            self._data[offset + i] = (bits >> (8 * i)) & 0xFF
+        self._data[offset + last] = (bits >> (8 * last)) & self._last_mask
+        self._next = (self._next + 1) % self.HISTORY
+
+    def get_all(self, delay: int = 0) -> int:
+        """ get_all returns every channel's value at the given delay as an int (bit c is channel c). """
+        if delay < 0 or delay >= self.HISTORY:
+            return 0
+        offset = ((self._next - 1 - delay) % self.HISTORY) * self._width
+        bits = 0
+        for i in range(self._width):
+            bits |= self._data[offset + i] << (8 * i)
+        return bits
+
+    def get(self, channel: int, delay: int = 0) -> int:
+        """ get returns one channel's value at the given delay, like ButtonBuffer.get(), or zero if out of range. """
+        if delay < 0 or delay >= self.HISTORY or channel < 0 or channel >= self.channels:
+            return 0
+        offset = ((self._next - 1 - delay) % self.HISTORY) * self._width
+        return (self._data[offset + channel // 8] >> (channel % 8)) & 0x01
+
+    def channel(self, channel: int) -> ButtonBuffer:
+        """ channel returns one channel's history as a ButtonBuffer, e.g., to talk to code that expects one. """
+        data = 0
+        for delay in range(self.HISTORY):
+            data |= self.get(channel, delay) << delay
+        return ButtonBuffer(data)
+
+    def serialize(self) -> bytearray:
+        """ serialize returns the 32 slices from oldest to newest in one bytearray of 32 * width bytes. """
+        d = bytearray(len(self._data))
+        split = self._next * self._width
+        view = memoryview(self._data)
+        d[:len(d) - split] = view[split:]
+        d[len(d) - split:] = view[:split]
+        return d
+
+    def serialize_into(self, buf, offset: int = 0) -> int:
+        """ serialize_into writes the same bytes as serialize() into buf at the given offset, without allocating. """
+        size = len(self._data)
+        split = self._next * self._width
+        for i in range(size):
+            buf[offset + i] = self._data[(split + i) % size]
+        return offset + size
+
+    def deserialize(self, d: bytearray) -> Error:
+        """ deserialize unpacks and validates the binary data. Updates the data members upon success."""
+        if len(d) != len(self._data):
+            return Error("Expected data to be %d bytes long but got %d bytes" % (len(self._data), len(d)))
+        self._data[:] = d
+        self._next = 0
+        return Success
+
+
+class PacketBuilder:
+    """
+    PacketBuilder assembles outgoing packets in one preallocated bytearray, so that a periodic transmit loop
+    doesn't allocate (and fragment the small heap) for every packet:
+
+        builder = PacketBuilder()
+        while True:
+            builder.reset()
+            builder.put_u8(PACKET_TYPE_BUTTONS)
+            builder.put_u16(sequence_number)
+            builder.put_button_buffer(buttons)
+            xbee.transmit(COORDINATOR_ADDRESS, builder.packet())
+
+    packet() returns a memoryview of the bytes written so far. The views are cached per length, so a loop that
+    sends packets of the same length reuses the same view. Overfilling the packet raises ValueError.
+    """
+
+    def __init__(self, size: int = MAX_PACKET_SIZE):
+        self.buf = bytearray(size)
+        self.length = 0
+        self._view = memoryview(self.buf)
+        self._packets = {}  # Length -> memoryview of buf[:length].
+
+    def reset(self) -> None:
+        self.length = 0
+
+    def _reserve(self, num_bytes: int) -> int:
+        offset = self.length
+        if offset + num_bytes > len(self.buf):
+            raise ValueError("packet full")
+        self.length = offset + num_bytes
+        return offset
+
+    def put_u8(self, value: int) -> None:
+        self.buf[self._reserve(1)] = value & 0xFF
+
+    def put_u16(self, value: int) -> None:
+        struct.pack_into(">H", self.buf, self._reserve(2), value & 0xFFFF)
+
+    def put_u32(self, value: int) -> None:
+        # Values of 2**30 and up are big ints on MicroPython, so they allocate; put_u16() twice doesn't.
+        struct.pack_into(">I", self.buf, self._reserve(4), value & 0xFFFFFFFF)
+
+    def put_bytes(self, data) -> None:
+        offset = self._reserve(len(data))
+        self.buf[offset:self.length] = data
+
+    def put_button_buffer(self, button_buffer) -> None:
+        """ put_button_buffer appends a ButtonBuffer or MultiButtonBuffer in its serialized form. """
+        button_buffer.serialize_into(self.buf, self._reserve(button_buffer.serialized_size))
+
+    def packet(self) -> memoryview:
+        view = self._packets.get(self.length)
+        if view is None:
+            view = self._view[:self.length]
+            self._packets[self.length] = view
+        return view
@@ -2,9 +2,21 @@
 """ main.py contains the main application to run on the XBee device. """
 
 import uos
+import ustruct
+import utime
 import umachine
 from xbee import atcmd, relay
 
+try:
+    from ubinascii import crc32  # Not every firmware build includes it (MICROPY_PY_UBINASCII_CRC32).
+except ImportError:
+    crc32 = None
+
+try:
+    from gc import mem_free
+except ImportError:
+    from ugc import mem_free  # Only under the CPython fakes; MicroPython's gc always has mem_free.
+
 
 class UserDataRelayLogger:
 
@@ -18,26 +30,173 @@ class UserDataRelayLogger:
         interface so that the Connect Sensor can print it out its Serial Console.
         """
         dest = relay.SERIAL
-        data = bytes([self.CSXB_MSG_LOG]) + msg
+        data = bytes([self.CSXB_MSG_LOG]) + (msg.encode() if isinstance(msg, str) else msg)
         try:
             relay.send(dest, data)
         except:
             pass  # Do nothing because relay must be broken so we have nowhere to send the error!
 
+    def poll(self):
+        pass  # Nothing is buffered.
+
+    def flush(self):
+        pass
+
+
+class BufferedUserDataRelayLogger:
+    """
+    BufferedUserDataRelayLogger is a UserDataRelayLogger that doesn't make the caller wait for relay.send().
+    print() only appends the message (plus a newline) to a preallocated ring buffer; poll() sends the buffered text
+    out the relay.SERIAL interface, packed into frames of up to frame_size bytes, at most max_frames_per_poll frames
+    per call. Call poll() from the application's main loop and flush() before anything that restarts MicroPython.
+
+    Backpressure: if relay.send() fails (e.g., ENOBUFS because the host isn't keeping up), the text stays buffered
+    for the next poll(). If the buffer is full, new messages are dropped and counted, and a message saying how many
+    were lost is sent in their place. Each frame is CSXB_MSG_LOG_STREAM followed by a chunk of the text stream, so
+    a message can span frames; the host's log collector (cpython/logcollector.py) joins them back into lines.
+    (UserDataRelayLogger's CSXB_MSG_LOG frames still hold exactly one message each.)
+
+    Why not logger.py's Logger, which has the same kind of ring buffer? It's a user module (and so is core.py, which
+    it uses), and this logger has to work before rebundling, when no user modules may be imported. So this is a
+    deliberately small copy that depends only on built-in modules. It also drops the newest messages rather than the
+    oldest, so that the start of a boot's log survives, and it sends out the relay rather than over the network.
+    """
+
+    # Caution: Ensure that CSXB_MSG_LOG_STREAM matches the redundant definition in cpython/logcollector.py.
+    CSXB_MSG_LOG_STREAM = 0x14
+
+    def __init__(self, capacity=2048, frame_size=84, max_frames_per_poll=4):
+        self.max_frames_per_poll = max_frames_per_poll
+        self.stats = {"messages": 0, "dropped": 0, "frames": 0, "send_errors": 0}
+        self._ring = bytearray(capacity)
+        self._ring_view = memoryview(self._ring)
+        self._head = 0  # Offset of the oldest unsent byte.
+        self._used = 0
+        self._unreported_drops = 0
+        self._before_drops = 0  # Buffered bytes that were logged before the unreported drops.
+        self._frame = bytearray(frame_size)
+        self._frame[0] = self.CSXB_MSG_LOG_STREAM
+        self._frame_view = memoryview(self._frame)
+
+    def print(self, msg):
+        data = msg.encode() if isinstance(msg, str) else msg
+        capacity = len(self._ring)
+        if self._used + len(data) + 1 > capacity:
+            if not self._unreported_drops:
+                self._before_drops = self._used
+            self.stats["dropped"] += 1
+            self._unreported_drops += 1
+            return
+        tail = (self._head + self._used) % capacity
+        first = min(len(data), capacity - tail)
+        view = memoryview(data)
+        self._ring[tail:tail + first] = view[:first]
+        self._ring[0:len(data) - first] = view[first:]
+        self._ring[(tail + len(data)) % capacity] = 0x0A
+        self._used += len(data) + 1
+        self.stats["messages"] += 1
+
+    def pending(self):
+        """ pending returns the number of buffered bytes that haven't been sent yet. """
+        return self._used
+
+    def poll(self):
+        """ poll sends up to max_frames_per_poll frames of buffered text. """
+        for _ in range(self.max_frames_per_poll):
+            if not (self._used or self._unreported_drops) or not self._send_frame():
+                return
+
+    def flush(self):
+        """ flush sends everything that's buffered, giving up if the relay fails. """
+        while self._used or self._unreported_drops:
+            if not self._send_frame():
+                return
+
+    def _send_frame(self):
+        if self._unreported_drops and not self._before_drops:
+            data = bytes([self.CSXB_MSG_LOG_STREAM]) + ("%d log messages dropped\n" % self._unreported_drops).encode()
+            if not self._send(data):
+                return False
+            self._unreported_drops = 0
+            return True
+        capacity = len(self._ring)
+        length = min(self._used, len(self._frame) - 1)
+        if self._unreported_drops:
+            length = min(length, self._before_drops)  # The frame after this one reports the drops.
+        first = min(length, capacity - self._head)
+        self._frame[1:1 + first] = self._ring_view[self._head:self._head + first]
+        self._frame[1 + first:1 + length] = self._ring_view[0:length - first]
+        if not self._send(self._frame_view[:1 + length]):
+            return False
+        self._head = (self._head + length) % capacity
+        self._used -= length
+        self._before_drops = max(0, self._before_drops - length)
+        return True
+
+    def _send(self, data):
+        try:
+            relay.send(relay.SERIAL, data)
+        except:
+            self.stats["send_errors"] += 1
+            return False
+        self.stats["frames"] += 1
+        return True
+
 
 class DualSinkLogger:
     """
     DualSinkLogger sends the message to both the given logger (e.g., a UserDataRelayLogger)
     and to REPL/stdout. This ensures that the developer can receive the message regardless of
     whether the developer is connected to the XBee via API Frames or the via the REPL terminal.
+    Set echo to False to skip the (slow, blocking) REPL output, e.g., in chatty debug builds.
     """
 
-    def __init__(self, logger):
+    def __init__(self, logger, echo=True):
         self.logger = logger
+        self.echo = echo
 
     def print(self, msg):
         self.logger.print(msg)
-        print(msg)  # This is the standard library print function.
+        if self.echo:
+            print(msg)  # This is the standard library print function.
+
+    def poll(self):
+        self.logger.poll()
+
+    def flush(self):
+        self.logger.flush()
+
+
+class EarlyBootMarks:
+    """
+    EarlyBootMarks records bootstrap()'s checkpoints for the boot profiler. bootprof.py is a user module, so main.py
+    can't import it until after rebundling; instead, the app passes this object to bootprof.start(), which takes
+    over the checkpoints recorded so far. Like the loggers above, this depends only on built-in modules.
+    """
+
+    MAX_CHECKPOINTS = 4
+
+    # Caution: Ensure that RECORD matches bootprof.py's _RECORD: (microseconds since start, mem_free) per checkpoint.
+    RECORD = ">II"
+    RECORD_SIZE = 8
+
+    def __init__(self):
+        self.start_ms = utime.ticks_ms()
+        self.start_us = utime.ticks_us()
+        self.records = bytearray(self.RECORD_SIZE * self.MAX_CHECKPOINTS)  # Preallocated so marks don't allocate.
+        self.names = [None] * self.MAX_CHECKPOINTS
+        self.count = 0
+        self.dropped = 0
+
+    def mark(self, name):
+        elapsed_us = utime.ticks_diff(utime.ticks_us(), self.start_us)
+        free = mem_free()
+        if self.count == len(self.names):
+            self.dropped += 1
+            return
+        ustruct.pack_into(self.RECORD, self.records, self.count * self.RECORD_SIZE, elapsed_us, free)
+        self.names[self.count] = name
+        self.count += 1
 
 
 def delete_any_dot_py_files(logger):
@@ -74,12 +233,45 @@ def djb2(data, seed=5381):
      perform the hash in chunks-- see unit tests for example.
      """
     # https://stackoverflow.com/questions/16745387/python-32-bit-and-64-bit-integer-math-with-intentional-overflow
+    # One mask per byte is enough: (h * 33 + d) mod 2**32 doesn't depend on masking h * 33 first.
     hash = seed & 0XFFFFFFFF
     for d in data:
-        hash = 0xFFFFFFFF & (0XFFFFFFFF & (hash * 33) + d)
+        hash = (hash * 33 + d) & 0xFFFFFFFF
     return hash
 
 
+def bundle_hash(filenames, algorithm=None):
+    """
+    bundle_hash hashes the contents of the given files (in order) and returns the string to store in ATKP.
+    The algorithm is "crc32" (ubinascii.crc32, which runs in C) when the firmware has it, else "djb2" (a Python loop,
+    much slower; hash_benchmark.py measures both, but hasn't been run on an XBee 3 yet). The ATKP prefix names the
+    algorithm, so a firmware that switches algorithms rebundles once rather than comparing hashes of different kinds.
+
+    Why not a @micropython.viper or @micropython.native djb2? The XBee 3 firmware doesn't include the native code
+    emitters, and a module that uses them fails to compile as a whole, so main.py couldn't even fall back.
+
+    Caution: Ensure that this matches bundle_hash() in cpython/bundlehash.py, which computes the same strings at
+    build time.
+    """
+    if algorithm is None:
+        algorithm = "crc32" if crc32 is not None else "djb2"
+    running_hash = 0 if algorithm == "crc32" else djb2(b"")
+    buf = bytearray(1024)
+    view = memoryview(buf)
+    for fname in filenames:
+        with open(fname, "rb") as f:
+            while True:
+                num_bytes = f.readinto(buf)
+                if not num_bytes:  # readinto() returns 0 when the end of the file is reached.
+                    break
+                if algorithm == "crc32":
+                    running_hash = crc32(view[:num_bytes], running_hash)
+                else:
+                    running_hash = djb2(view[:num_bytes], running_hash)
+    # ATKP field must contain no more than 20 ASCII characters.
+    return ("CRC32: 0x%08X" if algorithm == "crc32" else "Bundle: 0x%08X") % running_hash
+
+
 def rebundle_if_necessary(logger, desired_bundle):
     """
     rebundle_if_necessary checks whether the code in the bundle flash (uos.bundle()) matches the code
@@ -188,6 +380,7 @@ def rebundle_if_necessary(logger, desired_bundle):
         logger.print("Bypassing bundling feature. Ensuring that bundled code has been deleted.")
         if len(uos.bundle()) > 0:  # If there are any bundled modules...
             uos.bundle(None)  # Delete contents of the bundle.
+            logger.flush()
             umachine.soft_reset()  # Restart MicroPython interpreter.
         return
 
@@ -200,15 +393,7 @@ def rebundle_if_necessary(logger, desired_bundle):
 
     # Calculate the hash of all .mpy files on the device.
     mpy_filenames = ['%s.mpy' % m for m in desired_bundle]
-    running_hash = djb2(b"")
-    for fname in mpy_filenames:
-        with open(fname, "rb") as f:
-            while True:
-                chunk = f.read(1024)
-                if not chunk:  # read() returns a zero-length buffer when the end of the file is reached.
-                    break
-                running_hash = djb2(chunk, running_hash)
-    desired_hash = "Bundle: 0x%08X" % running_hash  # ATKP field must contain no more than 20 ASCII characters.
+    desired_hash = bundle_hash(mpy_filenames)
     logger.print("desired_bundle: %s\ndesired_hash: %s" % (desired_bundle, desired_hash))
 
     # Check for any problems with the bundled modules. I've noticed that sometimes a zero-length module name string
@@ -252,26 +437,83 @@ def rebundle_if_necessary(logger, desired_bundle):
         return
     logger.print("Updating bundle. Reason: %s" % reason_to_bundle)
     atcmd('KP', desired_hash)
+    logger.flush()  # Buffered log messages would be lost when the interpreter restarts.
 
     uos.bundle(None)  # Bundling seems to succeed more often if we first explicitly empty it like this.
     uos.bundle(*mpy_filenames)  # MUST be the last line in function because this restarts the MicroPython interpreter.
     # In other words, if the above us.bundle(...) call is successful, this function never returns.
 
 
-def bootstrap(logger):
+# Caution: Ensure that BOOT_STATE_FILE matches BOOT_STATE_PATH in cpython/core.py.
+BOOT_STATE_FILE = "boot_state.txt"
+
+
+def boot_signature(desired_bundle):
+    """
+    boot_signature returns a short string that changes whenever a file in /flash is added, removed, renamed or
+    resized, or the bundle's contents change. It costs one uos.ilistdir() and reads no file contents.
+
+    Caution: Files can change without changing size, so anything that writes files (i.e., the deploy step in
+    cpython/core.py) must delete BOOT_STATE_FILE to force the full checks on the next boot.
     """
-    Deletes any .py files and performs rebundling if necessary.
+    running_hash = djb2(b"")
+    for entry in uos.ilistdir("/flash"):
+        if entry[0] == BOOT_STATE_FILE:
+            continue
+        running_hash = djb2(entry[0].encode(), running_hash)
+        running_hash = 0xFFFFFFFF & (running_hash * 33 + entry[3])  # Mix in the size (0 for directories).
+    return "%08X %s %s" % (running_hash, ",".join(uos.bundle()), ",".join(desired_bundle))
+
+
+def read_boot_state():
+    try:
+        with open(BOOT_STATE_FILE) as f:
+            return f.read()
+    except OSError:
+        return ""  # First boot, or the deploy step invalidated it.
+
+
+def write_boot_state(signature, logger):
+    try:
+        with open(BOOT_STATE_FILE, "w") as f:
+            f.write(signature)
+    except OSError as ex:
+        logger.print("write_boot_state: Failed to save boot state. Details: %s" % ex)
+
+
+def bootstrap(logger, boot_marks=None):
     """
+    Deletes any .py files and performs rebundling if necessary, recording checkpoints in boot_marks if given.
+
+    Fast path: if the boot signature (see boot_signature) matches the one saved by the last successful bootstrap,
+    nothing has changed since, so this skips deleting .py files and hashing the .mpy files. The full checks run
+    (and save the new signature) only when the signature differs.
+    """
+    desired_bundle = ['components', 'constants', 'ugc', 'umqtt']
+    mark = boot_marks.mark if boot_marks is not None else lambda name: None
+    signature = boot_signature(desired_bundle)
+    if signature == read_boot_state():
+        mark("boot_state")
+        logger.print("Boot state unchanged; skipping .py cleanup and bundle check.")
+        return
+    mark("boot_state")
     delete_any_dot_py_files(logger)
-    rebundle_if_necessary(logger, ['components', 'constants', 'ugc', 'umqtt'])
+    mark("delete_py")
+    rebundle_if_necessary(logger, desired_bundle)  # Restarts MicroPython if it rebundles.
+    mark("rebundle")
+    write_boot_state(boot_signature(desired_bundle), logger)  # The listing changed if .py files were deleted.
 
 
 if __name__ == "__main__":
-    udr_logger = UserDataRelayLogger()
+    boot_marks = EarlyBootMarks()
+    udr_logger = BufferedUserDataRelayLogger()  # The application must call poll() regularly (e.g., in its main loop).
     dual_logger = DualSinkLogger(udr_logger)
 
     # Must delete any .py files and perform bundling before importing any user modules!
-    bootstrap(dual_logger)
+    bootstrap(dual_logger, boot_marks)
 
+    import bootprof
+    bootprof.start(boot_marks)
     from components import main
-    main(dual_logger)
+    bootprof.mark("imports")
+    main(dual_logger)  # The app should call bootprof.mark("app_init") and bootprof.report() once it's ready.
@@ -0,0 +1,33 @@
+"""
+hash_benchmark.py times the bundle hash implementations in bundle_demo.py on the device itself.
+Copy it (and bundle_demo.py) to the XBee and run it from the REPL with: import hash_benchmark
+
+The host counterpart (which runs the same device code on the CPython fakes) is cpython/bundlehash.py --size.
+No device results are recorded yet: this hasn't been run on an XBee 3. Add the figures here once it has.
+"""
+
+import utime
+
+from bundle_demo import crc32, djb2
+
+SIZE = 4096
+
+
+def time_us_per_kb(func, data):
+    start = utime.ticks_us()
+    func(data)
+    return utime.ticks_diff(utime.ticks_us(), start) * 1024 // len(data)
+
+
+def main():
+    data = bytearray(SIZE)
+    for i in range(SIZE):
+        data[i] = (i * 131 + 7) & 0xFF
+    print("djb2 (Python loop): %d us/KB" % time_us_per_kb(djb2, data))
+    if crc32 is None:
+        print("crc32: not available in this firmware (ubinascii.crc32 is missing)")
+    else:
+        print("crc32 (ubinascii): %d us/KB" % time_us_per_kb(crc32, data))
+
+
+main()
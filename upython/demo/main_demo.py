@@ -8,10 +8,10 @@ import binascii
 import sys
 
 from machine import Pin
-import xbee
 
 
-from helpers import ButtonBuffer, invert, MAX_PACKET_SIZE, PACKET_TYPE_LOG
+from core import ButtonBuffer, invert
+from logger import Logger
 
 # COORDINATOR_ADDRESS = xbee.ADDR_COORDINATOR
 COORDINATOR_ADDRESS = binascii.unhexlify("0013a200417d18ee")
@@ -30,28 +30,18 @@ def exception_details(ex):
     return traceback_stream.getvalue()
 
 
-def log(msg):
-    """
-    log transmits the given message via the network in a Log Packet.
-    If the message is too big to fit into a single packet, this chunks it up.
-    """
-    dest = COORDINATOR_ADDRESS
-    chunk_size = MAX_PACKET_SIZE - 1  # Minus 1 to make room for the packet type byte.
-    for i in range(0, len(msg), chunk_size-1):
-        chunk = msg[i:i+MAX_PACKET_SIZE]
-        tx = bytes([PACKET_TYPE_LOG]) + chunk
-        try:
-            xbee.transmit(dest, tx)
-        except:
-            print(msg)  # Looks like xbee.transmit isn't working, so just use print instead.
+# Log lines are buffered and sent in batches, at most a couple of packets per second, so that logging during a
+# failure storm can't saturate the radio. Call log.poll() regularly from the main loop.
+log = Logger(dest=COORDINATOR_ADDRESS, echo=True)
 
 
 def main():
     func = "main"
     try:
-        pass   # TODO  your code goes here!
+        pass   # TODO  your code goes here! e.g., a main loop that also calls log.poll() every pass.
     except Exception as ex:
-        log("%s: Fatal exception occurred in main. Details: %s" % (func, exception_details(ex)))
+        log.error("%s: Fatal exception occurred in main. Details: %s", func, exception_details(ex))
+        log.flush()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,69 @@
+"""
+lazy.py defers importing a module until it's first used, so that rarely used modules don't cost boot time or
+sit in the heap from boot onwards, and lets the app unload them again once it's done with them.
+
+    import lazy
+    mqtt = lazy.LazyModule("umqtt")     # Nothing is imported yet.
+    ...
+    mqtt.connect(...)                   # The first attribute access imports umqtt.
+    lazy.unload(mqtt)                   # Drops it from sys.modules and runs ugc.collect(); the next access reimports.
+
+Unloading only frees the module's globals if nothing else still refers to them: objects fetched from the module
+(functions, classes, instances) keep its globals alive, so don't hold on to them (e.g., call mqtt.connect() rather
+than keeping connect = mqtt.connect). Bundled modules' code lives in flash, but their globals are in the heap
+like any other module's.
+
+cpython/core.py's check_lazy_modules() (run by make.py --build) finds the LazyModule("...") calls in the sources
+and reports lazy modules that don't exist or weren't built. Keep the module name a string literal so that the
+check can see it. make.py --deploy checks the device's bundle hash (ATKP), so a stale bundled lazy module gets
+rebundled too.
+"""
+
+import sys
+
+import ugc
+
+
+class LazyModule:
+    """ LazyModule stands in for the named module and imports it on first attribute access. """
+
+    def __init__(self, name: str):
+        self._lazy_name = name
+        self._lazy_module = None
+        self._lazy_loads = 0  # Number of times the module has been imported, e.g., for tests and diagnostics.
+
+    def __getattr__(self, attr):
+        # Only called for attributes that the proxy itself doesn't have, i.e., the module's attributes.
+        module = self._lazy_module
+        if module is None:
+            module = load(self)
+        return getattr(module, attr)
+
+    def __repr__(self):
+        return "<LazyModule %s (%s)>" % (self._lazy_name, "loaded" if self._lazy_module is not None else "not loaded")
+
+
+def load(proxy: LazyModule):
+    """ load imports the proxy's module now (e.g., during idle time), returning the module. """
+    if proxy._lazy_module is None:
+        module = __import__(proxy._lazy_name)
+        for part in proxy._lazy_name.split(".")[1:]:  # __import__("a.b") returns the top-level package a.
+            module = getattr(module, part)
+        proxy._lazy_module = module
+        proxy._lazy_loads += 1
+    return proxy._lazy_module
+
+
+def loaded(proxy: LazyModule) -> bool:
+    return proxy._lazy_module is not None
+
+
+def unload(proxy: LazyModule, collect: bool = True) -> None:
+    """ unload forgets the proxy's module so that its heap can be reclaimed, optionally collecting right away. """
+    if proxy._lazy_module is None:
+        return
+    proxy._lazy_module = None
+    if proxy._lazy_name in sys.modules:
+        del sys.modules[proxy._lazy_name]
+    if collect:
+        ugc.collect()
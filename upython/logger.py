@@ -0,0 +1,211 @@
+"""
+logger.py contains a buffered, rate-limited logger that sends log lines over the network without flooding the
+radio or the heap, even when something is failing repeatedly and logging on every pass through the main loop.
+
+    log = Logger(level=INFO)
+    log.info("boot %d", count)        # Messages below the level are discarded before any formatting.
+    while True:
+        ...
+        log.poll()                    # Sends buffered lines, within the rate limit.
+
+- Lines are stored in a preallocated ring buffer. When it's full, the oldest lines are dropped (and counted), and
+  the next packet starts with a line saying how many were lost.
+- poll() packs as many lines as fit into each packet (lines longer than a packet span several packets) and sends
+  at most rate_per_sec packets per second, with bursts of up to `burst` packets (a token bucket on ticks_ms).
+- If sending fails (e.g., ENOBUFS), the lines stay buffered for the next poll().
+
+Each packet is PACKET_TYPE_LOG followed by UTF-8 text: one or more lines of the form "<level letter> <message>\n".
+Consumers should concatenate the text of consecutive packets, since a long line may continue in the next packet.
+
+Logging calls with arguments allocate a tuple for *args even when the line is filtered out, so wrap debug logging
+in hot loops with "if log.enabled(DEBUG):" to keep them allocation-free.
+"""
+
+import utime
+import xbee
+
+from core import MAX_PACKET_SIZE, PacketBuilder
+
+# Caution: Ensure that PACKET_TYPE_LOG matches the CSXB_MSG_LOG definition in bundle_demo.py.
+PACKET_TYPE_LOG = 0x00
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+_LETTERS = {DEBUG: b"D", INFO: b"I", WARNING: b"W", ERROR: b"E"}
+_RECORD_HEADER = 3  # Level (1 byte) and text length (2 bytes) of each record in the ring buffer.
+
+
+class Logger:
+    """
+    Logger buffers log lines and sends them to `dest` with xbee.transmit(), or to send(packet) if given.
+    stats counts lines logged, lines filtered out, lines dropped (oldest first) and packets sent.
+    """
+
+    def __init__(self, dest=None, send=None, level: int = INFO, capacity: int = 2048, rate_per_sec: int = 2,
+                 burst: int = 4, echo: bool = False):
+        if send is None:
+            dest = xbee.ADDR_COORDINATOR if dest is None else dest
+            send = lambda packet: xbee.transmit(dest, packet)
+        self.send = send
+        self.level = level
+        self.echo = echo  # Also print() each line, e.g., for the REPL.
+        self.rate_per_sec = rate_per_sec
+        self.burst = burst
+        self._ring = bytearray(capacity)
+        self._head = 0  # Offset of the oldest record.
+        self._used = 0  # Bytes of the ring in use.
+        self._sent = 0  # Bytes of the oldest record's text already sent (when it spans several packets).
+        self._credit = burst * 1000  # Token bucket, in thousandths of a packet.
+        self._refilled = utime.ticks_ms()
+        self._unreported_drops = 0
+        self._unterminated = False  # A partly sent line was dropped, so the host is still waiting for its newline.
+        self._builder = PacketBuilder(MAX_PACKET_SIZE)
+        self.stats = {"logged": 0, "filtered": 0, "dropped": 0, "packets": 0, "send_errors": 0}
+
+    def enabled(self, level: int) -> bool:
+        return level >= self.level
+
+    def debug(self, fmt, *args) -> None:
+        self.log(DEBUG, fmt, *args)
+
+    def info(self, fmt, *args) -> None:
+        self.log(INFO, fmt, *args)
+
+    def warning(self, fmt, *args) -> None:
+        self.log(WARNING, fmt, *args)
+
+    def error(self, fmt, *args) -> None:
+        self.log(ERROR, fmt, *args)
+
+    def print(self, msg) -> None:
+        """ print logs msg at INFO level, so a Logger can stand in for the loggers in bundle_demo.py. """
+        self.log(INFO, msg)
+
+    def log(self, level: int, fmt, *args) -> None:
+        if level < self.level:
+            self.stats["filtered"] += 1
+            return
+        msg = fmt % args if args else fmt
+        if self.echo:
+            print(msg)
+        self._append(level, msg.encode() if isinstance(msg, str) else msg)
+        self.stats["logged"] += 1
+
+    def pending(self) -> int:
+        """ pending returns the number of bytes of log records waiting to be sent. """
+        return self._used
+
+    def poll(self) -> None:
+        """ poll sends buffered lines, as many packets as the rate limit allows. """
+        now = utime.ticks_ms()
+        self._credit = min(self.burst * 1000,
+                           self._credit + utime.ticks_diff(now, self._refilled) * self.rate_per_sec)
+        self._refilled = now
+        while (self._used or self._unreported_drops) and self._credit >= 1000:
+            if not self._send_packet():
+                return
+            self._credit -= 1000
+
+    def flush(self) -> None:
+        """ flush sends everything that's buffered right away, ignoring the rate limit (e.g., before a reset). """
+        while self._used or self._unreported_drops:
+            if not self._send_packet():
+                return
+
+    # ---- Internals ----
+
+    def _append(self, level: int, text) -> None:
+        max_text = len(self._ring) // 2 - _RECORD_HEADER
+        if len(text) > max_text:
+            text = text[:max_text]  # Don't let one huge line flush out the whole buffer.
+        needed = _RECORD_HEADER + len(text)
+        while len(self._ring) - self._used < needed:
+            self._drop_oldest()
+        tail = (self._head + self._used) % len(self._ring)
+        self._put_byte(tail, level)
+        self._put_byte(tail + 1, len(text) >> 8)
+        self._put_byte(tail + 2, len(text) & 0xFF)
+        self._copy_in((tail + _RECORD_HEADER) % len(self._ring), text)
+        self._used += needed
+
+    def _put_byte(self, pos: int, value: int) -> None:
+        self._ring[pos % len(self._ring)] = value
+
+    def _get_byte(self, pos: int) -> int:
+        return self._ring[pos % len(self._ring)]
+
+    def _copy_in(self, pos: int, data) -> None:
+        first = min(len(data), len(self._ring) - pos)
+        view = memoryview(data)
+        self._ring[pos:pos + first] = view[:first]
+        if first < len(data):
+            self._ring[0:len(data) - first] = view[first:]
+
+    def _copy_out(self, pos: int, num_bytes: int, builder: PacketBuilder) -> None:
+        pos %= len(self._ring)
+        first = min(num_bytes, len(self._ring) - pos)
+        view = memoryview(self._ring)
+        builder.put_bytes(view[pos:pos + first])
+        if first < num_bytes:
+            builder.put_bytes(view[0:num_bytes - first])
+
+    def _record_text_length(self) -> int:
+        return (self._get_byte(self._head + 1) << 8) | self._get_byte(self._head + 2)
+
+    def _drop_oldest(self) -> None:
+        size = _RECORD_HEADER + self._record_text_length()
+        self._head = (self._head + size) % len(self._ring)
+        self._used -= size
+        if self._sent:
+            self._unterminated = True
+            self._sent = 0
+        self.stats["dropped"] += 1
+        self._unreported_drops += 1
+
+    def _send_packet(self) -> bool:
+        """ _send_packet sends one packet of buffered lines. Returns False if sending failed. """
+        builder = self._builder
+        builder.reset()
+        builder.put_u8(PACKET_TYPE_LOG)
+        if self._unreported_drops:
+            if self._unterminated:
+                builder.put_u8(0x0A)
+            builder.put_bytes(("W %d log lines dropped\n" % self._unreported_drops).encode())
+        consumed = 0  # Bytes of the ring this packet empties, if it's sent.
+        pos = self._head
+        sent = self._sent
+        used = self._used
+        while consumed < used:
+            room = len(builder.buf) - builder.length
+            text_length = (self._get_byte(pos + 1) << 8) | self._get_byte(pos + 2)
+            prefix = 2 if sent == 0 else 0  # The level letter and a space start each line.
+            if room < prefix + 2:
+                break  # Not even a byte of text (plus the newline) would fit.
+            if prefix:
+                builder.put_bytes(_LETTERS.get(self._get_byte(pos), b"?"))
+                builder.put_u8(0x20)
+            remaining = text_length - sent
+            chunk = min(remaining, room - prefix - 1)
+            self._copy_out(pos + _RECORD_HEADER + sent, chunk, builder)
+            if chunk < remaining:
+                sent += chunk  # The rest of this line goes in the next packet.
+                break
+            builder.put_u8(0x0A)
+            consumed += _RECORD_HEADER + text_length
+            pos += _RECORD_HEADER + text_length
+            sent = 0
+        try:
+            self.send(builder.packet())
+        except OSError:
+            self.stats["send_errors"] += 1
+            return False
+        self.stats["packets"] += 1
+        self._unreported_drops = 0
+        self._unterminated = False
+        self._head = pos % len(self._ring)
+        self._used -= consumed
+        self._sent = sent
+        return True
@@ -0,0 +1,306 @@
+"""
+transport.py delivers payloads of any size reliably and in order over xbee.transmit(), for bulk transfers such as
+logs and configuration blobs. The host counterpart is cpython/transport.py; both speak the same wire format.
+
+Payloads are split into fragments that fit in one packet. Up to `window` fragments per peer are in flight at once
+(a sliding window rather than stop-and-wait), the receiver acknowledges them selectively, and fragments that go
+unacknowledged for the retransmission timeout (estimated from the round trip time, on utime.ticks_ms) are sent again.
+
+    transport = Transport(on_message=handle_message)
+    transport.send(xbee.ADDR_COORDINATOR, config_blob)
+    while True:
+        msg = xbee.receive()
+        if msg is not None and not transport.handle(msg["sender_eui64"], msg["payload"]):
+            ...handle the app's other packet types...
+        transport.poll()
+        utime.sleep_ms(10)
+
+Wire format (every field Big Endian):
+    DATA: PACKET_TYPE_DATA (1 byte), sequence number (2 bytes), flags (1 byte), fragment (0 to FRAGMENT_SIZE bytes)
+    ACK:  PACKET_TYPE_ACK (1 byte), next expected sequence number (2 bytes), SACK bitmap (4 bytes)
+Bit i of the SACK bitmap means the fragment i+1 after the next expected one has arrived (out of order).
+FLAG_LAST marks the last fragment of a payload. FLAG_SYN marks the first fragment a sender sends to a peer; until it
+is acknowledged, that's the only fragment in flight. Each sender starts at a random sequence number, so after the
+sender restarts (or gives up on a peer) the receiver sees a FLAG_SYN fragment far from where it left off and
+resynchronizes.
+
+Caution: Ensure that these definitions match the redundant definitions in cpython/transport.py.
+"""
+
+import uos
+import utime
+import xbee
+
+from core import MAX_PACKET_SIZE, MAX_SEQUENCE_NUMBER, PacketBuilder, sequence_more_recent
+
+PACKET_TYPE_DATA = 0x10
+PACKET_TYPE_ACK = 0x11
+FLAG_LAST = 0x01
+FLAG_SYN = 0x02
+HEADER_SIZE = 4
+ACK_SIZE = 7
+FRAGMENT_SIZE = MAX_PACKET_SIZE - HEADER_SIZE
+SACK_BITS = 32
+MAX_WINDOW = 30  # Keeps the window inside the SACK bitmap, and bitmaps built from it small ints.
+
+# In-flight fragment fields. Each fragment is a small list rather than an object to keep the heap footprint down.
+_SEQ = 0
+_FLAGS = 1
+_DATA = 2
+_SENT_AT = 3
+_RETRIES = 4
+
+
+def _random_sequence_number(avoid: int = None) -> int:
+    """ _random_sequence_number returns a random starting sequence number that's far from `avoid`, if given. """
+    while True:
+        r = uos.urandom(2)
+        seq = (r[0] << 8) | r[1]
+        distance = (seq - avoid) & MAX_SEQUENCE_NUMBER if avoid is not None else MAX_SEQUENCE_NUMBER // 2
+        if 2 * SACK_BITS <= distance <= MAX_SEQUENCE_NUMBER - 2 * SACK_BITS:
+            return seq
+
+
+class _Peer:
+    """ _Peer holds both directions of the transport's state for one remote address. """
+
+    def __init__(self, rto_ms: int):
+        # Sending.
+        self.queue = []  # Payloads (memoryviews) waiting to be fragmented.
+        self.offset = 0  # Bytes of queue[0] already fragmented.
+        self.next_seq = _random_sequence_number()
+        self.in_flight = []  # Fragments sent but not acknowledged, oldest first.
+        self.syn = True  # Until the first fragment (the FLAG_SYN one) is acknowledged.
+        self.rto_ms = rto_ms
+        self.srtt_ms = 0  # Smoothed round trip time, or 0 before the first sample.
+        # Receiving.
+        self.expected = None  # Next sequence number to deliver, or None before the first fragment.
+        self.held = {}  # Sequence number -> (flags, fragment) for fragments that arrived out of order.
+        self.parts = []  # Fragments of the payload being reassembled.
+
+
+class Transport:
+    """
+    Transport is the reliable transport for every peer of this device. Call send() to queue a payload, pass each
+    received packet to handle(), and call poll() regularly (e.g., every pass through the main loop) to send new
+    fragments and retransmit lost ones. Each payload is passed to on_message(sender, payload) when it's complete.
+    Address peers by their 64-bit address or xbee.ADDR_COORDINATOR; broadcasts can't be acknowledged.
+
+    A peer that fails to acknowledge a fragment max_retries times is given up on: its queued and in-flight payloads
+    are discarded (and counted as failed), and the next payload starts afresh with FLAG_SYN.
+    """
+
+    def __init__(self, transmit=None, on_message=None, window: int = 8, rto_ms: int = 1000, min_rto_ms: int = 100,
+                 max_rto_ms: int = 8000, max_retries: int = 8, max_queued: int = 4):
+        self.transmit = transmit if transmit is not None else xbee.transmit
+        self.on_message = on_message
+        self.window = min(window, MAX_WINDOW)
+        self.initial_rto_ms = rto_ms
+        self.min_rto_ms = min_rto_ms
+        self.max_rto_ms = max_rto_ms
+        self.max_retries = max_retries
+        self.max_queued = max_queued
+        self.peers = {}  # Address (bytes) -> _Peer
+        self._aliases = {}  # xbee.ADDR_COORDINATOR -> the coordinator's own address, once it has answered.
+        self._builder = PacketBuilder()
+        self.stats = {"sent": 0, "retransmitted": 0, "acked": 0, "failed": 0, "transmit_errors": 0,
+                      "received": 0, "duplicates": 0, "delivered": 0}
+
+    def _peer(self, address) -> _Peer:
+        address = bytes(address)
+        address = self._aliases.get(address, address)
+        peer = self.peers.get(address)
+        if peer is None:
+            peer = self.peers[address] = _Peer(self.initial_rto_ms)
+        return peer
+
+    def send(self, dest, payload) -> bool:
+        """ send queues a payload for reliable delivery. Returns False if too many payloads are already queued. """
+        peer = self._peer(dest)
+        if len(peer.queue) >= self.max_queued:
+            return False
+        peer.queue.append(memoryview(payload))
+        return True
+
+    def idle(self) -> bool:
+        """ idle returns True once every queued payload has been acknowledged (or given up on). """
+        for peer in self.peers.values():
+            if peer.queue or peer.in_flight:
+                return False
+        return True
+
+    def poll(self) -> None:
+        now = utime.ticks_ms()
+        for address, peer in self.peers.items():
+            timed_out = False
+            for fragment in peer.in_flight:
+                if utime.ticks_diff(now, fragment[_SENT_AT]) >= peer.rto_ms:
+                    if fragment[_RETRIES] >= self.max_retries:
+                        self._give_up(peer)
+                        timed_out = False
+                        break
+                    self._retransmit(address, fragment, now)
+                    timed_out = True
+            if timed_out:
+                peer.rto_ms = min(peer.rto_ms * 2, self.max_rto_ms)  # Back off while the link is struggling.
+            while peer.queue and len(peer.in_flight) < (1 if peer.syn else self.window):
+                self._send_next_fragment(address, peer, now)
+
+    def handle(self, sender, payload) -> bool:
+        """ handle processes a received packet. Returns False if it isn't a transport packet, so the app can. """
+        if len(payload) < 1:
+            return False
+        if payload[0] == PACKET_TYPE_DATA and len(payload) >= HEADER_SIZE:
+            self._handle_data(sender, payload)
+            return True
+        if payload[0] == PACKET_TYPE_ACK and len(payload) >= ACK_SIZE:
+            self._handle_ack(sender, payload)
+            return True
+        return False
+
+    # ---- Sending ----
+
+    def _send_next_fragment(self, address, peer: _Peer, now: int) -> None:
+        data = peer.queue[0]
+        end = min(peer.offset + FRAGMENT_SIZE, len(data))
+        flags = FLAG_SYN if peer.syn else 0
+        fragment = data[peer.offset:end]
+        if end >= len(data):
+            flags |= FLAG_LAST
+            peer.queue.pop(0)
+            peer.offset = 0
+        else:
+            peer.offset = end
+        seq = peer.next_seq
+        peer.next_seq = (seq + 1) & MAX_SEQUENCE_NUMBER
+        peer.in_flight.append([seq, flags, fragment, now, 0])
+        self._transmit_fragment(address, seq, flags, fragment)
+        self.stats["sent"] += 1
+
+    def _retransmit(self, address, fragment, now: int) -> None:
+        fragment[_SENT_AT] = now
+        fragment[_RETRIES] += 1
+        self._transmit_fragment(address, fragment[_SEQ], fragment[_FLAGS], fragment[_DATA])
+        self.stats["retransmitted"] += 1
+
+    def _transmit_fragment(self, address, seq: int, flags: int, fragment) -> None:
+        builder = self._builder
+        builder.reset()
+        builder.put_u8(PACKET_TYPE_DATA)
+        builder.put_u16(seq)
+        builder.put_u8(flags)
+        builder.put_bytes(fragment)
+        try:
+            self.transmit(address, builder.packet())
+        except OSError:
+            self.stats["transmit_errors"] += 1  # E.g., ENOBUFS. The retransmission timer will try again.
+
+    def _give_up(self, peer: _Peer) -> None:
+        payloads = len(peer.queue) + sum(1 for fragment in peer.in_flight if fragment[_FLAGS] & FLAG_LAST)
+        self.stats["failed"] += payloads
+        peer.queue = []
+        peer.offset = 0
+        peer.in_flight = []
+        peer.syn = True
+        peer.rto_ms = self.initial_rto_ms
+        peer.next_seq = _random_sequence_number(avoid=peer.next_seq)
+
+    def _handle_ack(self, sender, payload) -> None:
+        sender = bytes(sender)
+        expected = (payload[1] << 8) | payload[2]
+        sack = (payload[3] << 24) | (payload[4] << 16) | (payload[5] << 8) | payload[6]
+        peer = self.peers.get(sender)
+        coordinator = self.peers.get(xbee.ADDR_COORDINATOR)
+        if (peer is None or not peer.in_flight) and coordinator is not None and self._acks(coordinator, expected):
+            # Payloads sent to xbee.ADDR_COORDINATOR are acknowledged from the coordinator's own address.
+            if peer is not None:
+                coordinator.expected, coordinator.held, coordinator.parts = peer.expected, peer.held, peer.parts
+            peer = self.peers[sender] = self.peers.pop(xbee.ADDR_COORDINATOR)
+            self._aliases[xbee.ADDR_COORDINATOR] = sender
+        if peer is None or not self._acks(peer, expected):
+            return  # E.g., a late ACK from before this peer was given up on.
+        now = utime.ticks_ms()
+        remaining = []
+        for fragment in peer.in_flight:
+            seq = fragment[_SEQ]
+            offset = (seq - expected - 1) & MAX_SEQUENCE_NUMBER
+            if sequence_more_recent(expected, seq) or (offset < SACK_BITS and (sack >> offset) & 1):
+                self.stats["acked"] += 1
+                if fragment[_RETRIES] == 0:
+                    self._sample_rtt(peer, utime.ticks_diff(now, fragment[_SENT_AT]))
+            else:
+                remaining.append(fragment)
+        if len(remaining) < len(peer.in_flight):
+            peer.syn = False
+        peer.in_flight = remaining
+        # Fragments after a hole arrived, so the hole was probably lost: resend it without waiting for the timer,
+        # but at most once per round trip.
+        if sack and remaining and remaining[0][_SEQ] == expected and \
+                utime.ticks_diff(now, remaining[0][_SENT_AT]) >= peer.srtt_ms:
+            self._retransmit(sender, remaining[0], now)
+
+    @staticmethod
+    def _acks(peer: _Peer, expected: int) -> bool:
+        """ _acks returns True if an ACK's next expected sequence number is about the peer's fragments in flight. """
+        if not peer.in_flight:
+            return False
+        oldest = peer.in_flight[0][_SEQ]
+        return (expected - oldest) & MAX_SEQUENCE_NUMBER <= (peer.next_seq - oldest) & MAX_SEQUENCE_NUMBER
+
+    def _sample_rtt(self, peer: _Peer, rtt_ms: int) -> None:
+        peer.srtt_ms = rtt_ms if peer.srtt_ms == 0 else (7 * peer.srtt_ms + rtt_ms) // 8
+        peer.rto_ms = max(self.min_rto_ms, min(2 * peer.srtt_ms, self.max_rto_ms))
+
+    # ---- Receiving ----
+
+    def _handle_data(self, sender, payload) -> None:
+        peer = self._peer(sender)
+        seq = (payload[1] << 8) | payload[2]
+        flags = payload[3]
+        self.stats["received"] += 1
+        if flags & FLAG_SYN and (peer.expected is None or not self._recognized(peer, seq)):
+            peer.expected = seq
+            peer.held = {}
+            peer.parts = []
+        elif peer.expected is None:
+            return  # We lost our state (e.g., restarted) and can't place this. The sender will give up and resync.
+        ahead = (seq - peer.expected) & MAX_SEQUENCE_NUMBER
+        if ahead == 0:
+            self._accept(sender, peer, flags, payload[HEADER_SIZE:])
+            while peer.expected in peer.held:
+                held_flags, fragment = peer.held.pop(peer.expected)
+                self._accept(sender, peer, held_flags, fragment)
+        elif ahead <= SACK_BITS and seq not in peer.held:
+            peer.held[seq] = (flags, payload[HEADER_SIZE:])
+        else:
+            self.stats["duplicates"] += 1  # Already delivered (its ACK was lost), or too far ahead to hold.
+        self._send_ack(sender, peer)
+
+    def _recognized(self, peer: _Peer, seq: int) -> bool:
+        """ _recognized returns True if seq is near the receive window, i.e., not from a restarted sender. """
+        distance = (seq - peer.expected) & MAX_SEQUENCE_NUMBER
+        return distance <= SACK_BITS or distance >= MAX_SEQUENCE_NUMBER + 1 - 2 * SACK_BITS
+
+    def _accept(self, sender, peer: _Peer, flags: int, fragment) -> None:
+        peer.expected = (peer.expected + 1) & MAX_SEQUENCE_NUMBER
+        peer.parts.append(fragment)
+        if flags & FLAG_LAST:
+            message = b"".join(peer.parts)
+            peer.parts = []
+            self.stats["delivered"] += 1
+            if self.on_message is not None:
+                self.on_message(bytes(sender), message)
+
+    def _send_ack(self, sender, peer: _Peer) -> None:
+        sack = 0
+        for seq in peer.held:
+            sack |= 1 << ((seq - peer.expected - 1) & MAX_SEQUENCE_NUMBER)
+        builder = self._builder
+        builder.reset()
+        builder.put_u8(PACKET_TYPE_ACK)
+        builder.put_u16(peer.expected)
+        builder.put_u32(sack)
+        try:
+            self.transmit(sender, builder.packet())
+        except OSError:
+            self.stats["transmit_errors"] += 1